@@ -0,0 +1,230 @@
+"""Latency benchmark of the JSON API on a synthetic SQLite dataset
+
+Writes articles, creators, authors and monthly downloads straight into a
+SQLite database (100k articles x 50 months, 5M downloads, by default),
+rebuilds the rollups and search postings, then requests every API route
+through the Flask test client with the response cache disabled and
+prints the p50, p95 and slowest latency of each.  The database is kept
+and reused when it already exists.
+
+    python api_benchmark.py --database /tmp/api.db
+    python api_benchmark.py --database /tmp/api.db --max-p95 50"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+CONTEXTS = ['alr', 'delpf', 'djcil', 'djglp', 'dlj', 'dltr', 'etd',
+            'faculty_scholarship', 'lcp', 'working_papers']
+WORDS = [u"word{0}".format(i) for i in range(2000)]
+KEYWORDS = [u"keyword{0}".format(i) for i in range(500)]
+DISCIPLINES = [u"Discipline {0}".format(i) for i in range(50)]
+INSERT_SIZE = 10000
+FIRST_MONTH = datetime.date(2012, 1, 1)
+
+
+def month_dates(months):
+    """Return the first days of months consecutive months"""
+    return [datetime.date(FIRST_MONTH.year + (FIRST_MONTH.month - 1 + i) // 12,
+                          (FIRST_MONTH.month - 1 + i) % 12 + 1, 1)
+            for i in range(months)]
+
+
+def insert(session, table, rows):
+    """Insert rows INSERT_SIZE at a time"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_SIZE:
+            session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        session.execute(table.insert(), batch)
+
+
+def article_rows(articles, rng):
+    """Yield the article rows"""
+    for article_id in range(1, articles + 1):
+        context = CONTEXTS[article_id % len(CONTEXTS)]
+        yield {'id': article_id,
+               'oai_identifier': u"oai:scholarship.law.duke.edu:{0}-{1}".
+               format(context, article_id),
+               'title': u" ".join(rng.sample(WORDS, 6)),
+               'date': datetime.date(2000 + rng.randrange(20),
+                                     rng.randrange(1, 13), 1),
+               'document_type': u'article',
+               'status': u'published',
+               'article_url': u"http://scholarship.law.duke.edu/{0}/{1}".
+               format(context, article_id),
+               'publication': context.decode('utf-8'),
+               'byline': u"Author {0}".format(article_id),
+               'context': context.decode('utf-8'),
+               'has_faculty': article_id % 3 == 0}
+
+
+def generate(session, articles, authors, months, seed):
+    """Write the synthetic dataset and rebuild its rollups and postings"""
+    from repository_metrics import rollups, search
+    from repository_metrics.model import (Article, Author, Creator,
+                                          Discipline, Download, Subject,
+                                          bump_dataset_version)
+    rng = random.Random(seed)
+    session.execute("PRAGMA synchronous = OFF")
+    session.execute("PRAGMA journal_mode = MEMORY")
+    emails = max(1, articles // 5)
+    print("articles")
+    insert(session, Article.__table__, article_rows(articles, rng))
+    print("authors")
+    insert(session, Author.__table__,
+           ({'id': i + 1, 'name_key': u"last{0} first{0}".format(i),
+             'email': u"a{0}@law.duke.edu".format(i),
+             'name': u"Last{0}, First{0}".format(i)}
+            for i in range(emails)))
+    print("creators, subjects and disciplines")
+    insert(session, Creator.__table__,
+           ({'article_id': article_id, 'position': position,
+             'first': u"First{0}".format(author), 'last':
+             u"Last{0}".format(author),
+             'email': u"a{0}@law.duke.edu".format(author),
+             'author_id': author + 1}
+            for article_id in range(1, articles + 1)
+            for (position, author) in
+            enumerate(rng.sample(xrange(emails), min(emails, rng.randint(
+                1, authors))), 1)))
+    insert(session, Subject.__table__,
+           ({'article_id': article_id, 'position': position, 'term': term}
+            for article_id in range(1, articles + 1)
+            for (position, term) in enumerate(rng.sample(KEYWORDS, 3), 1)))
+    insert(session, Discipline.__table__,
+           ({'article_id': article_id, 'position': 1,
+             'term': rng.choice(DISCIPLINES)}
+            for article_id in range(1, articles + 1)))
+    print("downloads")
+    dates = month_dates(months)
+    insert(session, Download.__table__,
+           ({'article_id': article_id, 'download_date': download_date,
+             'download_count': rng.randrange(100)}
+            for article_id in range(1, articles + 1)
+            for download_date in dates))
+    session.commit()
+    rollups.rebuild(session)
+    search.rebuild(session)
+    bump_dataset_version(session)
+
+
+def requests(articles, authors, rng, samples):
+    """Return {route: [urls]} of samples requests per route"""
+    emails = max(1, articles // 5)
+
+    def article():
+        return rng.randint(1, articles)
+
+    def author():
+        return rng.randrange(emails)
+    return {
+        'article': ["/api/articles/{0}".format(article())
+                    for i in range(samples)],
+        'article_days': ["/api/articles/{0}/days?start=2015-01-01".format(
+            article()) for i in range(samples)],
+        'page': ["/api/articles?per_page=50&context={0}".format(
+            rng.choice(CONTEXTS)) for i in range(samples)],
+        'page_title': ["/api/articles?per_page=50&sort=title&context={0}".
+                       format(rng.choice(CONTEXTS)) for i in range(samples)],
+        'author_email': ["/api/authors/a{0}@law.duke.edu".format(author())
+                         for i in range(samples)],
+        'author_id': ["/api/authors/{0}".format(author() + 1)
+                      for i in range(samples)],
+        'contexts': ["/api/contexts" for i in range(samples)],
+        'context': ["/api/contexts/{0}".format(rng.choice(CONTEXTS))
+                    for i in range(samples)],
+        'top_articles': ["/api/top/articles?n=10" for i in range(samples)],
+        'top_articles_context': ["/api/top/articles?n=10&context={0}".format(
+            rng.choice(CONTEXTS)) for i in range(samples)],
+        'top_authors': ["/api/top/authors?n=10" for i in range(samples)],
+        'search': ["/api/search?q={0}+{1}".format(rng.choice(WORDS),
+                                                  rng.choice(KEYWORDS))
+                   for i in range(samples)]}
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values"""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure(client, urls):
+    """Return the sorted latencies in ms of urls, after one warm-up"""
+    client.get(urls[0])
+    latencies = []
+    for url in urls:
+        start = time.time()
+        response = client.get(url)
+        latencies.append((time.time() - start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError("{0}: {1}".format(url, response.status_code))
+    return sorted(latencies)
+
+
+def main(args):
+    database = args.database or os.path.join(tempfile.gettempdir(),
+                                             'api_benchmark.db')
+    config = database + '.cfg'
+    with open(config, 'w') as config_file:
+        config_file.write("[sqlalchemy]\ndsn=sqlite:///{0}\necho=False\n".
+                          format(database))
+    os.environ['REPOSITORY_METRICS_CONFIG'] = config
+    from repository_metrics import model
+    from repository_metrics.api import cache
+    from repository_metrics.application import app
+    if not os.path.exists(database):
+        model.Base.metadata.create_all(model.get_engine())
+        start = time.time()
+        generate(model.get_session(), args.articles, args.authors,
+                 args.months, args.seed)
+        print("generated {0} in {1:.0f}s".format(database,
+                                                 time.time() - start))
+    # every request is a miss, as after a load
+    cache.max_bytes = 0
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    worst = 0
+    print("{0:<22} {1:>8} {2:>8} {3:>8}".format('route', 'p50 ms', 'p95 ms',
+                                                'max ms'))
+    for (name, urls) in sorted(requests(args.articles, args.authors, rng,
+                                        args.samples).items()):
+        latencies = measure(client, urls)
+        p95 = percentile(latencies, 0.95)
+        worst = max(worst, p95)
+        print("{0:<22} {1:>8.1f} {2:>8.1f} {3:>8.1f}".format(
+            name, percentile(latencies, 0.5), p95, latencies[-1]))
+    if args.max_p95 is not None and worst > args.max_p95:
+        print("p95 {0:.1f} ms exceeds {1} ms".format(worst, args.max_p95))
+        return 1
+    return 0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the API " +
+                                     "latency on synthetic data")
+    parser.add_argument('--database', help="SQLite database, generated " +
+                        "when missing")
+    parser.add_argument('--articles', help="Articles", type=int,
+                        default=100000)
+    parser.add_argument('--authors', help="Most authors per article",
+                        type=int, default=3)
+    parser.add_argument('--months', help="Months of downloads", type=int,
+                        default=50)
+    parser.add_argument('--seed', help="Random seed", type=int, default=1)
+    parser.add_argument('--samples', help="Requests per route", type=int,
+                        default=200)
+    parser.add_argument('--max-p95', help="Exit 1 when a route's p95 " +
+                        "latency exceeds this many ms", type=float)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    sys.exit(main(args))
@@ -0,0 +1,349 @@
+"""Synthetic data benchmarks for the loaders and exports
+
+Generates editor, metadata and downloads spreadsheets at a chosen scale,
+loads them row by row and in bulk into fresh SQLite databases with load.py
+and load_downloads.py and runs every export report, each as a separate
+process with --profile.  The elapsed time, peak memory and query count of
+every case can be saved as a baseline, with its scale and seed, and later
+checked against it.
+
+    python benchmark.py --articles 2000 --authors 3 --months 36
+    python benchmark.py --save baseline.json
+    python benchmark.py --check baseline.json --threshold 1.5"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import xlwt
+from repository_metrics import export
+
+
+SOURCE = os.path.dirname(os.path.realpath(__file__))
+CONTEXTS = ['dlj', 'faculty_scholarship']
+AUTHOR_FIELDS = ['First Name', 'Middle Name', 'Last Name', 'Suffix',
+                 'Institution', 'Email']
+# xls sheets hold 65536 rows of 256 columns
+MAX_ROWS = 65536
+MAX_COLUMNS = 256
+DATE_FORMAT = xlwt.easyxf(num_format_str='YYYY-MM-DD')
+# arguments a baseline records and --check restores
+SCALE = ['articles', 'authors', 'months', 'emails', 'seed']
+
+
+def article_url(context, number):
+    """Return the synthetic url of an article"""
+    return u"http://scholarship.law.duke.edu/{0}/{1}".format(context, number)
+
+
+def pdf_url(context, number):
+    """Return the pdf url load.py derives for an article"""
+    return u"http://scholarship.law.duke.edu/cgi/viewcontent.cgi?" + \
+        u"article={0}&context={1}".format(number, context)
+
+
+def write_row(sheet, index, values):
+    """Write a row of values, formatting dates"""
+    for (column, value) in enumerate(values):
+        if isinstance(value, datetime.date):
+            sheet.write(index, column, value, DATE_FORMAT)
+        else:
+            sheet.write(index, column, value)
+
+
+def write_editor_report(path, context, articles, authors, emails, rng):
+    """Write an editor report of articles with up to authors creators"""
+    workbook = xlwt.Workbook()
+    sheet = workbook.add_sheet('editor')
+    header = ['Manuscript#', 'Title', 'URL', 'Submission date',
+              'Date posted', 'Submission type', 'Last event',
+              'Date of last event', 'Status', 'Keywords']
+    for author in range(1, authors + 1):
+        header.extend("Author {0} {1}".format(author, field)
+                      for field in AUTHOR_FIELDS)
+    write_row(sheet, 0, header)
+    for number in range(1, articles + 1):
+        posted = datetime.date(2000 + number % 15, 1 + number % 12,
+                               1 + number % 28)
+        values = [number, u" Article {0} of {1} ".format(number, context),
+                  article_url(context, number),
+                  posted - datetime.timedelta(days=90), posted,
+                  u'article', u'published', posted, u'published',
+                  u", ".join(u"keyword {0}".format(rng.randint(1, 200))
+                             for _ in range(rng.randint(0, 5)))]
+        count = rng.randint(1, authors)
+        for author in range(authors):
+            if author < count:
+                email = u''
+                if rng.random() < 0.7:
+                    email = u"author{0}@law.duke.edu".format(
+                        rng.randint(1, emails))
+                values.extend([u"First{0}".format(rng.randint(1, 500)),
+                               rng.choice([u'', u'Q.']),
+                               u"Last{0}".format(rng.randint(1, 2000)),
+                               rng.choice([u'', u'', u'', u'Jr.']),
+                               u'Duke University', email])
+            else:
+                values.extend([u''] * len(AUTHOR_FIELDS))
+        write_row(sheet, number, values)
+    workbook.save(path)
+
+
+def write_metadata_report(path, context, articles, rng):
+    """Write a metadata report for every article
+
+    A third of the faculty articles point at the journal version of the
+    dlj article with the same number."""
+    workbook = xlwt.Workbook()
+    sheet = workbook.add_sheet('metadata')
+    write_row(sheet, 0, ['calc_url', 'volnum', 'issnum', 'fpage', 'lpage',
+                         'disciplines', 'source_publication',
+                         'source_fulltext_url'])
+    for number in range(1, articles + 1):
+        fulltext = u''
+        if context == 'faculty_scholarship' and number % 3 == 0:
+            fulltext = pdf_url('dlj', number)
+        write_row(sheet, number, [
+            article_url(context, number), number % 60 + 1, number % 4 + 1,
+            number % 300 + 1, number % 300 + 40,
+            u"; ".join(u"Discipline {0}".format(rng.randint(1, 40))
+                       for _ in range(rng.randint(0, 3))),
+            u'Duke Law Journal', fulltext])
+    workbook.save(path)
+
+
+def write_downloads_report(path, articles, months, rng):
+    """Write a monthly downloads report for every article"""
+    workbook = xlwt.Workbook()
+    sheet = workbook.add_sheet('downloads')
+    write_row(sheet, 0, ['Downloads by month'])
+    write_row(sheet, 1, ['URL'] + [datetime.date(2010 + month // 12,
+                                                 month % 12 + 1, 1)
+                                   for month in range(months)])
+    index = 2
+    for context in CONTEXTS:
+        for number in range(1, articles + 1):
+            popularity = rng.randint(0, 100)
+            write_row(sheet, index, [article_url(context, number)] +
+                      [rng.randint(0, popularity) for _ in range(months)])
+            index += 1
+    write_row(sheet, index, [article_url('missing', 1)] + [1] * months)
+    workbook.save(path)
+
+
+def generate(directory, articles, authors, months, emails, seed=1):
+    """Write the synthetic spreadsheets of both contexts to directory"""
+    rng = random.Random(seed)
+    for context in CONTEXTS:
+        write_editor_report(
+            os.path.join(directory, "{0}_editor.xls".format(context)),
+            context, articles, authors, emails, rng)
+        write_metadata_report(
+            os.path.join(directory, "{0}_metadata.xls".format(context)),
+            context, articles, rng)
+    write_downloads_report(os.path.join(directory, 'downloads.xls'),
+                           articles, months, rng)
+
+
+def serve(directory):
+    """Serve directory over HTTP from a thread, returning the server"""
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(directory, os.path.basename(
+                path.split('?')[0]))
+
+        def log_message(self, *args):
+            pass
+
+    server = SocketServer.TCPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def cases(directory, server):
+    """Return the (name, command, database) benchmark cases, in run order
+
+    load_rows loads the reports row by row into a database of its own, so
+    the bulk load that follows starts from empty tables too."""
+    load = [sys.executable, os.path.join(SOURCE, 'load.py'), server] + \
+        CONTEXTS + ['--no-cache']
+    model = [sys.executable, os.path.join(SOURCE, 'repository_metrics',
+                                          'model.py')]
+    result = [('load_rows', load, 'rows'),
+              ('load', load + ['--bulk'], 'benchmark'),
+              ('reload', load + ['--bulk'], 'benchmark'),
+              ('load_downloads',
+               [sys.executable, os.path.join(SOURCE, 'load_downloads.py'),
+                os.path.join(directory, 'downloads.xls'),
+                '--rejects', os.path.join(directory, 'rejected_urls.txt')],
+               'benchmark')]
+    for name in sorted(export.REPORTS):
+        result.append(("export_{0}".format(name),
+                       model + ['--report', name, '-o',
+                                os.path.join(directory, name + '.csv')],
+                       'benchmark'))
+    result.append(('export_faculty_workers',
+                   model + ['--report', 'faculty', '--workers', '2', '-o',
+                            os.path.join(directory, 'faculty_workers.csv')],
+                   'benchmark'))
+    return result
+
+
+def create_database(directory, database):
+    """Write the configuration of a new SQLite database, create its tables
+    and return the environment of the cases run against it"""
+    config = os.path.join(directory, database + '.cfg')
+    with open(config, 'w') as config_file:
+        config_file.write("[sqlalchemy]\ndsn=sqlite:///{0}\necho=False\n".
+                          format(os.path.join(directory, database + '.db')))
+    environment = dict(os.environ, REPOSITORY_METRICS_CONFIG=config)
+    subprocess.check_call([sys.executable,
+                           os.path.join(SOURCE, 'repository_metrics',
+                                        'model.py'), '-c'],
+                          env=environment, stdout=open(os.devnull, 'w'))
+    return environment
+
+
+def run_case(directory, name, command, environment):
+    """Run a case with --profile and return its profile summary"""
+    summary_path = os.path.join(directory, name + '.json')
+    log_path = os.path.join(directory, name + '.log')
+    with open(log_path, 'w') as log:
+        status = subprocess.call(command + ['--profile', '--profile-output',
+                                            summary_path],
+                                 stdout=log, stderr=subprocess.STDOUT,
+                                 env=environment)
+    if status:
+        with open(log_path) as log:
+            sys.stdout.write(log.read()[-2000:])
+        raise RuntimeError("{0} exited with status {1}".format(name, status))
+    with open(summary_path) as summary:
+        return json.load(summary)
+
+
+def run(args):
+    """Generate the data, run every case and return the results"""
+    if args.articles * len(CONTEXTS) + 3 > MAX_ROWS or \
+            args.months + 1 > MAX_COLUMNS or \
+            10 + args.authors * len(AUTHOR_FIELDS) > MAX_COLUMNS:
+        sys.exit("Scale exceeds the xls sheet size")
+    directory = tempfile.mkdtemp(prefix='benchmark-', dir=args.directory)
+    try:
+        print("generating {0} articles x {1} authors x {2} months in {3}".
+              format(args.articles, args.authors, args.months, directory))
+        generate(directory, args.articles, args.authors, args.months,
+                 args.emails or max(1, args.articles // 5), args.seed)
+        server = serve(directory)
+        url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+        results = {}
+        environments = {}
+        try:
+            for (name, command, database) in cases(directory, url):
+                if database not in environments:
+                    environments[database] = create_database(directory,
+                                                             database)
+                summary = run_case(directory, name, command,
+                                   environments[database])
+                results[name] = dict((key, summary[key]) for key in
+                                     ['elapsed', 'peak_rss_kb', 'queries',
+                                      'rows'])
+                print("{0:<28} {1:>8.2f}s {2:>8} KB {3:>8} queries".format(
+                    name, summary['elapsed'], summary['peak_rss_kb'],
+                    summary['queries']))
+        finally:
+            server.shutdown()
+    finally:
+        if args.keep:
+            print("kept {0}".format(directory))
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {'scale': dict((key, getattr(args, key)) for key in SCALE),
+            'results': results}
+
+
+def regressions(baseline, current, threshold=1.5, slack=0.5):
+    """Return messages for the cases slower, bigger or chattier than the
+    baseline by more than threshold
+
+    Elapsed time must also grow by more than slack seconds, so very short
+    cases do not fail on noise."""
+    messages = []
+    for (name, base) in sorted(baseline['results'].items()):
+        result = current['results'].get(name)
+        if result is None:
+            messages.append("{0}: not run".format(name))
+            continue
+        if result['elapsed'] > base['elapsed'] * threshold and \
+                result['elapsed'] > base['elapsed'] + slack:
+            messages.append("{0}: {1:.2f}s, baseline {2:.2f}s".format(
+                name, result['elapsed'], base['elapsed']))
+        if result['peak_rss_kb'] > base['peak_rss_kb'] * threshold:
+            messages.append("{0}: {1} KB, baseline {2} KB".format(
+                name, result['peak_rss_kb'], base['peak_rss_kb']))
+        if result['queries'] > base['queries'] * threshold:
+            messages.append("{0}: {1} queries, baseline {2}".format(
+                name, result['queries'], base['queries']))
+    return messages
+
+
+def main(args):
+    baseline = None
+    if args.check:
+        with open(args.check) as baseline_file:
+            baseline = json.load(baseline_file)
+        for (key, value) in baseline['scale'].items():
+            setattr(args, key, value)
+    current = run(args)
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(current, baseline_file, indent=2, sort_keys=True)
+        print("saved baseline to {0}".format(args.save))
+    if baseline is not None:
+        messages = regressions(baseline, current, args.threshold, args.slack)
+        for message in messages:
+            print("REGRESSION {0}".format(message))
+        if messages:
+            return 1
+        print("no regressions against {0}".format(args.check))
+    return 0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the loaders " +
+                                     "and exports on synthetic data")
+    parser.add_argument('--articles', help="Articles per context",
+                        type=int, default=1000)
+    parser.add_argument('--authors', help="Most authors per article",
+                        type=int, default=3)
+    parser.add_argument('--months', help="Months of downloads", type=int,
+                        default=24)
+    parser.add_argument('--emails', help="Distinct author emails, by " +
+                        "default a fifth of the articles", type=int)
+    parser.add_argument('--seed', help="Random seed", type=int, default=1)
+    parser.add_argument('--directory', help="Parent of the temporary " +
+                        "working directory")
+    parser.add_argument('--keep', help="Keep the generated files and " +
+                        "database", action="store_true")
+    parser.add_argument('--save', help="Write the results as a baseline " +
+                        "to this file")
+    parser.add_argument('--check', help="Compare with a baseline file, " +
+                        "at its scale, and exit 1 on a regression")
+    parser.add_argument('--threshold', help="Allowed ratio to the " +
+                        "baseline", type=float, default=1.5)
+    parser.add_argument('--slack', help="Seconds a case may always slow " +
+                        "down by", type=float, default=0.5)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    sys.exit(main(args))
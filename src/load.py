@@ -1,52 +1,25 @@
 """Loader script for metadata and downloads"""
 import argparse
+import hashlib
 import re
 import requests
+import time
 import urlparse
-import xlrd
 import repository_metrics
+from datetime import date
+from repository_metrics import profiling, rollups, search
+from repository_metrics.authors import AuthorIndex
+from repository_metrics.fetch import fetch_reports, report_url
+from repository_metrics.report_cache import ReportCache, DEFAULT_DIRECTORY
+from repository_metrics.spreadsheet import read_excel, SpreadsheetError
 from repository_metrics.model import (Article, Creator, Subject,
-                                      Discipline)
+                                      Discipline, article_context,
+                                      format_byline, get_report_loads,
+                                      record_report_loads)
+from sqlalchemy import and_, bindparam
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 
-def excel_row_count(file_contents):
-    """Count rows in the excel file"""
-    workbook = xlrd.open_workbook(file_contents=file_contents)
-    sheet = workbook.sheet_by_index(0)
-    return sheet.nrows
-
-
-def read_excel(file_contents):
-    try:
-        workbook = xlrd.open_workbook(file_contents=file_contents)
-    except:
-        workbook = None
-    #print workbook
-    if workbook:
-        sheet = workbook.sheet_by_index(0)
-        labels = sheet.row(0)
-        for row_index in range(1, sheet.nrows):
-            row = sheet.row(row_index)
-            record = {}
-            for (i, label) in enumerate(labels):
-                # force floats DATE and NUMBER into a string
-                if row[i].ctype in [2]:
-                    value = u"%d" % row[i].value
-                elif row[i].ctype in [3]:
-                    value = xlrd.xldate_as_tuple(row[i].value,
-                                                 workbook.datemode)
-                elif row[i].ctype in [4]:
-                    if row[i].value:
-                        value = True
-                    else:
-                        value = False
-                else:
-                    value = row[i].value
-                record[label.value] = value
-            yield record
-
-
 def get_spreadsheet(url):
     """Get the spreadsheet object from an URL"""
     request = requests.get(url)
@@ -54,13 +27,16 @@ def get_spreadsheet(url):
     return file_contents
 
 
-def get_metadata_report(server, context):
+def get_metadata_report(server, context, file_contents=None):
     """Pull the metadata report and make a datastructure for querying"""
     metadata = {}
-    metadata_filename = "{0}_metadata.xls".format(context)
-    metadata_report_url = urlparse.urljoin(server, metadata_filename)
-    print("opening: {0}".format(metadata_report_url))
-    for row in read_excel(get_spreadsheet(metadata_report_url)):
+    if file_contents is None:
+        metadata_filename = "{0}_metadata.xls".format(context)
+        metadata_report_url = urlparse.urljoin(server, metadata_filename)
+        print("opening: {0}".format(metadata_report_url))
+        file_contents = get_spreadsheet(metadata_report_url)
+    for row in profiling.timed(read_excel(file_contents, on_demand=True),
+                               'parse'):
         # not everything has a calc_url
         if row['calc_url']:
             metadata[row['calc_url']] = row
@@ -91,153 +67,519 @@ def journal_context(context):
     return mapping.get(context)
 
 
-def process_context(server, context, session):
-    """Process files for each context"""
+# recorded with the loaded report hashes; bump it when normalize or the
+# written columns change, so unchanged reports are loaded again
+LOADER_VERSION = 2
+
+CHILD_COLUMNS = {'creators': ['first', 'middle', 'last', 'suffix',
+                              'institution', 'email', 'author_id'],
+                 'subjects': ['term'],
+                 'disciplines': ['term']}
+
+CHILD_TABLES = [('creators', Creator.__table__),
+                ('subjects', Subject.__table__),
+                ('disciplines', Discipline.__table__)]
+
+
+def as_date(value):
+    """Coerce a spreadsheet date value into a date or None"""
+    if isinstance(value, tuple):
+        if not any(value[:3]):
+            return None
+        return date(*value[:3])
+    if value == u'':
+        return None
+    return value
+
+
+def split_terms(value, pattern):
+    """Split a delimited cell into terms, dropping an empty term"""
+    terms = re.split(pattern, value)
+    try:
+        terms.remove('')
+    except:
+        pass
+    return terms
+
+
+def article_identity(context, row):
+    """Return the article values that are only set on creation"""
+    return {'oai_identifier': u"oai:scholarship.law.duke.edu:{0}-{1}".
+            format(context, row['Manuscript#']),
+            'pdf_url': u'http://scholarship.law.duke.edu/cgi/viewcontent.' +
+            'cgi?article={0}&context={1}'.format(row['Manuscript#'], context),
+            'title': row['Title'].strip(),
+            'article_url': row['URL']}
+
+
+def article_values(context, row, metadata_row):
+    """Return the article values refreshed on every load"""
+    values = {}
+    values['submission_date'] = as_date(row['Submission date'])
+    if 'Date posted' in row:
+        values['date'] = as_date(row['Date posted'])
+    elif 'Date published' in row:
+        values['date'] = as_date(row['Date published'])
+
+    if 'Submission type' not in row:
+        values['document_type'] = u'Other'
+    else:
+        values['document_type'] = row['Submission type']
+
+    values['last_event'] = row['Last event']
+    values['last_event_date'] = as_date(row['Date of last event'])
+    values['status'] = row['Status']
+
+    if 'Volume' in row:
+        values['volume'] = row['Volume']
+    elif 'volnum' in metadata_row:
+        values['volume'] = metadata_row['volnum']
+
+    if 'Issue' in row:
+        values['issue'] = row['Issue']
+    elif 'issnum' in metadata_row:
+        values['issue'] = metadata_row['issnum']
+
+    if 'fpage' in metadata_row:
+        values['fpage'] = metadata_row['fpage']
+
+    if 'lpage' in metadata_row:
+        values['lpage'] = metadata_row['lpage']
+    if context == 'faculty_scholarship' and metadata_row:
+        source_publication = metadata_row['source_publication']
+        if source_publication:
+            values['publication'] = source_publication.strip()
+        else:
+            values['publication'] = None
+        # add reference to journal version
+        source_fulltext_url = metadata_row['source_fulltext_url']
+        if source_fulltext_url:
+            values['source_fulltext_url'] = source_fulltext_url.strip()
+        else:
+            values['source_fulltext_url'] = None
+    else:
+        values['publication'] = journal_context(context)
+    return values
+
+
+def row_creators(row):
+    """Return creator values in position order"""
+    # Author 1 Institution	Author 1 Email
+    i = 1
+    creator_key = 'Author {0}'.format(i)
+    creators = []
+    while "{0} First Name".format(creator_key) in row:
+        elementnames = ['First Name', 'Middle Name', 'Last Name',
+                        'Suffix', 'Institution', 'Email']
+        creator = {}
+        for elementname in elementnames:
+            elementkey = "{0} {1}".format(creator_key, elementname)
+            attname = elementname.lower().replace(' name', '')
+            creator[attname] = row[elementkey]
+        if creator['first'] or creator['last']:
+            if not creator['email']:
+                creator['email'] = None
+            creator['position'] = len(creators) + 1
+            creators.append(creator)
+        i += 1
+        creator_key = 'Author {0}'.format(i)
+    return creators
+
+
+def row_subjects(row):
+    """Return keyword terms in position order"""
+    return split_terms(row['Keywords'], ',\s*')
+
+
+def row_disciplines(metadata_row):
+    """Return discipline terms, or None when there is no metadata"""
+    if not metadata_row:
+        return None
+    return split_terms(metadata_row['disciplines'], ';\s*')
+
+
+def decode_values(values):
+    """Decode the byte string values of a dict to unicode, in place"""
+    for (key, value) in values.items():
+        if isinstance(value, str):
+            values[key] = value.decode('utf-8')
+    return values
+
+
+def normalize(context, row, metadata_row):
+    """Return the normalized values an article is built from
+
+    The result holds the creation only identity, the column values, the
+    position ordered child rows and a fingerprint of the values and
+    children stored as the article source_hash.  The identity is left
+    out of it since an update does not write it.  Text values are decoded
+    to unicode."""
+    record = {'identity': article_identity(context, row),
+              'values': article_values(context, row, metadata_row),
+              'creators': row_creators(row),
+              'subjects': [{'position': j + 1, 'term': term}
+                           for j, term in enumerate(row_subjects(row))],
+              'disciplines': None}
+    terms = row_disciplines(metadata_row)
+    if terms is not None:
+        record['disciplines'] = [{'position': j + 1, 'term': term}
+                                 for j, term in enumerate(terms)]
+    values = record['values']
+    values['byline'] = format_byline([(creator['first'], creator['middle'],
+                                       creator['last'], creator['suffix'])
+                                      for creator in record['creators']])
+    values['context'] = article_context(
+        record['identity']['oai_identifier'])
+    values['has_faculty'] = any(creator['email']
+                                for creator in record['creators'])
+    decode_values(record['identity'])
+    decode_values(values)
+    for (name, table) in CHILD_TABLES:
+        for child in record[name] or []:
+            decode_values(child)
+    source = [sorted(record['values'].items())]
+    for (name, table) in CHILD_TABLES:
+        if record[name] is None:
+            source.append(None)
+        else:
+            source.append([sorted(child.items()) for child in record[name]])
+    record['values']['source_hash'] = \
+        unicode(hashlib.sha1(repr(source)).hexdigest())
+    return record
+
+
+def diff_children(current, rows, columns):
+    """Return the changed child rows and the surplus stored positions
+
+    current maps position to the stored child; rows are the new position
+    ordered child values."""
+    changed = []
+    for row in rows:
+        child = current.get(row['position'])
+        if child is None or any(getattr(child, column) != row[column]
+                                for column in columns):
+            changed.append(row)
+    surplus = [position for position in current if position > len(rows)]
+    return (changed, surplus)
+
+
+def sync_collection(article, name, child_class, rows):
+    """Apply position level inserts, updates and deletes to a collection"""
+    collection = getattr(article, name)
+    current = dict((child.position, child) for child in collection)
+    (changed, surplus) = diff_children(current, rows, CHILD_COLUMNS[name])
+    for row in changed:
+        child = current.get(row['position'])
+        if child is None:
+            collection.append(child_class(**row))
+        else:
+            for column in CHILD_COLUMNS[name]:
+                setattr(child, column, row[column])
+    for position in surplus:
+        collection.remove(current[position])
+
+
+def print_summary(context, counts, start):
+    """Print article counts and throughput for a context"""
+    rows = sum(counts.values())
+    elapsed = time.time() - start
+    print("{0}: {1} rows in {2:.1f}s ({3:.0f} rows/sec), {4} inserted, "
+          "{5} updated, {6} unchanged".
+          format(context, rows, elapsed, rows / max(elapsed, 0.001),
+                 counts['inserted'], counts['updated'],
+                 counts['unchanged']))
+
+
+def refresh_rollups(session, previous):
+    """Refresh the rollups of updated articles
+
+    previous maps an updated article id to its creator author ids and
+    context before the update, whose rollup rows may have lost its
+    downloads."""
+    if not previous:
+        return
+    rollups.refresh(session, previous.keys(),
+                    [author_id for (author_ids, context) in previous.values()
+                     for author_id in author_ids if author_id is not None],
+                    [context for (author_ids, context) in previous.values()
+                     if context])
+
+
+def get_editor_report(server, context, reports=None):
+    """Return the editor report contents, fetching it when not supplied"""
+    if reports:
+        return reports['editor']
     editor_filename = "{0}_editor.xls".format(context)
     editor_report_url = urlparse.urljoin(server, editor_filename)
-    metadata = get_metadata_report(server, context)
     print("opening: {0}".format(editor_report_url))
-    for row in read_excel(get_spreadsheet(editor_report_url)):
+    return get_spreadsheet(editor_report_url)
+
+
+def process_context(server, context, session, reports=None, authors=None):
+    """Process files for each context
+
+    reports optionally holds the already fetched 'editor' and 'metadata'
+    file contents and authors the AuthorIndex creators are linked with.
+    Returns the inserted, updated and unchanged counts."""
+    if authors is None:
+        authors = AuthorIndex.load(session)
+    start = time.time()
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    written = []
+    previous = {}
+    metadata = get_metadata_report(server, context,
+                                   reports and reports['metadata'])
+    for row in profiling.timed(read_excel(get_editor_report(server, context,
+                                                            reports),
+                                          on_demand=True), 'parse'):
+        profiling.add_rows()
         # update/create use oai_identifier
-        oai_identifier = u"oai:scholarship.law.duke.edu:{0}-{1}".\
-            format(context, row['Manuscript#'])
-        pdf_url = u'http://scholarship.law.duke.edu/cgi/viewcontent.cgi?' +\
-            'article={0}&context={1}'.format(row['Manuscript#'], context)
+        with profiling.phase('parse'):
+            record = normalize(context, row, metadata.get(row['URL'], {}))
         article = None
-        article_url = row['URL']
-        title = row['Title'].strip()
-        if article_url in metadata:
-            row['metadata'] = metadata[article_url]  # stuff into row
-        else:
-            row['metadata'] = {}
         try:
-            article = session.query(Article).\
-                filter(Article.oai_identifier == oai_identifier).one()
+            with profiling.phase('hydrate'):
+                article = session.query(Article).\
+                    filter(Article.oai_identifier ==
+                           record['identity']['oai_identifier']).one()
         except NoResultFound, e:
-            article = Article(title=title, article_url=row['URL'],
-                              oai_identifier=oai_identifier, pdf_url=pdf_url)
+            article = Article(**record['identity'])
+            counts['inserted'] += 1
         except MultipleResultsFound, e:
             print e
+            continue
+        if article.id is not None:
+            if article.source_hash == record['values']['source_hash']:
+                counts['unchanged'] += 1
+                continue
+            counts['updated'] += 1
+            previous[article.id] = ([creator.author_id
+                                     for creator in article.creators],
+                                    article.context)
 
-        # article.submission_date
-        article.submission_date = row['Submission date']
-        # article.date
-        if 'Date posted' in row:
-            article.date = row['Date posted']
-        elif 'Date published' in row:
-            article.date = row['Date published']
+        for key, value in record['values'].items():
+            setattr(article, key, value)
+        with profiling.phase('write'):
+            authors.resolve(session, record['creators'])
+        sync_collection(article, 'creators', Creator, record['creators'])
+        sync_collection(article, 'subjects', Subject, record['subjects'])
+        if record['disciplines'] is not None:
+            sync_collection(article, 'disciplines', Discipline,
+                            record['disciplines'])
+        with profiling.phase('write'):
+            session.add(article)
+            session.commit()
+        written.append(article.id)
+    with profiling.phase('write'):
+        search.index_articles(session, written)
+    session.commit()
+    with profiling.phase('write'):
+        refresh_rollups(session, previous)
+    print_summary(context, counts, start)
+    return counts
 
-        if 'Submission type' not in row:
-            article.document_type = u'Other'
-        else:
-            article.document_type = row['Submission type']
 
-        article.last_event = row['Last event']
-        article.last_event_date = row['Date of last event']
+def write_batch(session, batch, existing, counts, authors, previous=None):
+    """Write the changed articles of a batch of records in one transaction
 
-        # article status
-        article.status = row['Status']
+    existing maps oai_identifier to (id, source_hash) and is updated with
+    the written articles.  Creators are linked through the AuthorIndex
+    authors.  previous, when given, gains the creator author ids and context
+    of the updated articles before the update, see refresh_rollups."""
+    changed = []
+    for record in batch:
+        oai_identifier = record['identity']['oai_identifier']
+        known = existing.get(oai_identifier)
+        values = dict(record['values'], oai_identifier=oai_identifier)
+        if known is None:
+            values.update(record['identity'])
+            counts['inserted'] += 1
+        elif known[1] == values['source_hash']:
+            counts['unchanged'] += 1
+            continue
+        else:
+            counts['updated'] += 1
+        changed.append((record, values, known))
+    if not changed:
+        return
+    authors.resolve(session, [creator for (item, v, k) in changed
+                              for creator in item['creators']])
+    updated_ids = [k[0] for (r, v, k) in changed if k is not None]
+    contexts = {}
+    if updated_ids:
+        contexts = dict(session.query(Article.id, Article.context).
+                        filter(Article.id.in_(updated_ids)))
+    repository_metrics.model.bulk_upsert(
+        session, Article.__table__, [row for (r, row, k) in changed],
+        ['oai_identifier'])
+    missing = [row['oai_identifier'] for (r, row, k) in changed
+               if k is None]
+    if missing:
+        for (oai_identifier, article_id) in \
+                session.query(Article.oai_identifier, Article.id).\
+                filter(Article.oai_identifier.in_(missing)):
+            existing[oai_identifier] = (article_id, None)
+    stored = {}
+    for (name, table) in CHILD_TABLES:
+        current = {}
+        if updated_ids:
+            for child in session.execute(
+                    table.select().where(table.c.article_id.in_(updated_ids))):
+                current.setdefault(child.article_id, {})[child.position] = \
+                    child
+        rows = []
+        surplus = []
+        for (record, values, known) in changed:
+            if record[name] is None:
+                continue
+            article_id = existing[values['oai_identifier']][0]
+            (children, extra) = diff_children(current.get(article_id, {}),
+                                              record[name],
+                                              CHILD_COLUMNS[name])
+            rows.extend(dict(child, article_id=article_id)
+                        for child in children)
+            if extra:
+                surplus.append({'target_id': article_id,
+                                'target_count': len(record[name])})
+        repository_metrics.model.bulk_upsert(session, table, rows,
+                                             ['article_id', 'position'])
+        if surplus:
+            session.execute(table.delete().where(and_(
+                table.c.article_id == bindparam('target_id'),
+                table.c.position > bindparam('target_count'))), surplus)
+        stored[name] = current
+    if previous is not None:
+        for article_id in updated_ids:
+            creators = stored['creators'].get(article_id, {})
+            previous[article_id] = ([creator.author_id
+                                     for creator in creators.values()],
+                                    contexts.get(article_id))
+    # titles are only set on creation and disciplines without metadata are
+    # kept, so updated articles index their stored values
+    titles = {}
+    if updated_ids:
+        titles = dict(session.query(Article.id, Article.title).
+                      filter(Article.id.in_(updated_ids)))
+    fields = {}
+    for (record, values, known) in changed:
+        article_id = existing[values['oai_identifier']][0]
+        disciplines = record['disciplines']
+        if disciplines is None:
+            current = stored['disciplines'].get(article_id, {})
+            disciplines = [current[position] for position in sorted(current)]
+        fields[article_id] = search.article_fields(
+            titles.get(article_id, record['identity']['title']),
+            [child['term'] for child in record['subjects']],
+            [child['term'] for child in disciplines])
+    search.delete_postings(session, updated_ids)
+    search.insert_postings(session, fields)
+    session.commit()
+    for (record, values, known) in changed:
+        existing[values['oai_identifier']] = \
+            (existing[values['oai_identifier']][0], values['source_hash'])
 
-        if 'Volume' in row:
-            article.volume = row['Volume']
-        elif 'volnum' in row['metadata']:
-            article.volume = row['metadata']['volnum']
 
-        if 'Issue' in row:
-            article.issue = row['Issue']
-        elif 'issnum' in row['metadata']:
-            article.issue = row['metadata']['issnum']
+def process_context_bulk(server, context, session, batch_size=500,
+                         reports=None, authors=None):
+    """Process files for each context with batched upserts
 
-        if 'fpage' in row['metadata']:
-            article.fpage = row['metadata']['fpage']
-
-        if 'lpage' in row['metadata']:
-            article.lpage = row['metadata']['lpage']
-        if context == 'faculty_scholarship' and row.get('metadata'):
-            source_publication = row['metadata']['source_publication']
-            if source_publication:
-                article.publication = source_publication.strip()
-            else:
-                article.publication = None
-            # add reference to journal version
-            source_fulltext_url = row['metadata']['source_fulltext_url']
-            if source_fulltext_url:
-                article.source_fulltext_url = source_fulltext_url.strip()
-            else:
-                article.source_fulltext_url = None
-        else:
-            article.publication = journal_context(context)
-        # add creators
-        # Author 1 Institution	Author 1 Email
-        i = 1
-        creator_key = 'Author {0}'.format(i)
-        creators = []
-        while "{0} First Name".format(creator_key) in row:
-            elementnames = ['First Name', 'Middle Name', 'Last Name',
-                            'Suffix', 'Institution', 'Email']
-            creator = Creator()
-            for elementname in elementnames:
-                elementkey = "{0} {1}".format(creator_key, elementname)
-                value = row[elementkey]
-                attname = elementname.lower().replace(' name', '')
-                setattr(creator, attname, value)
-            if creator.first or creator.last:
-                if not creator.email:
-                    creator.email = None
-                creators.append(creator)
-            i += 1
-            creator_key = 'Author {0}'.format(i)
-
-        if article.creators:
-            del article.creators
-            session.commit()
-        for j, creator in enumerate(creators):
-            creator.position = j + 1
-            article.creators.append(creator)
-
-        # keywords
-        keywords = re.split(',\s*', row['Keywords'])
-        try:
-            keywords.remove('')
-        except:
-            pass
-        if article.subjects:
-            del article.subjects
-            session.commit()
-        if len(keywords) > 0:
-            for j, keyword in enumerate(keywords):
-                subject = Subject(article_id=article.id, position=j + 1,
-                                  term=keyword)
-                article.subjects.append(subject)
-
-        # disciplines
-        if row['metadata']:
-            if article.disciplines:
-                del article.disciplines
-                session.commit()
-            terms = re.split(';\s*', row['metadata']['disciplines'])
-            try:
-                terms.remove('')
-            except:
-                pass
-            if len(terms) > 0:
-                for j, term in enumerate(terms):
-                    discipline = Discipline(article_id=article.id,
-                                            position=j + 1,
-                                            term=term)
-                    article.disciplines.append(discipline)
-        session.add(article)
-        session.commit()
-        # deal with creators
-    return True
+    Returns the inserted, updated and unchanged counts."""
+    if authors is None:
+        authors = AuthorIndex.load(session)
+    start = time.time()
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    metadata = get_metadata_report(server, context,
+                                   reports and reports['metadata'])
+    prefix = u"oai:scholarship.law.duke.edu:{0}-".format(context)
+    existing = {}
+    previous = {}
+    for (oai_identifier, article_id, source_hash) in \
+            session.query(Article.oai_identifier, Article.id,
+                          Article.source_hash).\
+            filter(Article.oai_identifier.startswith(prefix)):
+        existing[oai_identifier] = (article_id, source_hash)
+    batch = []
+    batch_identifiers = set()
+    for row in profiling.timed(read_excel(get_editor_report(server, context,
+                                                            reports),
+                                          on_demand=True), 'parse'):
+        profiling.add_rows()
+        with profiling.phase('parse'):
+            record = normalize(context, row, metadata.get(row['URL'], {}))
+        oai_identifier = record['identity']['oai_identifier']
+        # a repeated article must see the earlier one as stored
+        if len(batch) >= batch_size or oai_identifier in batch_identifiers:
+            with profiling.phase('write'):
+                write_batch(session, batch, existing, counts, authors,
+                            previous)
+            batch = []
+            batch_identifiers = set()
+        batch.append(record)
+        batch_identifiers.add(oai_identifier)
+    if batch:
+        with profiling.phase('write'):
+            write_batch(session, batch, existing, counts, authors,
+                        previous)
+    with profiling.phase('write'):
+        refresh_rollups(session, previous)
+    print_summary(context, counts, start)
+    return counts
 
 
 def main(args):
     session = repository_metrics.model.get_session()
+    totals = {'inserted': 0, 'updated': 0, 'unchanged': 0}
     server = args.server
     contexts = args.contexts
-    for context in contexts:
-        process_context(server, context, session)
+    cache = None
+    if not args.no_cache:
+        cache = ReportCache(args.cache_dir,
+                            max_bytes=args.cache_size * 1024 * 1024)
+    reports = fetch_reports(server, contexts, workers=args.workers,
+                            timeout=args.timeout, retries=args.retries,
+                            cache=cache)
+    authors = AuthorIndex.load(session)
+    # the loaded hashes are kept by the database, as the cache is shared
+    loaded = None
+    if cache is not None:
+        loaded = get_report_loads(session)
+        if loaded is None:
+            print("report_loads is missing, run model.py --migrate to " +
+                  "skip unchanged reports")
+    for (context, contents) in profiling.timed(reports, 'fetch'):
+        if contents is None:
+            print("skipping: {0}".format(context))
+            continue
+        urls = [report_url(server, context, report) for report in contents]
+        if loaded is not None and \
+                cache.is_loaded(urls, loaded, LOADER_VERSION):
+            print("unchanged: {0}".format(context))
+            continue
+        try:
+            if args.bulk:
+                counts = process_context_bulk(server, context, session,
+                                              batch_size=args.batch_size,
+                                              reports=contents,
+                                              authors=authors)
+            else:
+                counts = process_context(server, context, session,
+                                         reports=contents, authors=authors)
+        except SpreadsheetError as e:
+            session.rollback()
+            # forget the authors inserted by the rolled back transaction
+            authors = AuthorIndex.load(session)
+            print("skipping: {0}: {1}".format(context, e))
+            continue
+        for key in totals:
+            totals[key] += counts[key]
+        if loaded is not None:
+            record_report_loads(session, cache.digests(urls, LOADER_VERSION))
+    if cache is not None:
+        cache.evict()
+    if totals['inserted'] or totals['updated']:
+        repository_metrics.model.bump_dataset_version(session)
+    print("articles: {0} inserted, {1} updated, {2} unchanged".
+          format(totals['inserted'], totals['updated'], totals['unchanged']))
     return 0
 
 
@@ -253,8 +595,39 @@ def parse_arguments():
                         "files to load")
     parser.add_argument('contexts', help="Publication context or series",
                         nargs="*", default=contexts)
+    parser.add_argument('-b', '--bulk', help="Load with batched upserts " +
+                        "instead of one transaction per row",
+                        action="store_true")
+    parser.add_argument('--batch-size', help="Rows per bulk transaction",
+                        type=int, default=500)
+    parser.add_argument('-w', '--workers', help="Concurrent report " +
+                        "downloads", type=int, default=4)
+    parser.add_argument('--timeout', help="Seconds to wait for a report " +
+                        "server response", type=float, default=60)
+    parser.add_argument('--retries', help="Retries for a failed report " +
+                        "download", type=int, default=3)
+    parser.add_argument('--cache-dir', help="Directory caching fetched " +
+                        "reports", default=DEFAULT_DIRECTORY)
+    parser.add_argument('--cache-size', help="Report cache size in MB",
+                        type=int, default=512)
+    parser.add_argument('--no-cache', help="Fetch and load every report " +
+                        "even when unchanged", action="store_true")
+    parser.add_argument('--profile', help="Print phase times, rows/sec, " +
+                        "peak memory and query count as JSON",
+                        action="store_true")
+    parser.add_argument('--profile-output', help="Write the --profile " +
+                        "JSON to this file", default="-")
+    parser.add_argument('--pstats', help="Dump a cProfile of the run to " +
+                        "this file")
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_arguments()
-    main(args)
+    if args.profile or args.pstats:
+        profiling.start('load.py', pstats=args.pstats)
+        try:
+            main(args)
+        finally:
+            profiling.finish(args.profile_output)
+    else:
+        main(args)
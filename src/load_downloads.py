@@ -1,58 +1,15 @@
 import argparse
+import os
 import requests
-import xlrd
+import time
 import repository_metrics
 from repository_metrics.model import (Article, Creator, Subject,
                                       Download, Discipline)
+from repository_metrics import daily, profiling, rollups
+from repository_metrics.report_cache import DEFAULT_DIRECTORY
+from repository_metrics.spreadsheet import read_excel
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from datetime import datetime
-
-
-def excel_row_count(file_contents):
-    """Count rows in the excel file"""
-    workbook = xlrd.open_workbook(file_contents=file_contents)
-    sheet = workbook.sheet_by_index(0)
-    return sheet.nrows
-
-
-def read_excel(file_contents, start_row=1, label_row=0, sheet_by_index=0):
-    workbook = xlrd.open_workbook(file_contents=file_contents)
-    #print workbook
-    sheet = workbook.sheet_by_index(sheet_by_index)
-    headers = sheet.row(label_row)
-    labels = []
-    for header in headers:
-        if header.ctype in [2]:
-            value = u"%d" % header.value
-        elif header.ctype in [3]:
-            value = xlrd.xldate_as_tuple(header.value, workbook.datemode)
-        elif header.ctype in [4]:
-            if header.value:
-                value = True
-            else:
-                value = False
-        else:
-            value = header.value
-        labels.append(value)
-
-    for row_index in range(start_row, sheet.nrows):
-        row = sheet.row(row_index)
-        record = {}
-        for (i, label) in enumerate(labels):
-            # force floats DATE and NUMBER into a string
-            if row[i].ctype in [2]:
-                value = u"%d" % row[i].value
-            elif row[i].ctype in [3]:
-                value = xlrd.xldate_as_tuple(row[i].value, workbook.datemode)
-            elif row[i].ctype in [4]:
-                if row[i].value:
-                    value = True
-                else:
-                    value = False
-            else:
-                value = row[i].value
-            record[label] = value
-        yield record
+from datetime import date
 
 
 def get_spreadsheet(url):
@@ -66,52 +23,154 @@ def get_spreadsheet(url):
     return file_contents
 
 
-def process_data(article, session, row):
-    """Insert data"""
-    if article.downloads:
-        del article.downloads
-        session.commit()
+def article_url_map(session):
+    """Map article_url to article id, None when the url is ambiguous"""
+    mapping = {}
+    for (article_url, article_id) in \
+            session.query(Article.article_url, Article.id):
+        if article_url in mapping:
+            mapping[article_url] = None
+        else:
+            mapping[article_url] = article_id
+    return mapping
+
+
+def unpivot(article_id, row):
+    """Yield one download row per month column of a spreadsheet row"""
     for key, value in row.items():
         if isinstance(key, tuple):
-            download_date = datetime(*key)
-            download = Download(article_id=article.id,
-                                download_date=download_date,
-                                download_count=value)
-            article.downloads.append(download)
+            yield {'article_id': article_id,
+                   'download_date': date(*key[:3]),
+                   'download_count': int(value or 0),
+                   'from_days': False}
+
+
+def unpivot_days(article_id, row):
+    """Yield one daily download row per day column with downloads"""
+    for download in unpivot(article_id, row):
+        if download['download_count']:
+            yield {'article_id': article_id,
+                   'day': daily.day_key(download['download_date']),
+                   'download_count': download['download_count']}
+
+
+def process_days(session, batch, download_dates):
+    """Replace the daily downloads of a batch of articles over the days of
+    the report and rewrite their months in one transaction"""
+    article_ids = [article_id for (article_id, row) in batch]
+    first = daily.day_key(min(download_dates))
+    last = daily.day_key(max(download_dates))
+    days = []
+    for (article_id, row) in batch:
+        days.extend(unpivot_days(article_id, row))
+    daily.replace_days(session, article_ids, days, first, last)
+    daily.refresh_months(session, article_ids, first, last)
     session.commit()
-    return article
+    return len(days)
+
+
+def process_data(session, batch, download_dates):
+    """Replace the downloads of a batch of articles in one transaction
+
+    The report's months take its totals.  The other months are deleted,
+    except those summed from daily_downloads, which keep matching it."""
+    table = Download.__table__
+    article_ids = [article_id for (article_id, row) in batch]
+    downloads = []
+    for (article_id, row) in batch:
+        downloads.extend(unpivot(article_id, row))
+    session.execute(table.delete().
+                    where(table.c.article_id.in_(article_ids)).
+                    where(~table.c.download_date.in_(download_dates)).
+                    where(table.c.from_days.isnot(True)))
+    repository_metrics.model.bulk_upsert(session, table, downloads,
+                                         ['article_id', 'download_date'])
+    session.commit()
+    return len(downloads)
 
 
 def main(args):
     session = repository_metrics.model.get_session()
     url = args.url
-    file_contents = get_spreadsheet(url)
+    start = time.time()
+    with profiling.phase('fetch'):
+        file_contents = get_spreadsheet(url)
+    articles = article_url_map(session)
+    directory = os.path.dirname(args.rejects)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    rejects = open(args.rejects, 'w')
+    process = process_days if args.daily else process_data
+    batch = []
+    touched = set()
+    download_dates = None
     i = 0
-    for row in read_excel(file_contents, label_row=1, start_row=2):
+    rejected = 0
+    loaded = 0
+    for row in profiling.timed(read_excel(file_contents, label_row=1,
+                                          start_row=2, on_demand=True),
+                               'parse'):
         i += 1
+        profiling.add_rows()
+        if download_dates is None:
+            download_dates = [date(*key[:3]) for key in row
+                              if isinstance(key, tuple)]
         article_url = row['URL']
-        query = session.query(Article).\
-            filter(Article.article_url == article_url)
-        article = None
-        try:
-            article = query.one()
-        except:
-            print(article_url)
-            print("No article")
-        if article:
-            article = process_data(article, session, row)
-        if i % 100 == 0:
+        article_id = articles.get(article_url)
+        if article_id is None:
+            rejected += 1
+            rejects.write(u"{0}\n".format(article_url).encode('utf-8'))
+            continue
+        batch.append((article_id, row))
+        touched.add(article_id)
+        if len(batch) >= args.batch_size:
+            with profiling.phase('write'):
+                loaded += process(session, batch, download_dates)
+            batch = []
             print("processing row: {0}".format(i))
-            print(article_url)
-            print(article)
+    if batch:
+        with profiling.phase('write'):
+            loaded += process(session, batch, download_dates)
+    rejects.close()
+    with profiling.phase('rollups'):
+        rollups.refresh(session, touched)
+    repository_metrics.model.bump_dataset_version(session)
+    elapsed = time.time() - start
+    print("{0} rows, {1} downloads in {2:.1f}s ({3:.0f} rows/sec)".
+          format(i, loaded, elapsed, i / max(elapsed, 0.001)))
+    print("{0} unmatched urls written to {1}".format(rejected, args.rejects))
+    return 0
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Load XLS files and ' +
                                      'reshape into database schema')
     parser.add_argument('url', help="XLS file of monthly downloads")
+    parser.add_argument('--daily', help="The file has a column per day; " +
+                        "store the days and sum them into the months",
+                        action="store_true")
+    parser.add_argument('-r', '--rejects', help="File for article urls " +
+                        "not found in the database",
+                        default=os.path.join(DEFAULT_DIRECTORY,
+                                             'rejected_urls.txt'))
+    parser.add_argument('--batch-size', help="Articles per transaction",
+                        type=int, default=500)
+    parser.add_argument('--profile', help="Print phase times, rows/sec, " +
+                        "peak memory and query count as JSON",
+                        action="store_true")
+    parser.add_argument('--profile-output', help="Write the --profile " +
+                        "JSON to this file", default="-")
+    parser.add_argument('--pstats', help="Dump a cProfile of the run to " +
+                        "this file")
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_arguments()
-    main(args)
+    if args.profile or args.pstats:
+        profiling.start('load_downloads.py', pstats=args.pstats)
+        try:
+            main(args)
+        finally:
+            profiling.finish(args.profile_output)
+    else:
+        main(args)
@@ -0,0 +1,193 @@
+"""Vectorized download analytics
+
+The downloads are loaded once into an article x month matrix, from the
+database or from a matrix snapshot, and every statistic is computed for all
+articles at once with NumPy: trailing sums, growth over any lag, ranks and
+percentiles within a context.
+
+    python analytics.py --movers 20
+    python analytics.py --matrix download_matrix -o article_trends.csv"""
+import argparse
+import time
+from collections import namedtuple
+import numpy
+import unicodecsv
+import matrix
+import model
+
+
+Series = namedtuple('Series', ['article_ids', 'months', 'counts',
+                               'contexts', 'context_names'])
+
+
+def load_series(session):
+    """Return the Series of every article from the downloads table"""
+    (article_ids, contexts) = matrix.article_index(session)
+    months = matrix.month_range(session)
+    counts = numpy.zeros((len(article_ids), len(months)), dtype=numpy.int32)
+    matrix.read_downloads(session, counts, article_ids, months)
+    (context_codes, context_names) = matrix.codes(contexts)
+    return Series(article_ids, months, counts, context_codes, context_names)
+
+
+def snapshot_series(directory=matrix.DEFAULT_DIRECTORY, session=None):
+    """Return the Series of a matrix snapshot
+
+    Given a session, warns when the database changed since the snapshot."""
+    snapshot = matrix.Snapshot(directory)
+    if session is not None:
+        matrix.warn_if_stale(snapshot, session)
+    return Series(snapshot.article_ids, snapshot.months, snapshot.counts,
+                  snapshot.contexts, snapshot.context_names)
+
+
+def ranks(values):
+    """Return the descending rank of each value within its column
+
+    Ties share the best rank, so the values 9, 7, 7, 3 rank 1, 2, 2, 4."""
+    values = numpy.asarray(values)
+    if values.ndim == 1:
+        return ranks(values[:, numpy.newaxis])[:, 0]
+    result = numpy.empty(values.shape, dtype=numpy.int64)
+    for column in range(values.shape[1]):
+        ordered = numpy.sort(values[:, column])
+        result[:, column] = len(ordered) + 1 - \
+            numpy.searchsorted(ordered, values[:, column], side='right')
+    return result
+
+
+def percentiles(values, groups=None):
+    """Return the percentage of values within the same group that are
+    less than or equal to each value"""
+    values = numpy.asarray(values)
+    if groups is None:
+        groups = numpy.zeros(len(values), dtype=numpy.int32)
+    result = numpy.full(len(values), numpy.nan)
+    for group in numpy.unique(groups):
+        members = groups == group
+        ordered = numpy.sort(values[members])
+        result[members] = 100.0 * numpy.searchsorted(
+            ordered, values[members], side='right') / len(ordered)
+    return result
+
+
+def top_movers(series, n=20, lag=1, window=1, at=-1):
+    """Return (article_id, before, after) of the n largest changes
+
+    Compares the window month totals ending at month at with those lag
+    months earlier, when both windows are within the series."""
+    if not series.counts.shape[1]:
+        return []
+    at = at % series.counts.shape[1]
+    if at < lag + window - 1:
+        return []
+    after = window_total(series.counts, at, window)
+    before = window_total(series.counts, at - lag, window)
+    order = numpy.argsort(-numpy.abs(after - before), kind='mergesort')[:n]
+    return [(int(series.article_ids[row]), int(before[row]),
+             int(after[row])) for row in order]
+
+
+def window_total(counts, at, window=12):
+    """Return the window month totals of every article ending at month at"""
+    return numpy.asarray(counts[:, max(0, at - window + 1):at + 1]).\
+        sum(axis=1, dtype=numpy.int64)
+
+
+def change(before, after):
+    """Return (after - before) / before, NaN where before is zero"""
+    before = numpy.asarray(before, dtype=numpy.float64)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(before > 0, (after - before) / before, numpy.nan)
+
+
+def article_trends(series, window=12, at=-1):
+    """Return a dict of per article statistic arrays at month at
+
+    trailing_growth compares the window month totals with those a year
+    earlier and is NaN unless the earlier window is within the series.
+    Only the months needed are read, so this is cheap on a memory-mapped
+    snapshot."""
+    counts = series.counts
+    at = at % counts.shape[1]
+    trailing = window_total(counts, at, window)
+    nothing = numpy.full(len(trailing), numpy.nan)
+    month_growth = nothing
+    if at >= 1:
+        month_growth = change(counts[:, at - 1], counts[:, at])
+    trailing_growth = nothing
+    if at >= 12 + window - 1:
+        trailing_growth = change(window_total(counts, at - 12, window),
+                                 trailing)
+    return {'article_id': series.article_ids,
+            'downloads': counts[:, at],
+            'total': counts.sum(axis=1, dtype=numpy.int64),
+            'month_growth': month_growth,
+            'trailing': trailing,
+            'trailing_growth': trailing_growth,
+            'rank': ranks(trailing),
+            'context_percentile': percentiles(trailing, series.contexts)}
+
+
+TREND_FIELDS = ['article_id', 'context', 'downloads', 'month_growth',
+                'trailing', 'trailing_growth', 'rank', 'context_percentile',
+                'total']
+
+
+def write_trends(series, output, window=12, at=-1):
+    """Write the article_trends of every article as csv"""
+    trends = article_trends(series, window, at)
+    names = list(series.context_names) + [None]
+    trends['context'] = [names[code] for code in series.contexts]
+    columns = [trends[field] for field in TREND_FIELDS]
+    csvwriter = unicodecsv.writer(open(output, 'wb'))
+    csvwriter.writerow(TREND_FIELDS)
+    for row in zip(*[list(column) for column in columns]):
+        csvwriter.writerow(['' if value != value else value
+                            for value in row])
+    print("wrote trends of {0} articles to {1}".format(
+        len(series.article_ids), output))
+
+
+def main(args):
+    start = time.time()
+    if args.matrix:
+        series = snapshot_series(args.matrix, model.get_session())
+    else:
+        series = load_series(model.get_session())
+    print("loaded {0} articles x {1} months in {2:.2f}s".format(
+        series.counts.shape[0], series.counts.shape[1],
+        time.time() - start))
+    if not len(series.months):
+        print("No downloads")
+        return
+    print("month: {0}".format(series.months[-1]))
+    if args.movers:
+        for (article_id, before, after) in top_movers(series, args.movers,
+                                                      lag=args.lag):
+            print("{0}\t{1}\t{2}".format(article_id, before, after))
+    if args.output:
+        write_trends(series, args.output, window=args.window)
+
+
+def parse_arguments():
+    """Command line options for analytics"""
+    parser = argparse.ArgumentParser(description="Download trends, " +
+                                     "growth and rankings")
+    parser.add_argument("--matrix", help="Read a matrix snapshot " +
+                        "directory instead of the database")
+    parser.add_argument("--movers", help="Print the articles with the " +
+                        "largest change in monthly downloads", type=int,
+                        default=0)
+    parser.add_argument("--lag", help="Months compared by --movers",
+                        type=int, default=1)
+    parser.add_argument("--window", help="Months of the trailing totals",
+                        type=int, default=12)
+    parser.add_argument("-o", "--output", help="Write per article trends " +
+                        "to this csv file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,390 @@
+"""Read-only JSON metrics API"""
+import json
+from datetime import datetime
+from flask import Blueprint, Response, abort, jsonify, request
+from flask import stream_with_context
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
+import authors
+import daily
+import model
+import rollups
+import search
+from response_cache import ResponseCache
+from model import (Article, Author, Creator, Download, ArticleDownloadTotal,
+                   ContextMonthDownloads)
+
+
+api = Blueprint('api', __name__)
+
+# process internals, registered under /admin when [api] admin is set
+admin = Blueprint('admin', __name__)
+
+STREAM_BATCH_SIZE = 1000
+MAX_TOP = 1000
+MAX_PER_PAGE = 1000
+MAX_QUERY_LENGTH = 200
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# keyset sort columns of the paged article listing
+PAGE_SORTS = {'id': Article.id, 'title': Article.title}
+
+
+def get_session():
+    """Return the scoped session shared by the requests of this process"""
+    return model.get_session()
+
+
+def dataset_version():
+    """Return the dataset version stamp bumped by the loaders"""
+    return model.get_dataset_version(get_session())
+
+
+cache = ResponseCache(dataset_version)
+
+
+@api.before_app_first_request
+def limit_statements():
+    """Limit the SELECTs of the engines serving API requests"""
+    model.limit_statements(statement_timeout())
+
+
+@api.teardown_app_request
+def remove_session(exception=None):
+    """Return the request's connection to the pool"""
+    get_session().remove()
+
+
+def isodate(value):
+    """Return a date as an ISO string, or None"""
+    if value is None:
+        return None
+    return value.isoformat()
+
+
+def series(rows):
+    """Return a monthly series from (download_date, download_count) rows"""
+    return [{'month': download_date.strftime('%Y-%m'),
+             'count': download_count}
+            for (download_date, download_count) in rows]
+
+
+def top_limit():
+    """Return the n request argument bounded to MAX_TOP"""
+    n = request.args.get('n', 10, type=int)
+    return max(1, min(n, MAX_TOP))
+
+
+def article_listing(row):
+    """Return the listing fields of an articles x totals row"""
+    return {'id': row.id,
+            'title': row.title.strip() if row.title else row.title,
+            'byline': row.byline,
+            'context': row.context,
+            'publication': row.publication,
+            'date': isodate(row.date),
+            'downloads': row.downloads or 0}
+
+
+def listing_select():
+    """Return the select of article listing rows with download totals"""
+    return select([Article.id, Article.title, Article.byline,
+                   Article.context, Article.publication, Article.date,
+                   ArticleDownloadTotal.download_count.label('downloads')]).\
+        select_from(Article.__table__.outerjoin(
+            ArticleDownloadTotal.__table__,
+            ArticleDownloadTotal.article_id == Article.id))
+
+
+@api.route('/articles/<int:article_id>')
+@cache.cached
+def article_detail(article_id):
+    """Article metadata with its monthly download series"""
+    session = get_session()
+    article = session.query(Article).\
+        options(selectinload(Article.creators),
+                selectinload(Article.subjects),
+                selectinload(Article.disciplines)).\
+        get(article_id)
+    if article is None:
+        abort(404)
+    downloads = session.query(Download.download_date,
+                              Download.download_count).\
+        filter(Download.article_id == article_id).\
+        order_by(Download.download_date).all()
+    creators = sorted(article.creators, key=lambda creator: creator.position)
+    return jsonify({
+        'id': article.id,
+        'title': article.title.strip() if article.title else article.title,
+        'byline': article.byline,
+        'context': article.context,
+        'publication': article.publication,
+        'date': isodate(article.date),
+        'deposit_date': isodate(article.submission_date),
+        'document_type': article.document_type,
+        'article_url': article.article_url,
+        'has_faculty': article.has_faculty,
+        'creators': [{'name': creator.name, 'email': creator.email,
+                      'institution': creator.institution}
+                     for creator in creators],
+        'subjects': [subject.term for subject in
+                     sorted(article.subjects, key=lambda s: s.position)],
+        'disciplines': [discipline.term for discipline in
+                        sorted(article.disciplines,
+                               key=lambda d: d.position)],
+        'downloads': sum(count for (month, count) in downloads),
+        'series': series(downloads),
+        'years': [{'year': year, 'count': count} for (year, count) in
+                  rollups.article_years(session, article_id)]})
+
+
+def date_argument(name):
+    """Return a YYYY-MM-DD request argument as a date, or None"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+
+@api.route('/articles/<int:article_id>/days')
+@cache.cached
+def article_days(article_id):
+    """Daily downloads of an article between the start and end dates"""
+    session = get_session()
+    if session.query(Article.id).filter(Article.id == article_id).\
+            scalar() is None:
+        abort(404)
+    days = daily.article_days(session, article_id, date_argument('start'),
+                              date_argument('end'))
+    return jsonify({'id': article_id,
+                    'downloads': sum(count for (day, count) in days),
+                    'days': [{'date': day.isoformat(), 'count': count}
+                             for (day, count) in days]})
+
+
+@cache.cached
+def article_page(context):
+    """Return one keyset page of the article listing"""
+    session = get_session()
+    sort = request.args.get('sort', 'id')
+    if sort not in PAGE_SORTS:
+        abort(400)
+    per_page = max(1, min(request.args.get('per_page', 50, type=int),
+                          MAX_PER_PAGE))
+    query = listing_select()
+    if context:
+        query = query.where(Article.context == context)
+    if sort == 'title':
+        query = query.where(Article.title != None)
+    if context or sort != 'id':
+        total = model.cached_count(session, query,
+                                   "articles:{0}:{1}".format(context, sort))
+    else:
+        total = model.approximate_count(session, Article.__table__)
+    try:
+        page = model.KeysetPagination(query, PAGE_SORTS[sort], Article.id,
+                                      per_page,
+                                      cursor=request.args.get('cursor'),
+                                      total_count=total, session=session)
+    except ValueError:
+        abort(400)
+    return jsonify({'articles': [article_listing(row) for row in page.items],
+                    'page': page.page,
+                    'pages': page.pages,
+                    'total': total,
+                    'next': page.next_cursor,
+                    'prev': page.prev_cursor})
+
+
+@api.route('/articles')
+def article_list():
+    """Stream every article, optionally of one context, with totals
+
+    With a per_page or cursor argument one cached page is returned
+    instead; the stream itself is never cached."""
+    context = request.args.get('context')
+    if 'per_page' in request.args or 'cursor' in request.args:
+        return article_page(context)
+
+    def generate():
+        session = get_session()
+        yield '{"articles": ['
+        last_id = 0
+        first = True
+        while True:
+            query = listing_select().where(Article.id > last_id)
+            if context:
+                query = query.where(Article.context == context)
+            rows = session.execute(query.order_by(Article.id).
+                                   limit(STREAM_BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                if not first:
+                    yield ','
+                first = False
+                yield json.dumps(article_listing(row))
+            last_id = rows[-1].id
+        yield ']}'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+@api.route('/search')
+@cache.cached
+def article_search():
+    """Articles ranked by a query over titles, keywords and disciplines"""
+    query = request.args.get('q', u'').strip()
+    if not query or len(query) > MAX_QUERY_LENGTH:
+        abort(400)
+    session = get_session()
+    matches = search.search(session, query, limit=top_limit())
+    rows = {}
+    if matches:
+        rows = dict((row.id, row) for row in session.execute(
+            listing_select().where(Article.id.in_(
+                [article_id for (article_id, score, downloads)
+                 in matches]))))
+    results = []
+    for (article_id, score, downloads) in matches:
+        # postings may outlive an article deleted since the last rebuild
+        if article_id not in rows:
+            continue
+        listing = article_listing(rows[article_id])
+        listing['score'] = score
+        results.append(listing)
+    return jsonify({'query': query, 'results': results})
+
+
+@api.route('/authors/<email>')
+@cache.cached
+def author_summary(email):
+    """Monthly downloads and articles of the author of an email"""
+    session = get_session()
+    author_id = session.query(Author.id).\
+        filter(Author.email == authors.email_key(email)).scalar()
+    if author_id is None:
+        abort(404)
+    summary = author_downloads(session, author_id)
+    summary['email'] = email
+    return jsonify(summary)
+
+
+@api.route('/authors/<int:author_id>')
+@cache.cached
+def author_detail(author_id):
+    """Monthly downloads and articles of an author, with or without email"""
+    session = get_session()
+    author = session.query(Author).get(author_id)
+    if author is None:
+        abort(404)
+    summary = author_downloads(session, author_id)
+    summary.update({'id': author.id,
+                    'name': author.name,
+                    'email': author.email})
+    return jsonify(summary)
+
+
+def author_downloads(session, author_id):
+    """Return the downloads, monthly series and articles of an author"""
+    months = rollups.author_months(session, author_id)
+    articles = session.execute(
+        listing_select().
+        where(Article.id.in_(select([Creator.article_id]).
+                             where(Creator.author_id == author_id))).
+        order_by(Article.id)).fetchall()
+    return {'downloads': sum(count for (month, count) in months),
+            'series': series(months),
+            'articles': [article_listing(row) for row in articles]}
+
+
+@api.route('/contexts')
+@cache.cached
+def context_list():
+    """Download totals per context"""
+    return jsonify({'contexts': [{'context': context,
+                                  'downloads': int(count)}
+                                 for (context, count) in
+                                 rollups.context_summary(get_session())]})
+
+
+@api.route('/contexts/<context>')
+@cache.cached
+def context_detail(context):
+    """Monthly downloads and article count of a context"""
+    session = get_session()
+    months = session.query(ContextMonthDownloads.download_date,
+                           ContextMonthDownloads.download_count).\
+        filter(ContextMonthDownloads.context == context).\
+        order_by(ContextMonthDownloads.download_date).all()
+    articles = session.query(func.count(Article.id)).\
+        filter(Article.context == context).scalar()
+    if not articles:
+        abort(404)
+    return jsonify({'context': context,
+                    'articles': articles,
+                    'downloads': sum(count for (month, count) in months),
+                    'series': series(months)})
+
+
+@api.route('/top/articles')
+@cache.cached
+def top_articles():
+    """Most downloaded articles, optionally of one context"""
+    query = listing_select()
+    context = request.args.get('context')
+    if context:
+        query = query.where(Article.context == context)
+    query = query.where(ArticleDownloadTotal.download_count != None).\
+        order_by(ArticleDownloadTotal.download_count.desc()).\
+        limit(top_limit())
+    return jsonify({'articles': [article_listing(row) for row in
+                                 get_session().execute(query)]})
+
+
+@api.route('/top/authors')
+@cache.cached
+def top_authors():
+    """Most downloaded authors, with or without email"""
+    return jsonify({'authors': [{'id': author_id, 'name': name,
+                                 'email': email, 'downloads': int(count)}
+                                for (author_id, name, email, count) in
+                                rollups.author_leaderboard(
+                                    get_session(), limit=top_limit())]})
+
+
+def admin_enabled():
+    """Return whether the configuration enables the admin routes"""
+    config_file = model.read_config()
+    return config_file.has_option('api', 'admin') and \
+        config_file.getboolean('api', 'admin')
+
+
+def statement_timeout():
+    """Return the configured API statement timeout in ms, or None"""
+    config_file = model.read_config()
+    if config_file.has_option('api', 'statement_timeout'):
+        return config_file.getint('api', 'statement_timeout')
+    return None
+
+
+@admin.before_request
+def local_only():
+    """Refuse the admin routes to clients of other hosts"""
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(403)
+
+
+@admin.route('/cache')
+def cache_stats():
+    """Response cache hit and miss counters"""
+    return jsonify(cache.stats())
+
+
+@admin.route('/pool')
+def pool_stats():
+    """Connection pool status, checkout and wait counters"""
+    return jsonify({'engines': model.pool_metrics()})
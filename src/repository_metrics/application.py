@@ -1,5 +1,9 @@
 from flask import Flask
+from api import api, admin, admin_enabled
 app = Flask(__name__)
+app.register_blueprint(api, url_prefix='/api')
+if admin_enabled():
+    app.register_blueprint(admin, url_prefix='/admin')
 
 @app.route('/')
 def hello_world():
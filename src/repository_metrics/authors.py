@@ -0,0 +1,167 @@
+"""Author identities
+
+Creators are repeated for every article.  authors holds one row per
+distinct author and creators.author_id links each creator to it, so author
+queries join on an indexed integer instead of comparing names or emails.
+
+An author is identified by email when the creator has one, otherwise by
+its name key: the HumanName last and first names transliterated with
+unidecode, lower cased and stripped of punctuation.  A creator without an
+email joins the author without email of the same name key, or else the
+only author with that name key.
+
+AuthorIndex keeps the authors in memory so that the loaders resolve a
+batch of creators with a single insert of the new authors, and link
+resolves every creator in the database in one pass."""
+import re
+from nameparser import HumanName
+from sqlalchemy import select, func, bindparam
+from unidecode import unidecode
+from model import Author, Creator, format_name
+from rollups import chunks
+
+
+NON_WORD_RE = re.compile(r'[^a-z0-9]+')
+NAME_KEY_LENGTH = 191
+
+
+def normalize_word(value):
+    """Return a name part as lower case ascii letters and digits"""
+    if not value:
+        return u""
+    return unicode(NON_WORD_RE.sub('', unidecode(value).lower()))
+
+
+def name_key(first, middle, last, suffix):
+    """Return the normalized "last first" key of creator name parts"""
+    name = HumanName(u" ".join(part for part in (first, middle, last, suffix)
+                               if part))
+    words = [normalize_word(name.last), normalize_word(name.first)]
+    return u" ".join(word for word in words if word)[:NAME_KEY_LENGTH]
+
+
+def email_key(email):
+    """Return a normalized email address, or None"""
+    if not email or not email.strip():
+        return None
+    return email.strip().lower()
+
+
+class AuthorIndex(object):
+    """Author ids by email and by name key"""
+    def __init__(self):
+        self.by_email = {}
+        self.by_name = {}
+        self.without_email = {}
+        self.keys = {}
+
+    @classmethod
+    def load(cls, session):
+        """Return the index of every stored author"""
+        index = cls()
+        for (author_id, key, email) in session.query(Author.id,
+                                                     Author.name_key,
+                                                     Author.email):
+            index.add(author_id, key, email)
+        return index
+
+    def add(self, author_id, key, email):
+        """Index an author"""
+        if email is None:
+            self.without_email[key] = author_id
+        else:
+            self.by_email[email] = author_id
+        self.by_name.setdefault(key, set()).add(author_id)
+
+    def key(self, creator):
+        """Return the name key of a creator dict, parsing each name once"""
+        parts = (creator['first'], creator['middle'], creator['last'],
+                 creator['suffix'])
+        key = self.keys.get(parts)
+        if key is None:
+            key = self.keys[parts] = name_key(*parts)
+        return key
+
+    def find(self, key, email):
+        """Return the id of the author of a name key and email, or None"""
+        if email is not None:
+            return self.by_email.get(email)
+        author_id = self.without_email.get(key)
+        if author_id is None:
+            ids = self.by_name.get(key, ())
+            if len(ids) == 1:
+                author_id = next(iter(ids))
+        return author_id
+
+    def resolve(self, session, creators):
+        """Set the author_id of creator dicts, inserting the new authors"""
+        pending = []
+        new = {}
+        for creator in creators:
+            key = self.key(creator)
+            email = email_key(creator['email'])
+            creator['author_id'] = self.find(key, email)
+            if creator['author_id'] is None:
+                identity = (key, email)
+                if email is not None:
+                    identity = (None, email)
+                new.setdefault(identity, {
+                    'name_key': key, 'email': email,
+                    'name': format_name(creator['last'],
+                                        creator['first'])[:255]})
+                pending.append(creator)
+        if not new:
+            return 0
+        session.execute(Author.__table__.insert(), new.values())
+        query = session.query(Author.id, Author.name_key, Author.email)
+        emails = [address for (name_key, address) in new
+                  if address is not None]
+        for chunk in chunks(emails):
+            for (author_id, key, email) in \
+                    query.filter(Author.email.in_(chunk)):
+                self.add(author_id, key, email)
+        keys = [name_key for (name_key, address) in new
+                if address is None]
+        for chunk in chunks(keys):
+            for (author_id, key, email) in \
+                    query.filter(Author.email == None).\
+                    filter(Author.name_key.in_(chunk)):
+                self.add(author_id, key, email)
+        for creator in pending:
+            creator['author_id'] = self.find(self.key(creator),
+                                             email_key(creator['email']))
+        return len(new)
+
+
+def link(session):
+    """Link every creator to its author and delete the unlinked authors
+
+    Returns the number of creators whose author changed."""
+    index = AuthorIndex.load(session)
+    table = Creator.__table__
+    creators = [dict(row, linked=row.author_id) for row in session.execute(
+        select([table.c.article_id, table.c.position, table.c.first,
+                table.c.middle, table.c.last, table.c.suffix,
+                table.c.email, table.c.author_id]))]
+    added = index.resolve(session, creators)
+    changed = [{'target_id': creator['article_id'],
+                'target_position': creator['position'],
+                'target_author': creator['author_id']}
+               for creator in creators
+               if creator['author_id'] != creator['linked']]
+    if changed:
+        session.execute(table.update().
+                        where(table.c.article_id == bindparam('target_id')).
+                        where(table.c.position ==
+                              bindparam('target_position')).
+                        values(author_id=bindparam('target_author')),
+                        changed)
+    linked = select([table.c.author_id]).\
+        where(table.c.author_id != None).distinct()
+    removed = session.execute(Author.__table__.delete().
+                              where(~Author.id.in_(linked))).rowcount
+    session.commit()
+    print("linked {0} creators to {1} authors, {2} new, {3} removed".format(
+        len(changed), session.query(func.count(Author.id)).scalar(),
+        added, removed))
+    return len(changed)
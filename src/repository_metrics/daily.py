@@ -0,0 +1,201 @@
+"""Daily download storage
+
+Daily downloads are kept in daily_downloads, one row per article and day
+with downloads, keyed by a small integer calendar key instead of a date:
+
+    day = (year - 2000) * 372 + (month - 1) * 31 + (day of month - 1)
+
+Every month spans 31 keys and every year 372, so the month of a key is
+key - key % 31 in SQL or Python, and a key fits a SMALLINT from 2000
+through 2087.  Days without downloads are not stored.  On MySQL the table
+is partitioned by year (migrate adds the partitions) so a date range only
+reads its partitions.
+
+The month rows of downloads are derived from the daily rows after each
+load, so the monthly exports, rollups and API read the same tables as
+before and get no slower.  A month the report only partly covers keeps
+the total of a monthly report; the derived rows are marked from_days."""
+from calendar import monthrange
+from datetime import date
+from sqlalchemy import select, func, text
+from model import DailyDownload, Download, bulk_upsert
+from rollups import chunks
+
+
+EPOCH_YEAR = 2000
+DAYS_PER_MONTH = 31
+DAYS_PER_YEAR = 12 * DAYS_PER_MONTH
+# the days whose keys fit a SMALLINT
+FIRST_DAY = date(EPOCH_YEAR, 1, 1)
+LAST_DAY = date(2087, 12, 31)
+
+
+def day_key(value):
+    """Return the day key of a date from FIRST_DAY to LAST_DAY"""
+    if not FIRST_DAY <= value <= LAST_DAY:
+        raise ValueError("{0} is outside the day keys".format(value))
+    return (value.year - EPOCH_YEAR) * DAYS_PER_YEAR + \
+        (value.month - 1) * DAYS_PER_MONTH + value.day - 1
+
+
+def key_date(key):
+    """Return the date of a day key"""
+    (years, days) = divmod(key, DAYS_PER_YEAR)
+    (months, days) = divmod(days, DAYS_PER_MONTH)
+    return date(EPOCH_YEAR + years, months + 1, days + 1)
+
+
+def month_key(key):
+    """Return the key of the first day of the month of a day key"""
+    return key - key % DAYS_PER_MONTH
+
+
+def year_key(year):
+    """Return the key of January 1st of a year"""
+    return (year - EPOCH_YEAR) * DAYS_PER_YEAR
+
+
+def covers(first, last, month):
+    """Return whether day keys first to last cover every day of the
+    month starting on date month"""
+    end = month.replace(day=monthrange(month.year, month.month)[1])
+    return first <= day_key(month) and day_key(end) <= last
+
+
+def month_dates(first, last):
+    """Return the yyyy-mm-01 dates of the months from day key first to
+    day key last"""
+    return [key_date(key) for key in range(month_key(first), last + 1,
+                                           DAYS_PER_MONTH)]
+
+
+def replace_days(session, article_ids, days, first, last):
+    """Replace the daily downloads of article_ids from day key first to
+    day key last with days, dicts of article_id, day and download_count"""
+    table = DailyDownload.__table__
+    for chunk in chunks(article_ids):
+        session.execute(table.delete().
+                        where(table.c.article_id.in_(chunk)).
+                        where(table.c.day >= first).
+                        where(table.c.day <= last))
+    bulk_upsert(session, table, [row for row in days
+                                 if row['download_count']],
+                ['article_id', 'day'])
+
+
+def month_totals(session, article_ids, first, last):
+    """Return {(article_id, month): downloads} of the whole months from day
+    key first to day key last"""
+    table = DailyDownload.__table__
+    month = table.c.day - table.c.day % DAYS_PER_MONTH
+    query = select([table.c.article_id, month,
+                    func.sum(table.c.download_count)]).\
+        where(table.c.article_id.in_(article_ids)).\
+        where(table.c.day >= month_key(first)).\
+        where(table.c.day < month_key(last) + DAYS_PER_MONTH).\
+        group_by(table.c.article_id, month)
+    return dict(((article_id, key_date(key)), int(count))
+                for (article_id, key, count) in session.execute(query))
+
+
+def monthly_totals(session, article_ids, months):
+    """Return the (article_id, month) pairs of months with a total loaded
+    from a monthly report"""
+    if not months:
+        return set()
+    query = session.query(Download.article_id, Download.download_date).\
+        filter(Download.article_id.in_(article_ids)).\
+        filter(Download.download_date.in_(months)).\
+        filter(Download.from_days.isnot(True))
+    return set((article_id, month) for (article_id, month) in query)
+
+
+def refresh_months(session, article_ids, first, last):
+    """Rewrite the downloads rows of article_ids for the months from day
+    key first to day key last from their daily downloads
+
+    A month that first to last only partly covers is rewritten only when
+    it has no total from a monthly report.  Returns the rows written."""
+    months = month_dates(first, last)
+    partial = [month for month in months if not covers(first, last, month)]
+    written = 0
+    for chunk in chunks(article_ids):
+        totals = month_totals(session, chunk, first, last)
+        kept = monthly_totals(session, chunk, partial)
+        rows = [{'article_id': article_id,
+                 'download_date': month,
+                 'download_count': totals.get((article_id, month), 0),
+                 'from_days': True}
+                for article_id in chunk for month in months
+                if (article_id, month) not in kept]
+        bulk_upsert(session, Download.__table__, rows,
+                    ['article_id', 'download_date'])
+        written += len(rows)
+    return written
+
+
+def article_days(session, article_id, start=None, end=None):
+    """Return the (date, downloads) days of an article with downloads,
+    optionally from start to end"""
+    query = session.query(DailyDownload.day, DailyDownload.download_count).\
+        filter(DailyDownload.article_id == article_id)
+    if start is not None:
+        if start > LAST_DAY:
+            return []
+        query = query.filter(DailyDownload.day >=
+                             day_key(max(start, FIRST_DAY)))
+    if end is not None:
+        if end < FIRST_DAY:
+            return []
+        query = query.filter(DailyDownload.day <= day_key(min(end, LAST_DAY)))
+    return [(key_date(key), count)
+            for (key, count) in query.order_by(DailyDownload.day)]
+
+
+def partition_name(year):
+    """Return the name of the partition of a year"""
+    return "p{0}".format(year)
+
+
+def partition_clause(years):
+    """Return the partition definitions of years and a catch-all"""
+    definitions = ["PARTITION {0} VALUES LESS THAN ({1})".format(
+        partition_name(year), year_key(year + 1)) for year in years]
+    definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return "({0})".format(", ".join(definitions))
+
+
+def partition_steps(connection, exists=True, through=None):
+    """Return the (description, statement) steps partitioning
+    daily_downloads by year up to through, by default next year
+
+    Only MySQL partitions; an unpartitioned table starts at the year of
+    its first day, and a partitioned one gains the missing years."""
+    if connection.dialect.name != 'mysql':
+        return []
+    table = DailyDownload.__tablename__
+    if through is None:
+        through = date.today().year + 1
+    names = []
+    if exists:
+        names = [name for (name,) in connection.execute(text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name "
+            "ORDER BY PARTITION_ORDINAL_POSITION"), {'name': table})
+            if name is not None]
+    if not names:
+        first = None
+        if exists:
+            first = connection.execute(
+                select([func.min(DailyDownload.day)])).scalar()
+        start = date.today().year if first is None else key_date(first).year
+        return [("partition {0} by year from {1}".format(table, start),
+                 "ALTER TABLE {0} PARTITION BY RANGE (day) {1}".format(
+                     table, partition_clause(range(start, through + 1))))]
+    years = [int(name[1:]) for name in names if name != 'pmax']
+    missing = range(max(years) + 1, through + 1) if years else []
+    if not missing:
+        return []
+    return [("add {0} partitions through {1}".format(table, through),
+             "ALTER TABLE {0} REORGANIZE PARTITION pmax INTO {1}".format(
+                 table, partition_clause(missing)))]
@@ -0,0 +1,528 @@
+"""Declarative csv exports
+
+A Report names its columns and the passes that feed them.  A pass yields
+(article, rows) groups: article columns are computed once per group and
+row columns once per row, and each output line is written as a list
+through a buffered csv writer, without a dict per row.  The row sources
+select plain rows ordered by article id from a server-side cursor and group
+them as they arrive, so no ORM objects are kept and memory stays flat.
+Output is csv or tsv, optionally gzip or zstd compressed, and can be split
+between worker processes by article id range with the same bytes as a
+serial run."""
+import csv
+import gzip
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from collections import namedtuple
+from math import ceil
+import unicodecsv
+import profiling
+from sqlalchemy import select, func, or_
+from model import Article, Creator, Download, format_name, get_session
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BUFFER_SIZE = 1024 * 1024
+STREAM_SIZE = 10000
+FORMATS = {'csv': csv.excel, 'tsv': csv.excel_tab}
+
+
+class ExportError(Exception):
+    """Raised for an export that cannot be written"""
+
+
+class Column(object):
+    """An export column
+
+    value computes the column from the article of a group, or with
+    row=True from each row of the group.  A column without a value is
+    always empty."""
+    def __init__(self, name, value=None, row=False):
+        self.name = name
+        self.value = value
+        self.row = row
+
+
+class Report(object):
+    """Columns and the (rows, kwargs) passes that fill them
+
+    prepare is called once with a session before the passes run and
+    returns extra keyword arguments for every pass."""
+    def __init__(self, name, columns, passes, step=1000, prepare=None):
+        self.name = name
+        self.columns = columns
+        self.passes = passes
+        self.step = step
+        self.prepare = prepare
+
+    @property
+    def fieldnames(self):
+        """Return the column names"""
+        return [column.name for column in self.columns]
+
+
+def stripped(value):
+    """Return a string without surrounding whitespace, or None"""
+    if value:
+        return value.strip()
+    return None
+
+
+def year(value):
+    """Return the year of a date, or None"""
+    if value:
+        return value.year
+    return None
+
+
+def attribute(name):
+    """Return a column value reading an attribute"""
+    def value(item):
+        return getattr(item, name)
+    return value
+
+
+# article columns shared by the article centered reports
+ARTICLE_ID = Column('article_id', attribute('id'))
+TITLE = Column('title', lambda article: article.title.strip())
+BYLINE = Column('byline', attribute('byline'))
+PUBLICATION = Column('publication',
+                     lambda article: stripped(article.publication))
+PUBLICATION_DATE = Column('publication_date', attribute('date'))
+PUBLICATION_YEAR = Column('publication_year',
+                          lambda article: year(article.date))
+DEPOSIT_DATE = Column('deposit_date', attribute('submission_date'))
+DOCUMENT_TYPE = Column('document_type', attribute('document_type'))
+CONTEXT = Column('context', attribute('context'))
+ARTICLE_URL = Column('article_url', attribute('article_url'))
+HAS_FACULTY = Column('has_faculty', attribute('has_faculty'))
+DOWNLOAD_DATE = Column('download_date', attribute('download_date'),
+                       row=True)
+DOWNLOAD_COUNT = Column('download_count', attribute('download_count'),
+                        row=True)
+EMAIL = Column('email', attribute('email'), row=True)
+AUTHOR_ID = Column('author_id', attribute('author_id'), row=True)
+CREATOR = Column('creator', lambda row: format_name(row.last, row.first),
+                 row=True)
+
+DownloadMonth = namedtuple('DownloadMonth', ['download_date',
+                                             'download_count'])
+
+# the article columns selected by the row sources
+ARTICLE_COLUMNS = [Article.id, Article.title, Article.byline,
+                   Article.publication, Article.date,
+                   Article.submission_date, Article.document_type,
+                   Article.context, Article.article_url, Article.has_faculty]
+
+
+class ExportProgress(object):
+    """Row count of an export, shared by its worker processes"""
+    def __init__(self, step=1000):
+        self.step = step
+        self.rows = multiprocessing.Value('l', 0)
+
+    def add(self, rows=1):
+        """Count written rows, printing every step rows"""
+        with self.rows.get_lock():
+            before = self.rows.value
+            self.rows.value += rows
+            after = self.rows.value
+        if before // self.step != after // self.step:
+            print("writing row {0}".format(after - after % self.step))
+            sys.stdout.flush()
+
+
+def id_range(query, column, low, high):
+    """Restrict query to low <= column < high, either bound optional"""
+    if low is not None:
+        query = query.filter(column >= low)
+    if high is not None:
+        query = query.filter(column < high)
+    return query
+
+
+def article_id_ranges(session, parts):
+    """Split the article ids into at most parts (low, high) ranges"""
+    (first, last) = session.query(func.min(Article.id),
+                                  func.max(Article.id)).one()
+    if first is None:
+        return []
+    span = int(ceil((last - first + 1) / float(parts)))
+    return [(low, low + span) for low in range(first, last + 1, span)]
+
+
+def stream(session, statement):
+    """Return the rows of a select read from a server-side cursor
+
+    Rows are fetched STREAM_SIZE at a time instead of being buffered by the
+    driver (an SSCursor with MySQLdb).  No other statement may run on the
+    session while the rows are read."""
+    return session.execute(statement.execution_options(
+        stream_results=True, max_row_buffer=STREAM_SIZE))
+
+
+def article_groups(rows):
+    """Group rows ordered by article id into (first row, rows) pairs"""
+    for (article_id, group) in itertools.groupby(rows, lambda row: row.id):
+        first = next(group)
+        yield (first, itertools.chain([first], group))
+
+
+def write_groups(csvwriter, columns, groups, progress):
+    """Write the lines of (article, rows) groups"""
+    values = [None] * len(columns)
+    article_values = [(index, column.value)
+                      for (index, column) in enumerate(columns)
+                      if column.value is not None and not column.row]
+    row_values = [(index, column.value)
+                  for (index, column) in enumerate(columns)
+                  if column.value is not None and column.row]
+    writerow = csvwriter.writerow
+    with profiling.phase('write'):
+        for (article, rows) in profiling.timed(groups, 'hydrate'):
+            for (index, value) in article_values:
+                values[index] = value(article)
+            if not row_values:
+                writerow(values)
+                progress.add()
+                profiling.add_rows()
+                continue
+            written = 0
+            for row in profiling.timed(rows, 'hydrate'):
+                for (index, value) in row_values:
+                    values[index] = value(row)
+                writerow(values)
+                written += 1
+            if written:
+                progress.add(written)
+                profiling.add_rows(written)
+
+
+def output_format(output, format=None, compression=None):
+    """Return the (format, compression) of an output file name
+
+    Unless given they are inferred from the .tsv, .gz and .zst
+    extensions."""
+    (name, extension) = os.path.splitext(output)
+    if compression is None:
+        compression = {'.gz': 'gzip', '.zst': 'zstd'}.get(extension)
+        if compression is not None:
+            extension = os.path.splitext(name)[1]
+    if format is None:
+        format = 'tsv' if extension == '.tsv' else 'csv'
+    if compression == 'zstd' and zstandard is None:
+        raise ExportError("zstd output needs the zstandard package")
+    return (format, compression)
+
+
+def open_output(output, compression=None):
+    """Return (file, raw) where raw is the buffered file of output and
+    file compresses into it if asked"""
+    raw = open(output, 'wb', BUFFER_SIZE)
+    if compression == 'gzip':
+        return (gzip.GzipFile(fileobj=raw, mode='wb', mtime=0), raw)
+    if compression == 'zstd':
+        return (zstandard.ZstdCompressor().stream_writer(raw), raw)
+    return (raw, raw)
+
+
+_export = None
+
+
+def init_export_worker(report, format, kwargs, progress):
+    """Pool initializer opening the worker's own engine"""
+    global _export
+    _export = (report, format, kwargs, progress, get_session())
+    profiling.drain()
+
+
+def write_export_part(task):
+    """Write the lines of one pass and id range to a part file
+
+    Returns the part path and the worker's profiling counters."""
+    (index, low, high, path) = task
+    (report, format, kwargs, progress, session) = _export
+    (rows, pass_kwargs) = report.passes[index]
+    arguments = dict(kwargs, **pass_kwargs)
+    with open(path, 'wb', BUFFER_SIZE) as part:
+        csvwriter = unicodecsv.writer(part, dialect=FORMATS[format])
+        write_groups(csvwriter, report.columns,
+                     rows(session, low=low, high=high, **arguments),
+                     progress)
+    session.remove()
+    return (path, profiling.drain())
+
+
+def export(report, output, workers=1, format=None, compression=None):
+    """Write a report to output and return the number of rows
+
+    With several workers each pass is split into article id ranges that
+    worker processes, each with its own engine, write to uncompressed part
+    files.  The parts are appended to output in pass and id order, so the
+    result is identical to the serial export."""
+    (format, compression) = output_format(output, format, compression)
+    progress = ExportProgress(report.step)
+    session = get_session()
+    print("making query")
+    kwargs = {}
+    if report.prepare is not None:
+        kwargs = report.prepare(session)
+    (output_file, raw) = open_output(output, compression)
+    try:
+        csvwriter = unicodecsv.writer(output_file, dialect=FORMATS[format])
+        csvwriter.writerow(report.fieldnames)
+        if workers <= 1:
+            for (rows, pass_kwargs) in report.passes:
+                write_groups(csvwriter, report.columns,
+                             rows(session, **dict(kwargs, **pass_kwargs)),
+                             progress)
+        else:
+            ranges = article_id_ranges(session, workers * 4)
+            session.remove()
+            session.get_bind().dispose()
+            write_parts(report, output_file, format, kwargs, progress,
+                        ranges, workers,
+                        os.path.dirname(os.path.abspath(output)))
+    finally:
+        output_file.close()
+        if not raw.closed:
+            raw.close()
+    return progress.rows.value
+
+
+def write_parts(report, output_file, format, kwargs, progress, ranges,
+                workers, directory):
+    """Have a pool of workers write the parts and append them in order"""
+    directory = tempfile.mkdtemp(prefix='export-', dir=directory)
+    tasks = [(index, low, high,
+              os.path.join(directory, "{0}-{1}.csv".format(index, low)))
+             for index in range(len(report.passes))
+             for (low, high) in ranges]
+    pool = multiprocessing.Pool(workers, init_export_worker,
+                                (report, format, kwargs, progress))
+    try:
+        for (path, counters) in pool.imap(write_export_part, tasks):
+            profiling.merge(counters)
+            with profiling.phase('write'), open(path, 'rb') as part:
+                shutil.copyfileobj(part, output_file, BUFFER_SIZE)
+            os.remove(path)
+        pool.close()
+    finally:
+        pool.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def author_month_rows(session, low=None, high=None):
+    """Yield each article with its linked creator x download month rows"""
+    query = select(ARTICLE_COLUMNS + [Creator.first, Creator.last,
+                                      Creator.email, Creator.author_id,
+                                      Download.download_date,
+                                      Download.download_count]).\
+        where(Creator.author_id != None).\
+        where(Article.id == Creator.article_id).\
+        where(Article.id == Download.article_id).\
+        where(Download.download_count > 0)
+    query = id_range(query, Article.id, low, high).\
+        order_by(Article.id, Creator.position, Download.download_date)
+    return article_groups(stream(session, query))
+
+
+AUTHOR_MONTH = Report('author_month', [
+    EMAIL,
+    CREATOR,
+    ARTICLE_ID,
+    TITLE,
+    Column('publication', attribute('publication')),
+    PUBLICATION_DATE,
+    DEPOSIT_DATE,
+    DOCUMENT_TYPE,
+    ARTICLE_URL,
+    DOWNLOAD_DATE,
+    DOWNLOAD_COUNT,
+    AUTHOR_ID,
+], [(author_month_rows, {})], step=10000)
+
+
+def article_creator_rows(session, low=None, high=None):
+    """Yield each article with its creator rows"""
+    query = select(ARTICLE_COLUMNS + [Creator.first, Creator.last,
+                                      Creator.email, Creator.author_id]).\
+        where(Creator.article_id == Article.id)
+    query = id_range(query, Article.id, low, high).\
+        order_by(Article.id, Creator.position)
+    return article_groups(stream(session, query))
+
+
+ARTICLES_BY_AUTHOR = Report('articles_by_author', [
+    EMAIL,
+    CREATOR,
+    ARTICLE_ID,
+    TITLE,
+    PUBLICATION,
+    PUBLICATION_DATE,
+    DEPOSIT_DATE,
+    DOCUMENT_TYPE,
+    ARTICLE_URL,
+    BYLINE,
+    Column('constant'),
+    AUTHOR_ID,
+], [(article_creator_rows, {})])
+
+
+def article_month_rows(session, low=None, high=None):
+    """Yield each article with downloads with its download month rows"""
+    query = select(ARTICLE_COLUMNS + [Download.download_date,
+                                      Download.download_count]).\
+        where(Download.article_id == Article.id)
+    query = id_range(query, Article.id, low, high).\
+        order_by(Article.id, Download.download_date)
+    return article_groups(stream(session, query))
+
+
+ARTICLES_MONTH = Report('articles_month', [
+    ARTICLE_ID,
+    DOWNLOAD_DATE,
+    TITLE,
+    BYLINE,
+    PUBLICATION,
+    PUBLICATION_DATE,
+    PUBLICATION_YEAR,
+    DEPOSIT_DATE,
+    DOCUMENT_TYPE,
+    CONTEXT,
+    ARTICLE_URL,
+    HAS_FACULTY,
+    DOWNLOAD_COUNT,
+], [(article_month_rows, {})])
+
+
+def article_rows(session, low=None, high=None):
+    """Yield every article"""
+    query = id_range(select(ARTICLE_COLUMNS), Article.id, low, high).\
+        order_by(Article.id)
+    for article in stream(session, query):
+        yield (article, None)
+
+
+ARTICLES = Report('articles', [
+    ARTICLE_ID,
+    TITLE,
+    BYLINE,
+    PUBLICATION,
+    PUBLICATION_DATE,
+    PUBLICATION_YEAR,
+    DEPOSIT_DATE,
+    DOCUMENT_TYPE,
+    CONTEXT,
+    ARTICLE_URL,
+    HAS_FACULTY,
+], [(article_rows, {})])
+
+
+def journal_download_counts(session):
+    """Map journal pdf_url to {download_date: download_count}
+
+    Only the pdf urls that are the source_fulltext_url of a faculty
+    scholarship article are loaded, in a single query."""
+    sources = select([Article.source_fulltext_url]).\
+        where(Article.context == u'faculty_scholarship').\
+        where(Article.source_fulltext_url != None)
+    query = session.query(Article.pdf_url, Download.download_date,
+                          Download.download_count).\
+        filter(Download.article_id == Article.id).\
+        filter(Article.pdf_url.in_(sources))
+    counts = {}
+    for (pdf_url, download_date, download_count) in query:
+        counts.setdefault(pdf_url, {}).setdefault(download_date,
+                                                  download_count)
+    return counts
+
+
+def faculty_journal_urls(session):
+    """Return the source_fulltext_urls of faculty articles with downloads
+
+    The journal versions of these articles are folded into the faculty
+    rows and skipped by the non faculty pass."""
+    query = session.query(Article.source_fulltext_url).distinct().\
+        filter(Article.context == u'faculty_scholarship').\
+        filter(Article.source_fulltext_url != None).\
+        filter(Article.downloads.any())
+    return set(url for (url,) in query)
+
+
+def prepare_faculty(session):
+    """Load the journal downloads folded into the faculty rows"""
+    return {'journal_downloads': journal_download_counts(session),
+            'skip_urls': faculty_journal_urls(session)}
+
+
+def faculty_rows(session, journal_downloads, skip_urls, low=None,
+                 high=None, faculty=True):
+    """Yield faculty articles, or the other articles with an author email,
+    with their download months including journal version downloads"""
+    query = select(ARTICLE_COLUMNS + [Article.oai_identifier,
+                                      Article.pdf_url,
+                                      Article.source_fulltext_url,
+                                      Download.download_date,
+                                      Download.download_count]).\
+        where(Download.article_id == Article.id)
+    if faculty:
+        query = query.where(Article.context == u'faculty_scholarship')
+    else:
+        query = query.\
+            where(or_(Article.context == None,
+                      Article.context != u'faculty_scholarship')).\
+            where(Article.id.in_(select([Creator.article_id]).
+                                 where(Creator.email.contains(u'@'))))
+    query = id_range(query, Article.id, low, high).\
+        order_by(Article.id, Download.download_date)
+    for (article, rows) in article_groups(stream(session, query)):
+        if not faculty and article.pdf_url in skip_urls:
+            print("Skipping: {0}".format(article.oai_identifier))
+            continue
+        journal_counts = {}
+        if article.source_fulltext_url:
+            journal_counts = journal_downloads.get(
+                article.source_fulltext_url, {})
+        yield (article, faculty_counts(rows, journal_counts))
+
+
+def faculty_counts(rows, journal_counts):
+    """Yield download month rows with the journal version downloads added"""
+    for row in rows:
+        download_count = row.download_count
+        journal_download_count = journal_counts.get(row.download_date)
+        if journal_download_count:
+            download_count += journal_download_count
+        yield DownloadMonth(row.download_date, download_count)
+
+
+FACULTY = Report('faculty', [
+    ARTICLE_ID,
+    DOWNLOAD_DATE,
+    TITLE,
+    BYLINE,
+    PUBLICATION,
+    PUBLICATION_DATE,
+    PUBLICATION_YEAR,
+    DEPOSIT_DATE,
+    DOCUMENT_TYPE,
+    CONTEXT,
+    ARTICLE_URL,
+    HAS_FACULTY,
+    DOWNLOAD_COUNT,
+], [(faculty_rows, {'faculty': True}), (faculty_rows, {'faculty': False})],
+    prepare=prepare_faculty)
+
+
+REPORTS = dict((report.name, report) for report in
+               [AUTHOR_MONTH, ARTICLES_BY_AUTHOR, ARTICLES_MONTH, ARTICLES,
+                FACULTY])
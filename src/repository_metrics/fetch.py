@@ -0,0 +1,99 @@
+"""Concurrent retrieval of the editor and metadata report spreadsheets"""
+import requests
+import urlparse
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from spreadsheet import open_workbook, SpreadsheetError
+
+
+REPORTS = ['metadata', 'editor']
+
+
+def get_http_session(workers=4, retries=3, backoff_factor=0.5):
+    """Return a requests session with a pooled, retrying adapter"""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def report_url(server, context, report):
+    """Return the url of a context report"""
+    return urlparse.urljoin(server, "{0}_{1}.xls".format(context, report))
+
+
+def check_workbook(contents):
+    """Raise SpreadsheetError unless contents open as a workbook"""
+    open_workbook(contents, on_demand=True).release_resources()
+
+
+def fetch(http, url, timeout=60, cache=None):
+    """Return the body of url, raising on HTTP errors and on a body that is
+    not a workbook
+
+    With a ReportCache the request is made conditional on the cached
+    validators and a 304 response is answered from the cache.  A body the
+    cache fails to store is still returned."""
+    headers = {}
+    if cache is not None:
+        headers = cache.validators(url)
+    response = http.get(url, timeout=timeout, headers=headers)
+    if cache is not None and response.status_code == 304:
+        contents = cache.contents(url)
+        if contents is not None:
+            return contents
+        response = http.get(url, timeout=timeout)
+    response.raise_for_status()
+    check_workbook(response.content)
+    if cache is not None:
+        try:
+            cache.store(url, response.content, response.headers)
+        except (IOError, OSError) as e:
+            # a full or read-only cache only costs the next conditional GET
+            print("not cached: {0}: {1}".format(url, e))
+    return response.content
+
+
+def fetch_reports(server, contexts, workers=4, timeout=60, retries=3,
+                  http=None, cache=None):
+    """Download every context report concurrently
+
+    Yields (context, reports) as soon as both reports of a context have
+    arrived, where reports maps the report name to the file contents.  A
+    context whose reports could not be retrieved or read as a workbook
+    yields None instead."""
+    if http is None:
+        http = get_http_session(workers=workers, retries=retries)
+
+    def job(args):
+        (context, report) = args
+        url = report_url(server, context, report)
+        print("opening: {0}".format(url))
+        try:
+            return (context, report, fetch(http, url, timeout=timeout,
+                                           cache=cache))
+        except (requests.RequestException, IOError, OSError,
+                SpreadsheetError) as e:
+            print("failed: {0}: {1}".format(url, e))
+            return (context, report, None)
+
+    jobs = [(context, report) for context in contexts for report in REPORTS]
+    pool = ThreadPool(workers)
+    pending = {}
+    try:
+        for (context, report, contents) in pool.imap_unordered(job, jobs):
+            reports = pending.setdefault(context, {})
+            reports[report] = contents
+            if len(reports) == len(REPORTS):
+                del pending[context]
+                if None in reports.values():
+                    yield (context, None)
+                else:
+                    yield (context, reports)
+    finally:
+        pool.terminate()
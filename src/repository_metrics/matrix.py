@@ -0,0 +1,242 @@
+"""Memory-mapped article x month download matrix
+
+A snapshot stores the downloads table as a dense matrix of counts, one row
+per article and one column per month, next to the index arrays needed to
+label and group it:
+
+    counts.npy         int32 (articles, months) download counts
+    article_ids.npy    int64 article id of each row, ascending
+    months.npy         datetime64[M] month of each column
+    contexts.npy       int32 context code of each row, -1 for none
+    context_names.npy  context of each code
+    author_rows.npy    int32 row of each (author, article) creator pair
+    author_codes.npy   int32 author code of each pair, ascending
+    author_ids.npy     int64 author id of each code
+    snapshot.json      dataset version and shape
+
+Every array is a plain .npy file opened with mmap_mode='r', so a snapshot
+opens without reading the counts and processes share its pages.  Pivots
+group-sum the rows without querying the database."""
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy
+import unicodecsv
+from sqlalchemy import func
+from model import Article, Creator, Download, get_dataset_version
+
+
+DEFAULT_DIRECTORY = 'download_matrix'
+FETCH_SIZE = 50000
+PIVOTS = ['article', 'author', 'context']
+
+
+def month_index(values):
+    """Return datetime64[M] months of dates"""
+    return numpy.array(values, dtype='datetime64[D]').\
+        astype('datetime64[M]')
+
+
+def codes(values, dtype=numpy.unicode_):
+    """Return (codes, names) numbering the distinct non None values, the
+    names an array of dtype"""
+    names = sorted(set(value for value in values if value is not None))
+    numbers = dict((name, code) for (code, name) in enumerate(names))
+    return (numpy.array([numbers.get(value, -1) for value in values],
+                        dtype=numpy.int32),
+            numpy.array(names, dtype=dtype))
+
+
+def article_index(session):
+    """Return (article_ids, contexts) of every article, by id"""
+    (article_ids, contexts) = zip(*session.query(Article.id,
+                                                 Article.context).
+                                  order_by(Article.id).all()) or ((), ())
+    return (numpy.array(article_ids, dtype=numpy.int64), contexts)
+
+
+def month_range(session):
+    """Return the datetime64[M] months from the first to the last download"""
+    (first, last) = session.query(func.min(Download.download_date),
+                                  func.max(Download.download_date)).one()
+    if first is None:
+        return numpy.array([], dtype='datetime64[M]')
+    return numpy.arange(month_index([first])[0], month_index([last])[0] + 1)
+
+
+def read_downloads(session, counts, article_ids, months):
+    """Fill counts with every download, FETCH_SIZE rows at a time"""
+    query = session.query(Download.article_id, Download.download_date,
+                          Download.download_count).\
+        filter(Download.download_count != None).\
+        execution_options(stream_results=True, max_row_buffer=FETCH_SIZE)
+    batch = []
+    for row in query:
+        batch.append(row)
+        if len(batch) >= FETCH_SIZE:
+            fill(counts, article_ids, months, batch)
+            batch = []
+    fill(counts, article_ids, months, batch)
+
+
+def fill(counts, article_ids, months, batch):
+    """Store a batch of (article_id, download_date, count) rows"""
+    if not batch:
+        return
+    (ids, dates, values) = zip(*batch)
+    rows = numpy.searchsorted(article_ids, numpy.array(ids,
+                                                       dtype=numpy.int64))
+    columns = (month_index(dates) - months[0]).astype(numpy.int64)
+    counts[rows, columns] = values
+
+
+def build(session, directory=DEFAULT_DIRECTORY):
+    """Write a snapshot of the downloads to directory, replacing it"""
+    start = time.time()
+    version = get_dataset_version(session)
+    (article_ids, contexts) = article_index(session)
+    months = month_range(session)
+    parent = os.path.dirname(os.path.abspath(directory))
+    work = tempfile.mkdtemp(prefix='matrix-', dir=parent)
+    try:
+        counts = numpy.lib.format.open_memmap(
+            os.path.join(work, 'counts.npy'), mode='w+', dtype=numpy.int32,
+            shape=(len(article_ids), len(months)))
+        read_downloads(session, counts, article_ids, months)
+        counts.flush()
+        del counts
+        (context_codes, context_names) = codes(contexts)
+        pairs = session.query(Creator.author_id, Creator.article_id).\
+            filter(Creator.author_id != None).all()
+        (author_codes, author_ids) = codes([author_id
+                                            for (author_id, _) in pairs],
+                                           numpy.int64)
+        author_rows = numpy.searchsorted(
+            article_ids, numpy.array([article_id for (_, article_id)
+                                      in pairs], dtype=numpy.int64))
+        order = numpy.argsort(author_codes, kind='mergesort')
+        arrays = {'article_ids': article_ids,
+                  'months': months,
+                  'contexts': context_codes,
+                  'context_names': context_names,
+                  'author_rows': author_rows[order].astype(numpy.int32),
+                  'author_codes': author_codes[order],
+                  'author_ids': author_ids}
+        for (name, array) in arrays.items():
+            numpy.save(os.path.join(work, name + '.npy'), array)
+        with open(os.path.join(work, 'snapshot.json'), 'w') as info:
+            json.dump({'version': version,
+                       'articles': len(article_ids),
+                       'months': len(months),
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S')}, info)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.rename(work, directory)
+    except Exception:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+    print("snapshot of {0} articles x {1} months in {2:.1f}s".format(
+        len(article_ids), len(months), time.time() - start))
+
+
+class Snapshot(object):
+    """Read-only view of a snapshot directory"""
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+        with open(os.path.join(directory, 'snapshot.json')) as info:
+            self.info = json.load(info)
+        self.counts = self.load('counts')
+        self.article_ids = self.load('article_ids')
+        self.months = self.load('months')
+        self.contexts = self.load('contexts')
+        self.context_names = self.load('context_names')
+        self.author_rows = self.load('author_rows')
+        self.author_codes = self.load('author_codes')
+        self.author_ids = self.load('author_ids')
+
+    def is_current(self, session):
+        """Return whether the snapshot holds the current dataset version"""
+        return self.info['version'] == get_dataset_version(session)
+
+    def load(self, name):
+        """Return the memory-mapped array of a snapshot file"""
+        return numpy.load(os.path.join(self.directory, name + '.npy'),
+                          mmap_mode='r')
+
+    def month_labels(self):
+        """Return the months as YYYY-MM strings"""
+        return [unicode(month) for month in self.months]
+
+    def by_article(self):
+        """Return (labels, counts) with one row per article"""
+        return (self.article_ids, self.counts)
+
+    def by_context(self):
+        """Return (labels, counts) with one row per context"""
+        return (self.context_names,
+                group_sum(self.counts, self.contexts,
+                          len(self.context_names)))
+
+    def by_author(self):
+        """Return (labels, counts) with one row per author id
+
+        An article is credited in full to each of its creators linked to
+        the author, like the author_month_downloads rollup."""
+        return (self.author_ids,
+                group_sum(self.counts, self.author_codes,
+                          len(self.author_ids), self.author_rows))
+
+
+def warn_if_stale(snapshot, session):
+    """Print a warning when the database has changed since the snapshot
+
+    Returns whether the snapshot is current."""
+    if snapshot.is_current(session):
+        return True
+    print("warning: {0} is of dataset version {1}, the database is at {2}; "
+          "rebuild it with model.py --snapshot".format(
+              snapshot.directory, snapshot.info['version'],
+              get_dataset_version(session)))
+    return False
+
+
+def group_sum(counts, groups, size, rows=None):
+    """Sum rows of counts by group code, skipping negative codes
+
+    rows selects the counts row of each group code, by default the
+    row at the same position.  Rows are summed in blocks so that only
+    FETCH_SIZE rows of the matrix are copied at a time."""
+    result = numpy.zeros((size, counts.shape[1]), dtype=numpy.int64)
+    groups = numpy.asarray(groups)
+    if rows is None:
+        rows = numpy.arange(len(groups))
+    keep = groups >= 0
+    order = numpy.argsort(groups[keep], kind='mergesort')
+    groups = groups[keep][order]
+    rows = numpy.asarray(rows)[keep][order]
+    for start in range(0, len(groups), FETCH_SIZE):
+        block = groups[start:start + FETCH_SIZE]
+        starts = numpy.flatnonzero(numpy.r_[True, block[1:] != block[:-1]])
+        values = numpy.asarray(counts[rows[start:start + FETCH_SIZE]],
+                               dtype=numpy.int64)
+        result[block[starts]] += numpy.add.reduceat(values, starts, axis=0)
+    return result
+
+
+def write_pivot(snapshot, output, by='article'):
+    """Write a wide table of monthly downloads per article, author or
+    context"""
+    (labels, counts) = getattr(snapshot, 'by_' + by)()
+    csvwriter = unicodecsv.writer(open(output, 'wb'))
+    key = {'article': 'article_id', 'author': 'author_id',
+           'context': 'context'}[by]
+    csvwriter.writerow([key] + snapshot.month_labels() + ['total'])
+    for start in range(0, len(labels), FETCH_SIZE):
+        block = numpy.asarray(counts[start:start + FETCH_SIZE])
+        totals = block.sum(axis=1)
+        for (label, values, total) in zip(labels[start:start + FETCH_SIZE],
+                                          block.tolist(), totals.tolist()):
+            csvwriter.writerow([label] + values + [total])
+    print("wrote {0} {1} rows to {2}".format(len(labels), by, output))
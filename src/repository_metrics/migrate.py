@@ -0,0 +1,138 @@
+"""Bring an existing, populated database up to the current schema
+
+Missing tables, columns and indexes are added in place, TEXT columns
+declared with a bounded length in the model are narrowed on MySQL and the
+daily downloads get their yearly partitions, so a schema change does not
+need a drop and reload.  A derived table whose primary key changed, such
+as a rollup, is recreated empty."""
+from functools import partial
+from sqlalchemy import inspect, text, func, select
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.types import Text
+import daily
+
+
+# name, statement and sample parameters of the known hot queries
+HOT_QUERIES = [
+    ('download url lookup',
+     "SELECT id FROM articles WHERE article_url = :url",
+     {'url': u'http://scholarship.law.duke.edu/dlj/vol1/iss1/1'}),
+    ('faculty journal version join',
+     "SELECT downloads.download_date, downloads.download_count "
+     "FROM articles JOIN downloads ON downloads.article_id = articles.id "
+     "WHERE articles.pdf_url = :url",
+     {'url': u'http://scholarship.law.duke.edu/cgi/viewcontent.cgi?'
+             u'article=1&context=dlj'}),
+    ('author email filter',
+     "SELECT article_id FROM creators WHERE email = :email",
+     {'email': u'boyle@law.duke.edu'}),
+    ('context filter',
+     "SELECT id FROM articles WHERE context = :context",
+     {'context': u'faculty_scholarship'}),
+]
+
+EXPLAIN_PREFIXES = {'mysql': "EXPLAIN ",
+                    'sqlite': "EXPLAIN QUERY PLAN "}
+
+
+def explain(engine):
+    """Print the query plan of each hot query"""
+    prefix = EXPLAIN_PREFIXES.get(engine.dialect.name)
+    if prefix is None:
+        print("No EXPLAIN support for {0}".format(engine.dialect.name))
+        return
+    with engine.connect() as connection:
+        for (name, statement, params) in HOT_QUERIES:
+            print("{0}:".format(name))
+            try:
+                for row in connection.execute(text(prefix + statement),
+                                              params):
+                    print("    {0}".format(tuple(row)))
+            except Exception as e:
+                print("    {0}".format(getattr(e, 'orig', e)))
+
+
+def plan(connection, metadata):
+    """Return (description, step) pairs for the schema changes missing
+    from metadata"""
+    dialect = connection.dialect
+    inspector = inspect(connection)
+    existing_tables = inspector.get_table_names()
+    steps = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            steps.append(("create table {0}".format(table.name),
+                          partial(table.create, bind=connection)))
+            continue
+        if table.info.get('derived') and \
+                inspector.get_pk_constraint(table.name)[
+                    'constrained_columns'] != \
+                [column.name for column in table.primary_key]:
+            steps.append(("recreate table {0} with its new key".format(
+                table.name), partial(recreate, connection, table)))
+            continue
+        columns = dict((column['name'], column)
+                       for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                statement = "ALTER TABLE {0} ADD COLUMN {1}".format(
+                    table.name, CreateColumn(column).compile(dialect=dialect))
+                steps.append((statement,
+                              partial(connection.execute, text(statement))))
+            elif dialect.name == 'mysql' and \
+                    isinstance(columns[column.name]['type'], Text) and \
+                    not isinstance(column.type, Text):
+                steps.append(narrow_column(connection, table, column))
+        indexes = set(index['name']
+                      for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                steps.append(("create index {0}".format(index.name),
+                              partial(index.create, bind=connection)))
+    exists = daily.DailyDownload.__tablename__ in existing_tables
+    for (description, statement) in daily.partition_steps(connection,
+                                                          exists):
+        steps.append((description,
+                      partial(connection.execute, text(statement))))
+    return [step for step in steps if step is not None]
+
+
+def recreate(connection, table):
+    """Drop and create a derived table, which is then empty"""
+    table.drop(bind=connection)
+    table.create(bind=connection)
+
+
+def narrow_column(connection, table, column):
+    """Return the step narrowing a TEXT column to its declared type"""
+    longest = connection.execute(
+        select([func.max(func.char_length(column))])).scalar() or 0
+    if longest > column.type.length:
+        print("not narrowing {0}.{1}: values up to {2} characters".
+              format(table.name, column.name, longest))
+        return None
+    statement = "ALTER TABLE {0} MODIFY {1}".format(
+        table.name, CreateColumn(column).compile(dialect=connection.dialect))
+    return (statement, partial(connection.execute, text(statement)))
+
+
+def migrate(engine, metadata, dry_run=False):
+    """Apply the schema changes missing from metadata, printing plans
+    before and after
+
+    The caller passes its engine and metadata, so model.py --migrate does
+    not import a second copy of model."""
+    print("Query plans before:")
+    explain(engine)
+    with engine.begin() as connection:
+        steps = plan(connection, metadata)
+        if not steps:
+            print("Schema is up to date")
+        for (description, step) in steps:
+            print(description)
+            if not dry_run:
+                step()
+    if not dry_run and steps:
+        print("Query plans after:")
+        explain(engine)
+    return len(steps)
@@ -1,27 +1,46 @@
 """Schema for bibliographic and citation datbaase"""
 import argparse
+import base64
+import json
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import Column, UnicodeText, Integer, ForeignKey
-from sqlalchemy import Unicode, Date
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import Unicode, Date, DateTime, Boolean, Index
+from sqlalchemy import SmallInteger
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy import create_engine, event, exc, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import sessionmaker, scoped_session, selectinload
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import ConfigParser
 from nameparser import HumanName
+from datetime import date, datetime
 from math import ceil
 import os
 import re
-import unicodecsv
+import sys
+import threading
+import time
 
 
 Base = declarative_base()
 
+# oai:scholarship.law.duke.edu:faculty_scholarship-5781
+CONTEXT_RE = re.compile('oai:scholarship.law.duke.edu:([a-z_]+)-\d+')
+
 
 class Article(Base):
     """Article data"""
     __tablename__ = 'articles'
 
-    __table_args__ = {'mysql_engine': 'InnoDB'}
+    # TEXT columns can only be indexed by a bounded prefix on MySQL
+    __table_args__ = (Index('ix_articles_article_url', 'article_url',
+                            mysql_length=191),
+                      Index('ix_articles_pdf_url', 'pdf_url',
+                            mysql_length=191),
+                      {'mysql_engine': 'InnoDB'})
 
     #column definitions
     id = Column(u'id', Integer, primary_key=True, nullable=False)
@@ -37,11 +56,18 @@ class Article(Base):
     pdf_url = Column(u'pdf_url', UnicodeText)
     publication = Column(u'publication', UnicodeText, nullable=True)
     source_fulltext_url = Column(u'source_fulltext_url', UnicodeText)
-    volume = Column(u'volume', UnicodeText(32))
-    issue = Column(u'issue', UnicodeText(32))
+    volume = Column(u'volume', Unicode(32))
+    issue = Column(u'issue', Unicode(32))
+
+    fpage = Column(u'fpage', Unicode(32))
+    lpage = Column(u'lpage', Unicode(32))
+    # sha1 of the normalized report row, unchanged rows are not rewritten
+    source_hash = Column(u'source_hash', Unicode(40))
 
-    fpage = Column(u'fpage', UnicodeText(32))
-    lpage = Column(u'lpage', UnicodeText(32))
+    # maintained by the loaders and refresh_derived
+    byline = Column(u'byline', UnicodeText)
+    context = Column(u'context', Unicode(64), index=True)
+    has_faculty = Column(u'has_faculty', Boolean)
 
     #relation definitions
     creators = relationship('Creator',
@@ -61,30 +87,14 @@ class Article(Base):
         return u"<Article('%s, %s')>" % (self.id,
                                          self.oai_identifier)
 
-    @property
-    def byline(self):
-        """Return a joined creator string"""
-        stack = []
-        if self.creators is None:
-            return None
-        for creator in self.creators:
-            name = HumanName()
-            name.first = creator.first
-            name.last = creator.last
-            name.middle = creator.middle
-            name.suffix = creator.suffix
-            stack.append(unicode(name))
-        if len(stack) == 2:
-            creator_string = u" and ".join(stack)
-        elif len(stack) == 1:
-            creator_string = stack[0]
-        elif len(stack) > 2:
-            last = stack.pop(-1)
-            creator_string = u", ".join(stack)
-            creator_string = creator_string + u' and ' + last
-        else:
-            creator_string = u""
-        return creator_string
+    def refresh_derived(self):
+        """Recompute the byline, context and has_faculty columns"""
+        creators = sorted(self.creators, key=lambda creator: creator.position)
+        self.byline = format_byline([(creator.first, creator.middle,
+                                      creator.last, creator.suffix)
+                                     for creator in creators])
+        self.context = article_context(self.oai_identifier)
+        self.has_faculty = self.has_email
 
     @property
     def has_email(self):
@@ -95,6 +105,31 @@ class Article(Base):
         return False
 
 
+def format_byline(names):
+    """Return a joined creator string
+
+    names are (first, middle, last, suffix) tuples in position order."""
+    stack = []
+    for (first, middle, last, suffix) in names:
+        name = HumanName()
+        name.first = first
+        name.last = last
+        name.middle = middle
+        name.suffix = suffix
+        stack.append(unicode(name))
+    if len(stack) == 2:
+        creator_string = u" and ".join(stack)
+    elif len(stack) == 1:
+        creator_string = stack[0]
+    elif len(stack) > 2:
+        last = stack.pop(-1)
+        creator_string = u", ".join(stack)
+        creator_string = creator_string + u' and ' + last
+    else:
+        creator_string = u""
+    return creator_string
+
+
 class Creator(Base):
     """Creators for articles"""
     __tablename__ = 'creators'
@@ -115,7 +150,13 @@ class Creator(Base):
     middle = Column(u'middle', UnicodeText)
     suffix = Column(u'suffix', UnicodeText)
     institution = Column(u'institution', Unicode(255))
-    email = Column(u'email', Unicode(255), nullable=True)
+    email = Column(u'email', Unicode(255), nullable=True, index=True)
+    # set by the loaders and authors.link
+    author_id = Column(u'author_id', Integer,
+                       ForeignKey('authors.id',
+                                  ondelete='SET NULL',
+                                  onupdate='CASCADE'),
+                       nullable=True, index=True)
 
     def __repr__(self):
         return u"<Creator('%s, %s')>" % (self.article_id, self.position)
@@ -123,13 +164,35 @@ class Creator(Base):
     @property
     def name(self):
         """Returns name"""
-        stack = []
-        if self.last:
-            stack.append(self.last)
-        if self.first:
-            stack.append(self.first)
-        creator_string = u", ".join(stack)
-        return creator_string
+        return format_name(self.last, self.first)
+
+
+def format_name(last, first):
+    """Return a creator name as last, first"""
+    stack = []
+    if last:
+        stack.append(last)
+    if first:
+        stack.append(first)
+    creator_string = u", ".join(stack)
+    return creator_string
+
+
+class Author(Base):
+    """Distinct authors the creators are linked to, see authors"""
+    __tablename__ = 'authors'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(u'id', Integer, primary_key=True, nullable=False)
+    # unidecoded, lower case "last first", see authors.name_key
+    name_key = Column(u'name_key', Unicode(191), nullable=False, index=True)
+    email = Column(u'email', Unicode(255), nullable=True, unique=True)
+    name = Column(u'name', Unicode(255))
+
+    creators = relationship('Creator', backref='author')
+
+    def __repr__(self):
+        return u"<Author('%s, %s')>" % (self.id, self.name_key)
 
 
 class Download(Base):
@@ -145,15 +208,125 @@ class Download(Base):
                         nullable=False,
                         primary_key=True)
     # use yyyy-mm-01 for the month aggregations
-    # Assume to support by day eventually
+    # daily downloads are in daily_downloads and summed into these rows
     download_date = Column(u'download_date', Date, primary_key=True)
     download_count = Column(u'download_count', Integer)
+    # set when the count is the sum of daily_downloads rather than the
+    # total of a monthly report
+    from_days = Column(u'from_days', Boolean)
 
     def __repr__(self):
         return "<Download('{0} {1}')>".format(self.download_date,
                                               self.download_count)
 
 
+class DailyDownload(Base):
+    """Daily downloads for articles, see daily
+
+    day is a small integer calendar key rather than a date.  There is no
+    foreign key because MySQL cannot partition a table that has one."""
+    __tablename__ = 'daily_downloads'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    article_id = Column(u'article_id', Integer, primary_key=True,
+                        autoincrement=False)
+    day = Column(u'day', SmallInteger, primary_key=True, autoincrement=False)
+    download_count = Column(u'download_count', Integer)
+
+    def __repr__(self):
+        return "<DailyDownload('{0} {1} {2}')>".format(
+            self.article_id, self.day, self.download_count)
+
+
+class ArticleDownloadTotal(Base):
+    """Lifetime download total per article, see rollups"""
+    __tablename__ = 'article_download_totals'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    article_id = Column(u'article_id',
+                        Integer,
+                        ForeignKey('articles.id',
+                                   ondelete='CASCADE',
+                                   onupdate='CASCADE'),
+                        primary_key=True, autoincrement=False)
+    download_count = Column(u'download_count', Integer, index=True)
+
+    def __repr__(self):
+        return "<ArticleDownloadTotal('{0} {1}')>".format(
+            self.article_id, self.download_count)
+
+
+class ArticleYearDownloads(Base):
+    """Yearly downloads per article, see rollups"""
+    __tablename__ = 'article_year_downloads'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    article_id = Column(u'article_id',
+                        Integer,
+                        ForeignKey('articles.id',
+                                   ondelete='CASCADE',
+                                   onupdate='CASCADE'),
+                        primary_key=True, autoincrement=False)
+    year = Column(u'year', Integer, primary_key=True, autoincrement=False)
+    download_count = Column(u'download_count', Integer)
+
+    def __repr__(self):
+        return "<ArticleYearDownloads('{0} {1} {2}')>".format(
+            self.article_id, self.year, self.download_count)
+
+
+class AuthorDownloadTotal(Base):
+    """Lifetime download total per author, see rollups"""
+    __tablename__ = 'author_download_totals'
+    # derived: migrate recreates it when its primary key changes
+    __table_args__ = {'mysql_engine': 'InnoDB', 'info': {'derived': True}}
+
+    author_id = Column(u'author_id',
+                       Integer,
+                       ForeignKey('authors.id',
+                                  ondelete='CASCADE',
+                                  onupdate='CASCADE'),
+                       primary_key=True, autoincrement=False)
+    download_count = Column(u'download_count', Integer, index=True)
+
+    def __repr__(self):
+        return "<AuthorDownloadTotal('{0} {1}')>".format(
+            self.author_id, self.download_count)
+
+
+class AuthorMonthDownloads(Base):
+    """Monthly downloads per author, see rollups"""
+    __tablename__ = 'author_month_downloads'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'info': {'derived': True}}
+
+    author_id = Column(u'author_id',
+                       Integer,
+                       ForeignKey('authors.id',
+                                  ondelete='CASCADE',
+                                  onupdate='CASCADE'),
+                       primary_key=True, autoincrement=False)
+    download_date = Column(u'download_date', Date, primary_key=True)
+    download_count = Column(u'download_count', Integer)
+
+    def __repr__(self):
+        return "<AuthorMonthDownloads('{0} {1} {2}')>".format(
+            self.author_id, self.download_date, self.download_count)
+
+
+class ContextMonthDownloads(Base):
+    """Monthly downloads per publication context, see rollups"""
+    __tablename__ = 'context_month_downloads'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    context = Column(u'context', Unicode(64), primary_key=True)
+    download_date = Column(u'download_date', Date, primary_key=True)
+    download_count = Column(u'download_count', Integer)
+
+    def __repr__(self):
+        return "<ContextMonthDownloads('{0} {1} {2}')>".format(
+            self.context, self.download_date, self.download_count)
+
+
 class Subject(Base):
     """Subject class for articles"""
     __tablename__ = 'subjects'
@@ -200,6 +373,54 @@ class Discipline(Base):
         return "<Discipline('%s')>" % (self.term,)
 
 
+class SearchPosting(Base):
+    """Field weighted frequency of a search term in an article, see
+    search"""
+    __tablename__ = 'search_postings'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    term = Column(u'term', Unicode(64), primary_key=True)
+    article_id = Column(u'article_id',
+                        Integer,
+                        ForeignKey('articles.id',
+                                   ondelete='CASCADE',
+                                   onupdate='CASCADE'),
+                        primary_key=True, autoincrement=False, index=True)
+    frequency = Column(u'frequency', Integer, nullable=False)
+
+    def __repr__(self):
+        return "<SearchPosting('{0} {1} {2}')>".format(
+            self.term, self.article_id, self.frequency)
+
+
+class DatasetVersion(Base):
+    """Version stamp bumped by the loaders after a successful run"""
+    __tablename__ = 'dataset_version'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(u'id', Integer, primary_key=True, autoincrement=False)
+    version = Column(u'version', Integer, nullable=False)
+    updated = Column(u'updated', DateTime)
+
+    def __repr__(self):
+        return "<DatasetVersion('{0} {1}')>".format(self.version,
+                                                    self.updated)
+
+
+class ReportLoad(Base):
+    """Content hash of a report url at its last successful load into this
+    database"""
+    __tablename__ = 'report_loads'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    url = Column(u'url', Unicode(191), primary_key=True)
+    sha256 = Column(u'sha256', Unicode(64), nullable=False)
+    loaded = Column(u'loaded', DateTime)
+
+    def __repr__(self):
+        return "<ReportLoad('{0} {1}')>".format(self.url, self.sha256)
+
+
 class Pagination(object):
     """Pagination object"""
     def __init__(self, page, per_page, total_count):
@@ -237,26 +458,483 @@ class Pagination(object):
                 last = num
 
 
-def get_engine():
-    """Return an sqlalchemy engine"""
-    config_file = ConfigParser.ConfigParser()
+def encode_cursor(values):
+    """Return an opaque url safe token for a list of cursor values"""
+    encoded = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = {'datetime': value.isoformat()}
+        elif isinstance(value, date):
+            value = {'date': value.isoformat()}
+        encoded.append(value)
+    return base64.urlsafe_b64encode(json.dumps(encoded))
+
+
+def decode_cursor(token):
+    """Return the cursor values of a token, raising ValueError if invalid"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != 4:
+        raise ValueError("Invalid cursor")
+    decoded = []
+    for value in values:
+        if isinstance(value, dict) and 'datetime' in value:
+            value = datetime.strptime(value['datetime'][:19],
+                                      '%Y-%m-%dT%H:%M:%S')
+        elif isinstance(value, dict) and 'date' in value:
+            value = datetime.strptime(value['date'], '%Y-%m-%d').date()
+        decoded.append(value)
+    return decoded
+
+
+class KeysetPagination(Pagination):
+    """Keyset pagination object
+
+    Pages a query by (sort_column, id_column) from an opaque cursor instead
+    of an OFFSET, so a deep page costs the same as the first one.  The
+    sort column must not be NULL.  total_count is optional and only used
+    by pages and iter_pages, see cached_count."""
+    def __init__(self, query, sort_column, id_column, per_page,
+                 cursor=None, total_count=None, descending=False,
+                 session=None):
+        page = 1
+        direction = 'next'
+        key = None
+        if cursor:
+            (direction, sort_value, id_value, page) = decode_cursor(cursor)
+            key = (sort_value, id_value)
+        super(KeysetPagination, self).__init__(page, per_page, total_count)
+        self.sort_column = sort_column
+        self.id_column = id_column
+        self.descending = descending
+        self.session = session
+        backwards = direction == 'prev'
+        unpaged = query
+        if key is not None:
+            query = query.filter(self.after(key, descending != backwards))
+        if descending != backwards:
+            query = query.order_by(sort_column.desc(), id_column.desc())
+        else:
+            query = query.order_by(sort_column, id_column)
+        rows = self.fetch(query.limit(per_page + 1))
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+            self._has_prev = more
+            # the rows of the page the cursor came from may be gone, so
+            # probe for one past this page like the forward limit + 1
+            self._has_next = bool(rows) and bool(self.fetch(
+                unpaged.filter(self.after(self.key(rows[-1]), descending)).
+                limit(1)))
+        else:
+            self._has_prev = key is not None
+            self._has_next = more
+        self.items = rows
+
+    def fetch(self, query):
+        """Return the rows of a query, or of a select with a session"""
+        if self.session is None:
+            return query.all()
+        return self.session.execute(query).fetchall()
+
+    def after(self, key, descending):
+        """Return the condition selecting rows past key"""
+        (sort_value, id_value) = key
+        if descending:
+            return or_(self.sort_column < sort_value,
+                       and_(self.sort_column == sort_value,
+                            self.id_column < id_value))
+        return or_(self.sort_column > sort_value,
+                   and_(self.sort_column == sort_value,
+                        self.id_column > id_value))
+
+    def key(self, item):
+        """Return the (sort, id) values of a result row"""
+        return (getattr(item, self.sort_column.key),
+                getattr(item, self.id_column.key))
+
+    @property
+    def has_prev(self):
+        """Return boolean"""
+        return self._has_prev
+
+    @property
+    def has_next(self):
+        """Return boolean"""
+        return self._has_next
+
+    @property
+    def pages(self):
+        """Return the number of pages, or None without a total_count"""
+        if self.total_count is None:
+            return None
+        return super(KeysetPagination, self).pages
+
+    @property
+    def next_cursor(self):
+        """Return the cursor of the following page, or None"""
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(['next'] + list(self.key(self.items[-1])) +
+                             [self.page + 1])
+
+    @property
+    def prev_cursor(self):
+        """Return the cursor of the preceding page, or None"""
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor(['prev'] + list(self.key(self.items[0])) +
+                             [max(self.page - 1, 1)])
+
+
+_counts = {}
+
+
+def cached_count(session, query, name, ttl=300):
+    """Return the row count of query, cached under name for ttl seconds"""
+    now = time.time()
+    cached = _counts.get(name)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1]
+    if hasattr(query, 'count'):
+        count = query.order_by(None).count()
+    else:
+        count = session.execute(select([func.count()]).
+                                select_from(query.order_by(None).
+                                            subquery())).scalar()
+    _counts[name] = (now, count)
+    return count
+
+
+def approximate_count(session, table):
+    """Return the estimated row count of a table
+
+    MySQL answers from the table statistics without scanning; other
+    databases fall back to a cached COUNT(*)."""
+    if session.bind.dialect.name == 'mysql':
+        count = session.execute(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name",
+            {'name': table.name}).scalar()
+        if count is not None:
+            return int(count)
+    return cached_count(session, session.query(table), table.name)
+
+
+def config_path():
+    """Return the configuration file, REPOSITORY_METRICS_CONFIG if set"""
     directory = os.path.dirname(os.path.realpath(__file__))
-    config_file.read(os.path.join(directory, 'repository-metrics.cfg'))
-    engine = create_engine(config_file.get("sqlalchemy", "dsn"),
-                           echo=config_file.getboolean("sqlalchemy", "echo"),
-                           pool_recycle=3600)
+    return os.environ.get('REPOSITORY_METRICS_CONFIG',
+                          os.path.join(directory, 'repository-metrics.cfg'))
+
+
+# engines, scoped sessions and pool metrics of this process, by dsn
+_engines = {}
+_sessions = {}
+_metrics = {}
+_configs = {}
+_pid = os.getpid()
+# SELECT time limit in ms of the engines created, see limit_statements
+_statement_timeout = None
+
+# [sqlalchemy] pool options and the ConfigParser method reading each
+POOL_OPTIONS = [('pool_size', 'getint'),
+                ('max_overflow', 'getint'),
+                ('pool_timeout', 'getfloat'),
+                ('pool_recycle', 'getint'),
+                ('pool_pre_ping', 'getboolean')]
+
+
+def read_config():
+    """Return the parsed configuration file, read once per process"""
+    path = config_path()
+    config_file = _configs.get(path)
+    if config_file is None:
+        config_file = ConfigParser.ConfigParser()
+        config_file.read(path)
+        _configs[path] = config_file
+    return config_file
+
+
+def engine_options(config_file):
+    """Return the create_engine arguments of the configuration
+
+    Only the pool options present are passed, so a SQLite database keeps
+    its default pool."""
+    options = {'echo': config_file.getboolean("sqlalchemy", "echo"),
+               'pool_recycle': 3600}
+    for (name, method) in POOL_OPTIONS:
+        if config_file.has_option("sqlalchemy", name):
+            options[name] = getattr(config_file, method)("sqlalchemy", name)
+    return options
+
+
+class PoolMetrics(object):
+    """Checkout counters and wait times of an engine's pool"""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear the counters"""
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidated = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+
+    def add(self, name, value=1):
+        """Increment a counter"""
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def waited(self, seconds):
+        """Record the time a checkout waited for a connection"""
+        with self.lock:
+            self.wait_seconds += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def stats(self):
+        """Return the counters as a dict"""
+        with self.lock:
+            return {'connects': self.connects,
+                    'checkouts': self.checkouts,
+                    'invalidated': self.invalidated,
+                    'timeouts': self.timeouts,
+                    'wait_seconds': round(self.wait_seconds, 6),
+                    'max_wait': round(self.max_wait, 6)}
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool timing how long each checkout waits for a connection"""
+    metrics = None
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.metrics.add('timeouts')
+            raise
+        finally:
+            self.metrics.waited(time.time() - started)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.metrics = self.metrics
+        return pool
+
+
+def set_statement_timeout(engine, milliseconds):
+    """Limit the execution time of the SELECTs of every new connection
+
+    Only MySQL (max_execution_time) is supported."""
+    if engine.dialect.name != 'mysql':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET SESSION max_execution_time = {0}".format(
+            int(milliseconds)))
+        cursor.close()
+
+
+def limit_statements(milliseconds):
+    """Limit the SELECTs of the engines this process creates from now on
+
+    Only the API sets a limit: exports, rollup rebuilds, snapshots and the
+    loaders run SELECTs that legitimately take minutes."""
+    global _statement_timeout
+    _statement_timeout = milliseconds
+
+
+def watch_pool(engine, metrics):
+    """Count the connections, checkouts and invalidations of an engine
+
+    A connection made by another process is invalidated at checkout
+    instead of being shared with it."""
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+        metrics.add('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.add('checkouts')
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.dbapi_connection = \
+                connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError("connection belongs to process " +
+                                         "{0}".format(
+                                             connection_record.info['pid']))
+
+    @event.listens_for(engine, 'invalidate')
+    def invalidate(dbapi_connection, connection_record, exception):
+        metrics.add('invalidated')
+
+
+def after_fork():
+    """Forget the engines and sessions inherited from the parent process
+
+    The pools are dropped without closing their connections, which still
+    belong to the parent; the child opens its own on first use."""
+    global _pid
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    for metrics in _metrics.values():
+        metrics.reset()
+    _sessions.clear()
+    _pid = os.getpid()
+
+
+def get_engine(dsn=None):
+    """Return the sqlalchemy engine of dsn, by default the configured one
+
+    Engines are created once per process and dsn with the pool options
+    of the configuration file and the limit_statements limit."""
+    if os.getpid() != _pid:
+        after_fork()
+    config_file = read_config()
+    if dsn is None:
+        dsn = config_file.get("sqlalchemy", "dsn")
+    engine = _engines.get(dsn)
+    if engine is not None:
+        return engine
+    options = engine_options(config_file)
+    metrics = PoolMetrics()
+    if make_url(dsn).get_backend_name() != 'sqlite':
+        options['poolclass'] = TimedQueuePool
+    engine = create_engine(dsn, **options)
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.metrics = metrics
+    watch_pool(engine, metrics)
+    if _statement_timeout:
+        set_statement_timeout(engine, _statement_timeout)
+    _engines[dsn] = engine
+    _metrics[dsn] = metrics
     return engine
 
 
-def get_session():
-    """Return a scoped session"""
-    engine = get_engine()
-    session = scoped_session(sessionmaker(autocommit=False,
-                                          autoflush=False,
-                                          bind=engine))
+def get_session(dsn=None):
+    """Return the scoped session of dsn, by default the configured one"""
+    engine = get_engine(dsn)
+    session = _sessions.get(engine)
+    if session is None:
+        session = scoped_session(sessionmaker(autocommit=False,
+                                              autoflush=False,
+                                              bind=engine))
+        _sessions[engine] = session
     return session
 
 
+def dispose_engines():
+    """Close the pooled connections of every engine"""
+    for engine in _engines.values():
+        engine.dispose()
+
+
+def pool_metrics():
+    """Return the pool status and checkout metrics of every engine"""
+    result = []
+    for (dsn, engine) in _engines.items():
+        pool = engine.pool
+        stats = {'dsn': repr(engine.url),
+                 'pool': type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            stats.update({'size': pool.size(),
+                          'checked_in': pool.checkedin(),
+                          'checked_out': pool.checkedout(),
+                          'overflow': pool.overflow()})
+        stats.update(_metrics[dsn].stats())
+        result.append(stats)
+    return sorted(result, key=lambda stats: stats['dsn'])
+
+
+def get_dataset_version(session):
+    """Return the current dataset version stamp"""
+    return session.query(DatasetVersion.version).\
+        filter(DatasetVersion.id == 1).scalar() or 0
+
+
+def bump_dataset_version(session):
+    """Increment the dataset version stamp and commit"""
+    updated = session.query(DatasetVersion).\
+        filter(DatasetVersion.id == 1).\
+        update({DatasetVersion.version: DatasetVersion.version + 1,
+                DatasetVersion.updated: datetime.now()},
+               synchronize_session=False)
+    if not updated:
+        session.add(DatasetVersion(id=1, version=1, updated=datetime.now()))
+    session.commit()
+    return get_dataset_version(session)
+
+
+def get_report_loads(session):
+    """Return {url: hash} of the reports last loaded into the database, or
+    None when report_loads does not exist yet (before --migrate)"""
+    if not inspect(session.get_bind()).has_table(ReportLoad.__tablename__):
+        return None
+    return dict(session.query(ReportLoad.url, ReportLoad.sha256))
+
+
+def record_report_loads(session, digests):
+    """Record {url: hash} of successfully loaded reports and commit"""
+    loaded = datetime.now()
+    bulk_upsert(session, ReportLoad.__table__,
+                [{'url': unicode(url), 'sha256': unicode(digest),
+                  'loaded': loaded} for (url, digest) in digests.items()],
+                ['url'])
+    session.commit()
+
+
+def bulk_upsert(session, table, rows, index_elements, update_columns=None):
+    """Insert rows into table, updating the rows that already exist
+
+    index_elements are the columns of the primary or unique key used to
+    detect an existing row.  update_columns defaults to every other column
+    present in a row.  Consecutive rows sharing a key set are written with
+    a single executemany, so rows are inserted in the order given."""
+    dialect = session.get_bind().dialect.name
+    groups = []
+    for row in rows:
+        keys = tuple(sorted(row))
+        if not groups or groups[-1][0] != keys:
+            groups.append((keys, []))
+        groups[-1][1].append(row)
+    for keys, group in groups:
+        if update_columns is None:
+            columns = [key for key in keys if key not in index_elements]
+        else:
+            columns = [key for key in update_columns if key in keys]
+        if dialect == 'mysql':
+            statement = mysql_insert(table)
+            if not columns:
+                columns = index_elements[:1]
+            statement = statement.on_duplicate_key_update(
+                dict((column, statement.inserted[column])
+                     for column in columns))
+        elif dialect == 'sqlite':
+            statement = sqlite_insert(table)
+            if columns:
+                statement = statement.on_conflict_do_update(
+                    index_elements=index_elements,
+                    set_=dict((column, statement.excluded[column])
+                              for column in columns))
+            else:
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=index_elements)
+        else:
+            raise ValueError("bulk_upsert does not support the " +
+                             "{0} dialect".format(dialect))
+        session.execute(statement, group)
+    return len(rows)
+
+
 def test():
     """Small testing framework"""
     print("Testing...")
@@ -294,283 +972,34 @@ def test():
     """
 
 
-def generate_author_month_csv(output):
-    """Generate csv for pivot"""
-    session = get_session()
-    print("making query")
-
-    count = session.query(Article, Creator, Download).\
-        filter(Creator.email != None).\
-        filter(Article.id == Creator.article_id).\
-        filter(Article.id == Download.article_id).\
-        filter(Download.download_count > 0).count()
-    print("rows: {0}".format(count))
-    query = session.query(Article, Creator, Download).\
-        filter(Creator.email != None).\
-        filter(Article.id == Creator.article_id).\
-        filter(Article.id == Download.article_id).\
-        filter(Download.download_count > 0).yield_per(10000)
-    fieldnames = ['email', 'creator', 'article_id', 'title', 'publication',
-                  'publication_date', 'deposit_date', 'document_type',
-                  'article_url', 'download_date', 'download_count']
-    csvwriter = unicodecsv.DictWriter(open(output, 'wb'),
-                                      fieldnames=fieldnames)
-    csvwriter.writeheader()
-    i = 0
-    for (article, creator, download) in query:
-        i += 1
-        row = {}
-        row['creator'] = creator.name
-        row['article_id'] = article.id
-        row['publication'] = article.publication
-        row['publication_date'] = article.date
-        row['deposit_date'] = article.submission_date
-        row['email'] = creator.email
-        row['title'] = article.title.strip()
-        row['document_type'] = article.document_type
-        row['article_url'] = article.article_url
-        row['download_date'] = download.download_date
-        row['download_count'] = download.download_count
-        csvwriter.writerow(row)
-        if i % 10000 == 0:
-            print("writing row {0}".format(i))
-
-
-def generate_articles_by_author_csv(output):
-    session = get_session()
-    print("making query")
-    query = session.query(Creator).\
-        filter(Creator.article_id == Article.id).yield_per(10000)
-    fieldnames = ['email', 'creator', 'article_id', 'title', 'publication',
-                  'publication_date', 'deposit_date', 'document_type',
-                  'article_url', 'byline', 'constant']
-    csvwriter = unicodecsv.DictWriter(open(output, 'wb'),
-                                      fieldnames=fieldnames)
-    csvwriter.writeheader()
-    i = 0
-    for creator in query:
-        i += 1
-        row = {}
-        article = creator.article
-        row['creator'] = creator.name
-        row['article_id'] = article.id
-        if article.publication:
-            row['publication'] = article.publication.strip()
-        row['publication_date'] = article.date
-        row['deposit_date'] = article.submission_date
-        row['email'] = creator.email
-        row['title'] = article.title.strip()
-        row['document_type'] = article.document_type
-        row['article_url'] = article.article_url
-        row['byline'] = article.byline
-        csvwriter.writerow(row)
-        if i % 1000 == 0:
-            print("writing row {0}".format(i))
-
-
-def generate_articles_month_csv(output):
-    """Generate a table of one row per article/month downloads"""
-    session = get_session()
-    print("making query")
-    fieldnames = ['article_id', 'download_date', 'title', 'byline',
-                  'publication', 'publication_date', 'publication_year',
-                  'deposit_date', 'document_type', 'context',
-                  'article_url', 'has_faculty', 'download_count' ]
-
-    csvwriter = unicodecsv.DictWriter(open(output, 'wb'),
-                                      fieldnames=fieldnames)
-    csvwriter.writeheader()
-    query = session.query(Article).yield_per(100)
-    i = 0
-    for article in query:
-        for download in article.downloads:
-            row = {}
-            i += 1
-            row['article_id'] = article.id
-            row['download_date'] = download.download_date
-            row['title'] = article.title.strip()
-            row['byline'] = article.byline
-            if article.publication:
-                row['publication'] = article.publication.strip()
-            row['publication_date'] = article.date
-            row['publication_year'] = article.date.year
-            row['deposit_date'] = article.submission_date
-            row['document_type'] = article.document_type
-
-            # oai:scholarship.law.duke.edu:faculty_scholarship-5781
-            context_re = re.compile('oai:scholarship.law.duke.edu' +
-                                    ':([a-z_]+)-\d+')
-            context_search = context_re.search(article.oai_identifier)
-            if context_search:
-                row['context'] = context_search.group(1)
-            row['article_url'] = article.article_url
-            row['has_faculty'] = article.has_email
-            row['download_count'] = download.download_count
-            csvwriter.writerow(row)
-            if i % 1000 == 0:
-                print("writing row {0}".format(i))
-
-
-def generate_articles_csv(output):
-    """Generate a table of article metadata"""
-    session = get_session()
-    print("making query")
-    fieldnames = ['article_id', 'title', 'byline',
-                  'publication', 'publication_date', 'publication_year',
-                  'deposit_date', 'document_type', 'context',
-                  'article_url', 'has_faculty']
-
-    csvwriter = unicodecsv.DictWriter(open(output, 'wb'),
-                                      fieldnames=fieldnames)
-    csvwriter.writeheader()
-    query = session.query(Article).yield_per(1000)
-    i = 0
-    for article in query:
-        row = {}
-        i += 1
-        row['article_id'] = article.id
-        row['title'] = article.title.strip()
-        row['byline'] = article.byline
-        if article.publication:
-            row['publication'] = article.publication.strip()
-        row['publication_date'] = article.date
-        if article.date:
-            row['publication_year'] = article.date.year
-        row['deposit_date'] = article.submission_date
-        row['document_type'] = article.document_type
-
-        # oai:scholarship.law.duke.edu:faculty_scholarship-5781
-        context_re = re.compile('oai:scholarship.law.duke.edu:([a-z_]+)-\d+')
-        context_search = context_re.search(article.oai_identifier)
-        if context_search:
-            row['context'] = context_search.group(1)
-        row['article_url'] = article.article_url
-        row['has_faculty'] = article.has_email
-        csvwriter.writerow(row)
-        if i % 1000 == 0:
-            print("writing row {0}".format(i))
-
-
-def generate_faculty_scholarship_csv(output):
-    """Generate a grouped view of faculty publications"""
+def article_context(oai_identifier):
+    """Return the publication context of an oai identifier"""
+    context_search = CONTEXT_RE.search(oai_identifier)
+    if context_search:
+        return context_search.group(1)
+    return None
+
+
+def backfill_derived(batch_size=1000):
+    """Recompute the derived article columns for every article"""
     session = get_session()
-    print("making query")
-    fieldnames = ['article_id', 'download_date', 'title', 'byline',
-                  'publication', 'publication_date', 'publication_year',
-                  'deposit_date', 'document_type', 'context',
-                  'article_url', 'has_faculty', 'download_count']
-
-    csvwriter = unicodecsv.DictWriter(open(output, 'wb'),
-                                      fieldnames=fieldnames)
-    csvwriter.writeheader()
-    faculty_scholarship = session.query(Article).\
-        filter(Article.oai_identifier.like(u'%faculty_scholarship%')).\
-        yield_per(100)
+    last_id = 0
     i = 0
-    j = 0
-    seen_journal_articles = {}
-    for article in faculty_scholarship:
-        j += 1
-        if j % 100 == 0:
-            print("Starting article {0}: {1}".format(j, article.article_url))
-        for download in article.downloads:
-            row = {}
-            i += 1
-            # source_fulltext_url
-            row['article_id'] = article.id
-            row['title'] = article.title.strip()
-            row['byline'] = article.byline
-            if article.publication:
-                row['publication'] = article.publication.strip()
-            row['publication_date'] = article.date
-            if article.date:
-                row['publication_year'] = article.date.year
-            row['deposit_date'] = article.submission_date
-            row['document_type'] = article.document_type
-
-            # oai:scholarship.law.duke.edu:faculty_scholarship-5781
-            context_re = re.compile('oai:scholarship.law.duke.edu' +
-                                    ':([a-z_]+)-\d+')
-            context_search = context_re.search(article.oai_identifier)
-            if context_search:
-                row['context'] = context_search.group(1)
-            row['article_url'] = article.article_url
-            row['has_faculty'] = article.has_email
-            row['download_date'] = download.download_date
-            download_count = download.download_count
-            if article.source_fulltext_url:
-                seen_journal_articles[article.source_fulltext_url] = True
-                try:
-                    journal_download_count = session.query(Download
-                                                           .download_count).\
-                        filter(Article.pdf_url ==
-                               article.source_fulltext_url).\
-                        filter(Download.article_id == Article.id).\
-                        filter(Download.download_date ==
-                               download.download_date).\
-                        scalar()
-                    if journal_download_count:
-                        download_count += journal_download_count
-                except Exception as e:
-                    print(e.msg)
-            row['download_count'] = download_count
-            csvwriter.writerow(row)
-            if i % 1000 == 0:
-                print("writing row {0}".format(i))
-    print("Starting non_faculty")
-    not_faculty_scholarship = session.query(Article).\
-        filter(Article.oai_identifier.notlike(u'%faculty_scholarship%')).\
-        filter(Article.id == Creator.article_id).\
-        filter(Creator.email.contains('@')).\
-        yield_per(100)
-    for article in not_faculty_scholarship:
-        j += 1
-        if article.pdf_url in seen_journal_articles:
-            print("Skipping: {0}".format(article.oai_identifier))
-            continue
-        if j % 100 == 0:
-            print("Starting article {0}: {1}".format(j, article.article_url))
-        for download in article.downloads:
-            row = {}
-            i += 1
-            # source_fulltext_url
-            row['article_id'] = article.id
-            row['title'] = article.title.strip()
-            row['byline'] = article.byline
-            if article.publication:
-                row['publication'] = article.publication.strip()
-            row['publication_date'] = article.date
-            if article.date:
-                row['publication_year'] = article.date.year
-            row['deposit_date'] = article.submission_date
-            row['document_type'] = article.document_type
-
-            # oai:scholarship.law.duke.edu:faculty_scholarship-5781
-            context_re = re.compile('oai:scholarship.law.duke.edu' +
-                                    ':([a-z_]+)-\d+')
-            context_search = context_re.search(article.oai_identifier)
-            if context_search:
-                row['context'] = context_search.group(1)
-            row['article_url'] = article.article_url
-            row['has_faculty'] = article.has_email
-            row['download_date'] = download.download_date
-            download_count = download.download_count
-            if article.source_fulltext_url:
-                seen_journal_articles[article.source_fulltext_url] = True
-                try:
-                    journal_download_count = session.query(Download.download_count).\
-                        filter(Article.pdf_url == article.source_fulltext_url).\
-                        filter(Download.article_id == Article.id).\
-                        filter(Download.download_date == download.download_date).\
-                        scalar()
-                    if journal_download_count:
-                        download_count += journal_download_count
-                except Exception as e:
-                    print(e.msg)
-            row['download_count'] = download_count
-            csvwriter.writerow(row)
-            if i % 1000 == 0:
-                print("writing row {0}".format(i))
+    while True:
+        articles = session.query(Article).\
+            filter(Article.id > last_id).\
+            order_by(Article.id).\
+            options(selectinload(Article.creators)).\
+            limit(batch_size).all()
+        if not articles:
+            break
+        for article in articles:
+            article.refresh_derived()
+        last_id = articles[-1].id
+        session.commit()
+        session.expunge_all()
+        i += len(articles)
+        print("updated article {0}".format(i))
 
 
 def create_tables():
@@ -585,8 +1014,12 @@ def drop_tables():
     engine = get_engine()
     conn = engine.connect()
     database = conn.begin()
-    tablenames = ['articles', 'creators', 'subjects', 'downloads',
-                  'disciplines']
+    tablenames = ['articles', 'creators', 'authors', 'subjects',
+                  'downloads', 'disciplines', 'article_download_totals',
+                  'author_download_totals', 'author_month_downloads',
+                  'context_month_downloads',
+                  'article_year_downloads', 'daily_downloads',
+                  'search_postings', 'report_loads', 'dataset_version']
     try:
         conn.execute("SET foreign_key_checks = 0")
         database.commit()
@@ -603,21 +1036,78 @@ def drop_tables():
     return 1
 
 
+def run_export(name, args):
+    """Write one of the reports of the export module"""
+    import export
+    if name not in export.REPORTS:
+        sys.exit("Unknown report {0}, one of: {1}".format(
+            name, ", ".join(sorted(export.REPORTS))))
+    try:
+        export.export(export.REPORTS[name], args.output,
+                      workers=args.workers, format=args.format,
+                      compression=args.compress)
+    except export.ExportError as e:
+        sys.exit(str(e))
+
+
 def main(args):
     if args.droptables:
         drop_tables()
     elif args.createtables:
         create_tables()
     elif args.generate:
-        generate_author_month_csv(args.output)
+        run_export('author_month', args)
     elif args.authors:
-        generate_articles_by_author_csv(args.output)
+        run_export('articles_by_author', args)
     elif args.articles:
-        generate_articles_month_csv(args.output)
+        run_export('articles_month', args)
     elif args.article_summary:
-        generate_articles_csv(args.output)
+        run_export('articles', args)
     elif args.faculty:
-        generate_faculty_scholarship_csv(args.output)
+        run_export('faculty', args)
+    elif args.report:
+        run_export(args.report, args)
+    elif args.backfill:
+        backfill_derived()
+    elif args.link_authors:
+        import authors
+        session = get_session()
+        authors.link(session)
+        bump_dataset_version(session)
+    elif args.rebuild_search:
+        import search
+        session = get_session()
+        search.rebuild(session)
+        bump_dataset_version(session)
+    elif args.rebuild_rollups:
+        import rollups
+        session = get_session()
+        rollups.rebuild(session)
+        bump_dataset_version(session)
+    elif args.check_rollups:
+        import rollups
+        if rollups.check(get_session()):
+            sys.exit(1)
+    elif args.leaderboard:
+        import rollups
+        for (author_id, name, email, count) in \
+                rollups.author_leaderboard(get_session()):
+            print(u"{0}\t{1}\t{2}\t{3}".format(
+                author_id, name, email or u"", count).encode('utf-8'))
+    elif args.snapshot:
+        import matrix
+        matrix.build(get_session(), args.matrix)
+    elif args.pivot:
+        import matrix
+        snapshot = matrix.Snapshot(args.matrix)
+        matrix.warn_if_stale(snapshot, get_session())
+        matrix.write_pivot(snapshot, args.output, by=args.pivot)
+    elif args.migrate:
+        import migrate
+        migrate.migrate(get_engine(), Base.metadata, dry_run=args.dry_run)
+    elif args.explain:
+        import migrate
+        migrate.explain(get_engine())
 
     elif args.test:
         test()
@@ -651,11 +1141,64 @@ def parse_arguments():
                         action="store_true")
     parser.add_argument("-F", "--faculty", help="Article centered faculty csv",
                         action="store_true")
+    parser.add_argument("-m", "--migrate", help="Add missing tables, " +
+                        "columns and indexes and compact column types",
+                        action="store_true")
+    parser.add_argument("-n", "--dry-run", help="Print the migration " +
+                        "steps without applying them", action="store_true")
+    parser.add_argument("-x", "--explain", help="Print query plans for " +
+                        "the hot queries", action="store_true")
+    parser.add_argument("--link-authors", help="Link every creator to " +
+                        "its author, adding the missing authors",
+                        action="store_true")
+    parser.add_argument("--rebuild-search", help="Rebuild the search " +
+                        "postings of every article", action="store_true")
+    parser.add_argument("--rebuild-rollups", help="Rebuild the " +
+                        "download rollup tables", action="store_true")
+    parser.add_argument("--check-rollups", help="Compare the download " +
+                        "rollup tables with the downloads",
+                        action="store_true")
+    parser.add_argument("-l", "--leaderboard", help="Print authors by " +
+                        "total downloads", action="store_true")
+    parser.add_argument("-b", "--backfill", help="Recompute article " +
+                        "byline, context and has_faculty columns",
+                        action="store_true")
+    parser.add_argument("--snapshot", help="Write the article x month " +
+                        "download matrix snapshot", action="store_true")
+    parser.add_argument("--pivot", help="Write monthly downloads per " +
+                        "article, author or context from the snapshot",
+                        choices=['article', 'author', 'context'])
+    parser.add_argument("--matrix", help="Snapshot directory",
+                        default="download_matrix")
     parser.add_argument("-o", "--output", help="Output filename",
                         default="/vagrant/output.csv")
+    parser.add_argument("--profile", help="Print phase times, rows/sec, " +
+                        "peak memory and query count as JSON",
+                        action="store_true")
+    parser.add_argument("--profile-output", help="Write the --profile " +
+                        "JSON to this file", default="-")
+    parser.add_argument("--pstats", help="Dump a cProfile of the run to " +
+                        "this file")
+    parser.add_argument("-r", "--report", help="Export the named report")
+    parser.add_argument("-w", "--workers", help="Export worker processes",
+                        type=int, default=1)
+    parser.add_argument("--format", help="Export format, by default tsv " +
+                        "for a .tsv output and csv otherwise",
+                        choices=['csv', 'tsv'])
+    parser.add_argument("--compress", help="Compress the export, by " +
+                        "default for a .gz or .zst output",
+                        choices=['gzip', 'zstd'])
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_arguments()
-    main(args)
+    if args.profile or args.pstats:
+        import profiling
+        profiling.start('model.py', pstats=args.pstats)
+        try:
+            main(args)
+        finally:
+            profiling.finish(args.profile_output)
+    else:
+        main(args)
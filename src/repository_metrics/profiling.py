@@ -0,0 +1,217 @@
+"""Phase timing for the command line tools
+
+A run started with start() attributes wall time to named phases such as
+fetch, parse, query, hydrate and write.  Phases nest and time is charged
+to the innermost one only, so the SQL executed while hydrating ORM objects
+is counted as query and not as hydrate.  Every statement executed on any
+engine is counted and timed as query.  finish() prints or writes a JSON
+summary with rows/sec and peak RSS, and with pstats also dumps a cProfile
+of the run.
+
+Export worker processes report their phases back to the parent, where
+they are summed, so phase totals may exceed the elapsed time.  Every
+helper is a no-op when no run was started."""
+import cProfile
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+current = None
+
+
+class Profile(object):
+    """Phase times and counters of one run"""
+    def __init__(self, command, pstats=None):
+        self.command = command
+        self.pstats = pstats
+        self.thread = threading.current_thread()
+        self.started = time.time()
+        self.reset()
+        self.profiler = None
+        if pstats:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def reset(self):
+        """Clear the phase times and counters"""
+        self.phases = {}
+        self.stack = []
+        self.mark = time.time()
+        self.rows = 0
+        self.queries = 0
+
+    def charge(self, now):
+        """Add the time since the last switch to the current phase"""
+        if self.stack:
+            name = self.stack[-1]
+            self.phases[name] = self.phases.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+    def enter(self, name):
+        """Start charging time to phase name"""
+        self.charge(time.time())
+        self.stack.append(name)
+
+    def leave(self):
+        """Go back to charging the enclosing phase"""
+        self.charge(time.time())
+        self.stack.pop()
+
+    def summary(self):
+        """Return the JSON summary of the run"""
+        elapsed = time.time() - self.started
+        own = peak_rss_kb()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return {'command': self.command,
+                'elapsed': round(elapsed, 3),
+                'phases': dict((name, round(seconds, 3))
+                               for (name, seconds) in self.phases.items()),
+                'rows': self.rows,
+                'rows_per_sec': round(self.rows / max(elapsed, 0.001), 1),
+                'queries': self.queries,
+                'peak_rss_kb': max(own, children)}
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in kB
+
+    VmHWM of /proc/self/status is read where available: ru_maxrss is kept
+    across exec, so a command started by a larger process would report
+    its parent's peak."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def active():
+    """Return the current Profile when called from the thread that
+    started it, otherwise None"""
+    if current is not None and \
+            threading.current_thread() is current.thread:
+        return current
+    return None
+
+
+def start(command, pstats=None):
+    """Start profiling a run"""
+    global current
+    current = Profile(command, pstats)
+    return current
+
+
+def finish(output='-'):
+    """Stop profiling and write the JSON summary to output, '-' for stdout
+
+    Returns the summary, or None when no run was started."""
+    global current
+    profile = current
+    if profile is None:
+        return None
+    current = None
+    if profile.profiler is not None:
+        profile.profiler.disable()
+        profile.profiler.dump_stats(profile.pstats)
+    summary = profile.summary()
+    if output == '-':
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        with open(output, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2, sort_keys=True)
+    return summary
+
+
+@contextmanager
+def phase(name):
+    """Charge the time spent in the block to phase name"""
+    profile = active()
+    if profile is None:
+        yield
+        return
+    profile.enter(name)
+    try:
+        yield
+    finally:
+        profile.leave()
+
+
+def timed(iterable, name):
+    """Charge the time spent producing each item to phase name"""
+    if active() is None:
+        return iterable
+    return timed_items(iter(iterable), name)
+
+
+def timed_items(iterator, name):
+    """Yield the items of iterator, timing each next() as phase name"""
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def add_rows(rows=1):
+    """Count processed rows"""
+    profile = active()
+    if profile is not None:
+        profile.rows += rows
+
+
+def drain():
+    """Return and clear the counters of a worker process"""
+    profile = active()
+    if profile is None:
+        return None
+    profile.charge(time.time())
+    counters = {'phases': profile.phases, 'rows': profile.rows,
+                'queries': profile.queries}
+    stack = profile.stack
+    profile.reset()
+    profile.stack = stack
+    return counters
+
+
+def merge(counters):
+    """Add the counters of a worker process to the current run"""
+    profile = active()
+    if profile is None or counters is None:
+        return
+    for (name, seconds) in counters['phases'].items():
+        profile.phases[name] = profile.phases.get(name, 0.0) + seconds
+    profile.rows += counters['rows']
+    profile.queries += counters['queries']
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = active()
+    if profile is not None:
+        profile.queries += 1
+        profile.enter('query')
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    profile = active()
+    if profile is not None and profile.stack and \
+            profile.stack[-1] == 'query':
+        profile.leave()
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    after_cursor_execute(None, None, None, None, None, None)
@@ -0,0 +1,159 @@
+"""Content-addressed on-disk cache for fetched report spreadsheets
+
+Report bodies are stored once per content hash under objects/, and each
+url has a small JSON entry under entries/ holding the hash and the HTTP
+validators.  The hashes last loaded successfully are kept by the target
+database (report_loads), since one cache serves every database."""
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'repository_metrics')
+
+
+class ReportCache(object):
+    """Size bounded cache of report contents keyed by url"""
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        for name in ['entries', 'objects']:
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def entry_path(self, url):
+        """Return the entry filename for url"""
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'entries', key + '.json')
+
+    def object_path(self, digest):
+        """Return the filename holding contents with the given hash"""
+        return os.path.join(self.directory, 'objects', digest + '.xls')
+
+    def write(self, path, data):
+        """Atomically replace path with data"""
+        temporary = "{0}.{1}.tmp".format(path, threading.current_thread().
+                                         ident)
+        with open(temporary, 'wb') as fh:
+            fh.write(data)
+        os.rename(temporary, path)
+
+    def get(self, url):
+        """Return the entry for url, or None"""
+        try:
+            with open(self.entry_path(url)) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, url, entry):
+        """Save the entry for url"""
+        self.write(self.entry_path(url), json.dumps(entry))
+
+    def contents(self, url):
+        """Return the cached contents for url, or None"""
+        entry = self.get(url)
+        if entry is None or not entry.get('sha256'):
+            return None
+        try:
+            with open(self.object_path(entry['sha256']), 'rb') as fh:
+                contents = fh.read()
+        except IOError:
+            return None
+        with self.lock:
+            entry['accessed'] = time.time()
+            try:
+                self.put(url, entry)
+            except (IOError, OSError):
+                pass
+        return contents
+
+    def validators(self, url):
+        """Return conditional request headers for url"""
+        headers = {}
+        entry = self.get(url)
+        if entry is None or not entry.get('sha256') or \
+           not os.path.exists(self.object_path(entry['sha256'])):
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, contents, headers):
+        """Cache contents fetched from url with the response headers"""
+        digest = hashlib.sha256(contents).hexdigest()
+        path = self.object_path(digest)
+        with self.lock:
+            if not os.path.exists(path):
+                self.write(path, contents)
+            entry = self.get(url) or {}
+            entry.update({'url': url,
+                          'sha256': digest,
+                          'size': len(contents),
+                          'etag': headers.get('ETag'),
+                          'last_modified': headers.get('Last-Modified'),
+                          'accessed': time.time()})
+            self.put(url, entry)
+        return digest
+
+    def digests(self, urls, version=None):
+        """Return {url: hash} of the cached contents of urls
+
+        With a version the hash also covers it, so the contents count as
+        not loaded by another version of the loader."""
+        result = {}
+        for url in urls:
+            entry = self.get(url)
+            if entry is not None and entry.get('sha256'):
+                digest = entry['sha256']
+                if version is not None:
+                    digest = hashlib.sha256("{0}:{1}".format(
+                        digest, version)).hexdigest()
+                result[url] = digest
+        return result
+
+    def is_loaded(self, urls, loaded, version=None):
+        """Return True if the cached contents of every url are the ones in
+        loaded, {url: hash} of the last successful load by version"""
+        digests = self.digests(urls, version)
+        return all(url in digests and loaded.get(url) == digests[url]
+                   for url in urls)
+
+    def evict(self):
+        """Drop least recently used entries until under max_bytes"""
+        with self.lock:
+            entries_directory = os.path.join(self.directory, 'entries')
+            entries = []
+            for filename in os.listdir(entries_directory):
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(entries_directory, filename)
+                try:
+                    with open(path) as fh:
+                        entries.append((json.load(fh), path))
+                except (IOError, ValueError):
+                    os.remove(path)
+            entries.sort(key=lambda item: item[0].get('accessed', 0))
+            sizes = dict((entry.get('sha256'), entry.get('size', 0))
+                         for (entry, path) in entries)
+            total = sum(sizes.values())
+            while entries and total > self.max_bytes:
+                (entry, path) = entries.pop(0)
+                os.remove(path)
+                digest = entry.get('sha256')
+                if digest not in [other.get('sha256') for (other, p)
+                                  in entries]:
+                    total -= sizes[digest]
+            referenced = set(entry.get('sha256') for (entry, path) in entries)
+            objects_directory = os.path.join(self.directory, 'objects')
+            for filename in os.listdir(objects_directory):
+                if filename[:-len('.xls')] not in referenced:
+                    os.remove(os.path.join(objects_directory, filename))
+            return total
@@ -0,0 +1,129 @@
+"""In-process HTTP response cache invalidated by the dataset version
+
+Metrics only change when a loader runs and bumps the dataset version, so
+responses are cached by route and normalized query arguments until the
+version changes.  The cache is bounded by body size with LRU eviction and
+answers conditional requests with 304 Not Modified."""
+import hashlib
+import threading
+import time
+import urllib
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, request
+
+
+class ResponseCache(object):
+    """LRU cache of response bodies keyed by route and query arguments"""
+    def __init__(self, get_version, max_bytes=64 * 1024 * 1024,
+                 version_ttl=5.0):
+        self.get_version = get_version
+        self.max_bytes = max_bytes
+        self.version_ttl = version_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.version = None
+        self.version_checked = 0
+
+    def check_version(self):
+        """Clear the cache when the dataset version has changed
+
+        The version is read at most once every version_ttl seconds."""
+        now = time.time()
+        if now - self.version_checked < self.version_ttl:
+            return self.version
+        version = self.get_version()
+        with self.lock:
+            self.version_checked = now
+            if version != self.version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+        return version
+
+    def get(self, key):
+        """Return the entry for key, marking it recently used"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry, version=None):
+        """Store an entry, evicting least recently used ones
+
+        An entry rendered at another version than the current one, which
+        changed while the view ran, is dropped."""
+        size = len(entry['body'])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old['body'])
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                (evicted_key, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted['body'])
+                self.evictions += 1
+
+    def stats(self):
+        """Return the cache counters"""
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'not_modified': self.not_modified,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes,
+                    'version': self.version}
+
+    def cached(self, view):
+        """Decorate a view so its 200 responses are cached"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = self.check_version()
+            key = cache_key()
+            entry = self.get(key)
+            if entry is None:
+                response = view(*args, **kwargs)
+                if not isinstance(response, Response) or \
+                   response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                etag = hashlib.sha1("{0}:{1}".format(version, key) +
+                                    body).hexdigest()
+                entry = {'body': body, 'etag': etag,
+                         'mimetype': response.mimetype}
+                self.put(key, entry, version)
+            if entry['etag'] in request.if_none_match:
+                with self.lock:
+                    self.not_modified += 1
+                response = Response(status=304)
+            else:
+                response = Response(entry['body'],
+                                    mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            return response
+        return wrapper
+
+
+def cache_key():
+    """Return the request path with sorted query arguments"""
+    args = sorted((key, value.encode('utf-8'))
+                  for (key, values) in request.args.lists()
+                  for value in values)
+    return "{0}?{1}".format(request.path.encode('utf-8'),
+                            urllib.urlencode(args))
@@ -0,0 +1,196 @@
+"""Download rollup tables
+
+article_download_totals, article_year_downloads, author_download_totals,
+author_month_downloads and context_month_downloads hold the downloads x
+creators x articles aggregates by article, author id and context so that
+leaderboards and summaries do not scan the whole join.
+load_downloads refreshes the rows touched by the articles it loaded;
+rebuild recomputes everything and check reports rows that disagree with
+the downloads table."""
+from sqlalchemy import select, func
+from model import (Article, Author, Creator, Download, ArticleDownloadTotal,
+                   ArticleYearDownloads, AuthorDownloadTotal,
+                   AuthorMonthDownloads, ContextMonthDownloads)
+
+
+CHUNK_SIZE = 500
+
+
+def chunks(values, size=CHUNK_SIZE):
+    """Split values into lists of at most size items"""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def article_totals_query():
+    """Return the select computing article_download_totals"""
+    return select([Download.article_id,
+                   func.sum(Download.download_count)]).\
+        group_by(Download.article_id)
+
+
+def article_year_query():
+    """Return the select computing article_year_downloads"""
+    year = func.extract('year', Download.download_date)
+    return select([Download.article_id, year,
+                   func.sum(Download.download_count)]).\
+        group_by(Download.article_id, year)
+
+
+def author_totals_query():
+    """Return the select computing author_download_totals"""
+    return select([Creator.author_id, func.sum(Download.download_count)]).\
+        where(Creator.article_id == Download.article_id).\
+        where(Creator.author_id != None).\
+        group_by(Creator.author_id)
+
+
+def author_month_query():
+    """Return the select computing author_month_downloads"""
+    return select([Creator.author_id, Download.download_date,
+                   func.sum(Download.download_count)]).\
+        where(Creator.article_id == Download.article_id).\
+        where(Creator.author_id != None).\
+        group_by(Creator.author_id, Download.download_date)
+
+
+def context_month_query():
+    """Return the select computing context_month_downloads"""
+    return select([Article.context, Download.download_date,
+                   func.sum(Download.download_count)]).\
+        where(Article.id == Download.article_id).\
+        where(Article.context != None).\
+        group_by(Article.context, Download.download_date)
+
+
+# rollup model, key column, computing select
+ROLLUPS = [(ArticleDownloadTotal, Download.article_id, article_totals_query),
+           (ArticleYearDownloads, Download.article_id, article_year_query),
+           (AuthorDownloadTotal, Creator.author_id, author_totals_query),
+           (AuthorMonthDownloads, Creator.author_id, author_month_query),
+           (ContextMonthDownloads, Article.context, context_month_query)]
+
+
+def replace_rows(session, rollup, key_column, query, keys=None):
+    """Recompute the rollup rows for keys, or for every key"""
+    table = rollup.__table__
+    names = [column.name for column in table.columns]
+    rollup_key = table.columns[names[0]]
+    if keys is None:
+        session.execute(table.delete())
+        session.execute(table.insert().from_select(names, query()))
+        return
+    for chunk in chunks(keys):
+        session.execute(table.delete().where(rollup_key.in_(chunk)))
+        session.execute(table.insert().from_select(
+            names, query().where(key_column.in_(chunk))))
+
+
+def refresh(session, article_ids, author_ids=(), contexts=()):
+    """Recompute the rollup rows affected by the downloads of article_ids
+
+    author_ids and contexts add keys the articles no longer have, such as
+    the previous authors and contexts of updated articles."""
+    article_ids = list(set(article_ids))
+    author_ids = set(author_ids)
+    contexts = set(contexts)
+    for chunk in chunks(article_ids):
+        author_ids.update(author_id for (author_id,) in
+                          session.query(Creator.author_id).distinct().
+                          filter(Creator.article_id.in_(chunk)).
+                          filter(Creator.author_id != None))
+        contexts.update(context for (context,) in
+                        session.query(Article.context).distinct().
+                        filter(Article.id.in_(chunk)).
+                        filter(Article.context != None))
+    keys = [article_ids, article_ids, author_ids, author_ids, contexts]
+    for ((rollup, key_column, query), values) in zip(ROLLUPS, keys):
+        replace_rows(session, rollup, key_column, query, values)
+    session.commit()
+    print("refreshed rollups for {0} articles, {1} authors, {2} contexts".
+          format(len(article_ids), len(author_ids), len(contexts)))
+
+
+def rebuild(session):
+    """Recompute every rollup table"""
+    for (rollup, key_column, query) in ROLLUPS:
+        print("rebuilding {0}".format(rollup.__tablename__))
+        replace_rows(session, rollup, key_column, query)
+    session.commit()
+
+
+def check(session):
+    """Print and count rollup rows that disagree with the downloads"""
+    mismatches = 0
+    for (rollup, key_column, query) in ROLLUPS:
+        table = rollup.__table__
+        expected = {}
+        for row in session.execute(query()):
+            expected[tuple(row[:-1])] = row[-1]
+        stored = {}
+        for row in session.execute(table.select()):
+            stored[tuple(row[:-1])] = row[-1]
+        for key in set(expected) | set(stored):
+            if expected.get(key) != stored.get(key):
+                mismatches += 1
+                print(u"{0} {1}: expected {2}, stored {3}".format(
+                    table.name, key, expected.get(key), stored.get(key)))
+        print("checked {0}: {1} rows".format(table.name, len(stored)))
+    print("{0} mismatched rollup rows".format(mismatches))
+    return mismatches
+
+
+def author_leaderboard(session, limit=20, start=None, end=None):
+    """Return (author_id, name, email, downloads) rows ordered by downloads
+
+    start and end optionally bound the download months; without them the
+    lifetime totals are read from author_download_totals.  email is None
+    for an author without one."""
+    if start is None and end is None:
+        return session.query(AuthorDownloadTotal.author_id, Author.name,
+                             Author.email,
+                             AuthorDownloadTotal.download_count).\
+            filter(Author.id == AuthorDownloadTotal.author_id).\
+            filter(AuthorDownloadTotal.download_count != None).\
+            order_by(AuthorDownloadTotal.download_count.desc(),
+                     AuthorDownloadTotal.author_id).\
+            limit(limit).all()
+    total = func.sum(AuthorMonthDownloads.download_count)
+    query = session.query(AuthorMonthDownloads.author_id, Author.name,
+                          Author.email, total.label('count')).\
+        filter(Author.id == AuthorMonthDownloads.author_id)
+    if start is not None:
+        query = query.filter(AuthorMonthDownloads.download_date >= start)
+    if end is not None:
+        query = query.filter(AuthorMonthDownloads.download_date <= end)
+    return query.group_by(AuthorMonthDownloads.author_id, Author.name,
+                          Author.email).\
+        order_by(total.desc(), AuthorMonthDownloads.author_id).\
+        limit(limit).all()
+
+
+def author_months(session, author_id):
+    """Return the (month, downloads) pairs of an author ordered by month
+
+    An article is counted once per creator linked to the author."""
+    return session.query(AuthorMonthDownloads.download_date,
+                         AuthorMonthDownloads.download_count).\
+        filter(AuthorMonthDownloads.author_id == author_id).\
+        order_by(AuthorMonthDownloads.download_date).all()
+
+
+def article_years(session, article_id):
+    """Return the (year, downloads) pairs of an article ordered by year"""
+    return session.query(ArticleYearDownloads.year,
+                         ArticleYearDownloads.download_count).\
+        filter(ArticleYearDownloads.article_id == article_id).\
+        order_by(ArticleYearDownloads.year).all()
+
+
+def context_summary(session):
+    """Return (context, downloads) pairs ordered by context"""
+    return session.query(ContextMonthDownloads.context,
+                         func.sum(ContextMonthDownloads.download_count)).\
+        group_by(ContextMonthDownloads.context).\
+        order_by(ContextMonthDownloads.context).all()
@@ -0,0 +1,233 @@
+"""Full-text article search
+
+The titles, keywords (subjects) and disciplines of every article are
+tokenized into search_postings, one row per term and article holding the
+term frequency weighted by field.  The loaders rewrite the postings of the
+articles they change and rebuild (model.py --rebuild-search) recomputes
+them all.
+
+Searching reads the postings once per dataset version into a compact
+in-process inverted index, NumPy arrays of article rows and frequencies per
+term, and ranks the articles matching any query term with BM25:
+
+    python search.py "environmental regulation" -n 10"""
+import argparse
+import itertools
+import math
+import re
+import sys
+import threading
+import numpy
+from sqlalchemy import select
+from unidecode import unidecode
+import model
+from model import (Article, Subject, Discipline, SearchPosting,
+                   ArticleDownloadTotal, get_dataset_version)
+from rollups import chunks
+
+
+TERM_RE = re.compile(r'[a-z0-9]+')
+TERM_LENGTH = 64
+STOP_WORDS = frozenset(['a', 'an', 'and', 'as', 'at', 'by', 'for', 'from',
+                        'in', 'into', 'is', 'it', 'of', 'on', 'or', 'the',
+                        'to', 'with'])
+# weight of a term occurrence in each field
+TITLE_WEIGHT = 3
+SUBJECT_WEIGHT = 2
+DISCIPLINE_WEIGHT = 1
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def terms(text):
+    """Return the search terms of a text, in order"""
+    if not text:
+        return []
+    return [unicode(term[:TERM_LENGTH])
+            for term in TERM_RE.findall(unidecode(text).lower())
+            if term not in STOP_WORDS]
+
+
+def article_terms(fields):
+    """Return {term: weighted frequency} of (weight, text) fields"""
+    frequencies = {}
+    for (weight, text) in fields:
+        for term in terms(text):
+            frequencies[term] = frequencies.get(term, 0) + weight
+    return frequencies
+
+
+def article_fields(title, subjects, disciplines):
+    """Return the (weight, text) fields of an article"""
+    return [(TITLE_WEIGHT, title)] + \
+        [(SUBJECT_WEIGHT, term) for term in subjects] + \
+        [(DISCIPLINE_WEIGHT, term) for term in disciplines]
+
+
+def delete_postings(session, article_ids):
+    """Delete the search postings of article_ids"""
+    table = SearchPosting.__table__
+    for chunk in chunks(article_ids):
+        session.execute(table.delete().where(table.c.article_id.in_(chunk)))
+
+
+def insert_postings(session, fields):
+    """Insert the search postings of {article_id: fields}"""
+    postings = [{'term': term, 'article_id': article_id,
+                 'frequency': frequency}
+                for (article_id, article_fields) in fields.items()
+                for (term, frequency) in
+                article_terms(article_fields).items()]
+    if postings:
+        session.execute(SearchPosting.__table__.insert(), postings)
+
+
+def index_articles(session, article_ids):
+    """Rewrite the search postings of article_ids from the stored articles
+
+    The caller commits."""
+    for chunk in chunks(article_ids):
+        children = {}
+        for child in (Subject, Discipline):
+            for (article_id, term) in session.query(child.article_id,
+                                                    child.term).\
+                    filter(child.article_id.in_(chunk)).\
+                    order_by(child.article_id, child.position):
+                children.setdefault((child, article_id), []).append(term)
+        fields = {}
+        for (article_id, title) in session.query(Article.id, Article.title).\
+                filter(Article.id.in_(chunk)):
+            fields[article_id] = article_fields(
+                title, children.get((Subject, article_id), []),
+                children.get((Discipline, article_id), []))
+        delete_postings(session, chunk)
+        insert_postings(session, fields)
+
+
+def rebuild(session):
+    """Recompute the search postings of every article"""
+    session.execute(SearchPosting.__table__.delete())
+    article_ids = [article_id for (article_id,) in
+                   session.query(Article.id).order_by(Article.id)]
+    index_articles(session, article_ids)
+    session.commit()
+    print("indexed {0} articles".format(len(article_ids)))
+
+
+class SearchIndex(object):
+    """In-memory inverted index of the search postings"""
+    def __init__(self, version, article_ids, downloads, lengths, postings):
+        self.version = version
+        self.article_ids = article_ids
+        self.downloads = downloads
+        self.lengths = lengths
+        self.average_length = lengths.mean() if len(lengths) else 0.0
+        self.postings = postings
+
+    @classmethod
+    def load(cls, session):
+        """Return the index of the stored postings"""
+        version = get_dataset_version(session)
+        article_ids = numpy.array(
+            [article_id for (article_id,) in
+             session.query(Article.id).order_by(Article.id)],
+            dtype=numpy.int64)
+        downloads = numpy.zeros(len(article_ids), dtype=numpy.int64)
+        totals = session.query(ArticleDownloadTotal.article_id,
+                               ArticleDownloadTotal.download_count).all()
+        if totals:
+            (ids, counts) = zip(*totals)
+            downloads[numpy.searchsorted(article_ids, ids)] = \
+                [count or 0 for count in counts]
+        lengths = numpy.zeros(len(article_ids), dtype=numpy.float64)
+        postings = {}
+        query = select([SearchPosting.term, SearchPosting.article_id,
+                        SearchPosting.frequency]).\
+            order_by(SearchPosting.term)
+        for (term, group) in itertools.groupby(session.execute(query),
+                                               lambda row: row.term):
+            (_, ids, frequencies) = zip(*group)
+            rows = numpy.searchsorted(article_ids, ids)
+            frequencies = numpy.array(frequencies, dtype=numpy.float64)
+            postings[term] = (rows, frequencies)
+            numpy.add.at(lengths, rows, frequencies)
+        return cls(version, article_ids, downloads, lengths, postings)
+
+    def scores(self, query):
+        """Return the BM25 score of every article for a query"""
+        total = numpy.zeros(len(self.article_ids), dtype=numpy.float64)
+        for term in set(terms(query)):
+            if term not in self.postings:
+                continue
+            (rows, frequencies) = self.postings[term]
+            idf = math.log(1 + (len(self.article_ids) - len(rows) + 0.5) /
+                           (len(rows) + 0.5))
+            norm = K1 * (1 - B + B * self.lengths[rows] /
+                         self.average_length)
+            total += numpy.bincount(
+                rows, idf * frequencies * (K1 + 1) / (frequencies + norm),
+                minlength=len(total))
+        return total
+
+    def search(self, query, limit=20):
+        """Return (article_id, score, downloads) of the best matches
+
+        Equal scores rank the most downloaded article first."""
+        scores = self.scores(query)
+        matches = numpy.flatnonzero(scores)
+        order = numpy.lexsort((-self.downloads[matches],
+                               -scores[matches]))[:limit]
+        return [(int(self.article_ids[row]), round(float(scores[row]), 4),
+                 int(self.downloads[row])) for row in matches[order]]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index(session):
+    """Return the search index of this process, reloaded when the dataset
+    version has changed"""
+    global _index
+    version = get_dataset_version(session)
+    with _index_lock:
+        if _index is None or _index.version != version:
+            _index = SearchIndex.load(session)
+        return _index
+
+
+def search(session, query, limit=20):
+    """Return (article_id, score, downloads) of the articles best matching
+    a query, by descending score"""
+    return get_index(session).search(query, limit)
+
+
+def main(args):
+    session = model.get_session()
+    # the query argument arrives in bytes of the terminal encoding
+    query = args.query
+    if isinstance(query, str):
+        try:
+            query = query.decode(sys.getfilesystemencoding() or 'utf-8')
+        except UnicodeDecodeError:
+            # a C locale reports ascii for a UTF-8 terminal
+            query = query.decode('utf-8', 'replace')
+    for (article_id, score, downloads) in search(session, query,
+                                                 args.limit):
+        print("{0}\t{1}\t{2}".format(article_id, score, downloads))
+
+
+def parse_arguments():
+    """Command line options for search"""
+    parser = argparse.ArgumentParser(description="Search article titles, " +
+                                     "keywords and disciplines")
+    parser.add_argument("query", help="Search terms")
+    parser.add_argument("-n", "--limit", help="Results to print", type=int,
+                        default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
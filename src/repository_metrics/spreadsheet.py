@@ -0,0 +1,178 @@
+"""Spreadsheet reader shared by the loaders"""
+import functools
+import xlrd
+
+
+class SpreadsheetError(Exception):
+    """Raised when report contents cannot be read as a workbook"""
+    pass
+
+
+def convert_number(datemode, value):
+    """Force NUMBER cells into a string"""
+    return u"%d" % value
+
+
+def convert_date(datemode, value):
+    """Return DATE cells as a date tuple"""
+    return xlrd.xldate_as_tuple(value, datemode)
+
+
+def convert_boolean(datemode, value):
+    """Return BOOLEAN cells as True or False"""
+    return bool(value)
+
+
+# indexed by xlrd cell type, None keeps the cell value as is; converters
+# take the datemode first so that a column binds it once with partial
+CONVERTERS = (None,              # XL_CELL_EMPTY
+              None,              # XL_CELL_TEXT
+              convert_number,    # XL_CELL_NUMBER
+              convert_date,      # XL_CELL_DATE
+              convert_boolean,   # XL_CELL_BOOLEAN
+              None,              # XL_CELL_ERROR
+              None)              # XL_CELL_BLANK
+# column_converter result for a column whose cells need different converters
+MIXED = 'mixed'
+
+
+def convert_values(types, values, datemode):
+    """Convert a row of raw cell values according to their cell types"""
+    converted = []
+    for (ctype, value) in zip(types, values):
+        converter = CONVERTERS[ctype]
+        if converter is not None:
+            value = converter(datemode, value)
+        converted.append(value)
+    return converted
+
+
+def column_converter(types, datemode):
+    """Return the converter of a column from the cell types of its data
+    rows, None when its values are kept as they are or MIXED"""
+    converters = set(CONVERTERS[ctype] for ctype in set(types))
+    if len(converters) > 1:
+        return MIXED
+    converter = converters.pop()
+    if converter is None:
+        return None
+    return functools.partial(converter, datemode)
+
+
+class Schema(object):
+    """Header labels of a sheet compiled into a label to column index"""
+    __slots__ = ('labels', 'index', 'width')
+
+    def __init__(self, labels):
+        self.index = {}
+        for (i, label) in enumerate(labels):
+            # as with a dict, the last column with a label wins
+            self.index[label] = i
+        self.labels = [label for (i, label) in enumerate(labels)
+                       if self.index[label] == i]
+        self.width = len(labels)
+
+    def __repr__(self):
+        return "<Schema({0})>".format(len(self.labels))
+
+
+class Row(object):
+    """Read only spreadsheet row addressed by header label"""
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    def __getitem__(self, label):
+        return self.values[self.schema.index[label]]
+
+    def __contains__(self, label):
+        return label in self.schema.index
+
+    def __iter__(self):
+        return iter(self.schema.labels)
+
+    def __len__(self):
+        return len(self.schema.labels)
+
+    def get(self, label, default=None):
+        """Return the value for label, or default"""
+        i = self.schema.index.get(label)
+        if i is None:
+            return default
+        return self.values[i]
+
+    def keys(self):
+        """Return the header labels"""
+        return list(self.schema.labels)
+
+    def items(self):
+        """Return (label, value) pairs in column order"""
+        index = self.schema.index
+        return [(label, self.values[index[label]])
+                for label in self.schema.labels]
+
+    def __repr__(self):
+        return "<Row({0!r})>".format(dict(self.items()))
+
+
+def open_workbook(file_contents, on_demand=False):
+    """Open workbook contents, raising SpreadsheetError when unreadable"""
+    if not file_contents:
+        raise SpreadsheetError("Empty workbook contents")
+    try:
+        return xlrd.open_workbook(file_contents=file_contents,
+                                  on_demand=on_demand)
+    except Exception as e:
+        raise SpreadsheetError("Unreadable workbook: {0}".format(e))
+
+
+def excel_row_count(file_contents):
+    """Count rows in the excel file"""
+    workbook = open_workbook(file_contents, on_demand=True)
+    try:
+        return workbook.sheet_by_index(0).nrows
+    finally:
+        workbook.release_resources()
+
+
+def read_excel(file_contents, start_row=1, label_row=0, sheet_by_index=0,
+               on_demand=False):
+    """Yield a Row for each data row of a sheet
+
+    The header row is read once into a Schema shared by every row, and the
+    cell types of the data rows once into a converter per column.  Only
+    the cells of MIXED columns are converted by their own cell type.  With
+    on_demand only the requested sheet is loaded from the workbook."""
+    workbook = open_workbook(file_contents, on_demand=on_demand)
+    try:
+        try:
+            sheet = workbook.sheet_by_index(sheet_by_index)
+        except IndexError:
+            raise SpreadsheetError("No sheet {0}".format(sheet_by_index))
+        datemode = workbook.datemode
+        schema = Schema(convert_values(sheet.row_types(label_row),
+                                       sheet.row_values(label_row),
+                                       datemode))
+        row_indexes = range(start_row, sheet.nrows)
+        types = [sheet.row_types(row_index, 0, schema.width)
+                 for row_index in row_indexes]
+        converters = [column_converter(column, datemode)
+                      for column in zip(*types)]
+        mixed = [i for (i, convert) in enumerate(converters)
+                 if convert is MIXED]
+        for i in mixed:
+            converters[i] = None
+        for (row_index, row_types) in zip(row_indexes, types):
+            cells = sheet.row_values(row_index, 0, schema.width)
+            values = [cell if convert is None else convert(cell)
+                      for (convert, cell) in zip(converters, cells)]
+            for i in mixed:
+                converter = CONVERTERS[row_types[i]]
+                if converter is not None:
+                    values[i] = converter(datemode, cells[i])
+            yield Row(schema, values)
+    finally:
+        if on_demand:
+            workbook.release_resources()
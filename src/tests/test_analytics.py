@@ -0,0 +1,58 @@
+"""Trends, growth, ranks and percentiles of download series"""
+import unittest
+import numpy
+from repository_metrics.analytics import (Series, article_trends, ranks,
+                                          percentiles, top_movers)
+
+
+def series(counts, contexts=None):
+    """Return a Series of consecutive months from a list of rows"""
+    counts = numpy.array(counts, dtype=numpy.int32)
+    if contexts is None:
+        contexts = [0] * len(counts)
+    return Series(numpy.arange(1, len(counts) + 1),
+                  numpy.datetime64('2010-01') + numpy.arange(counts.shape[1]),
+                  counts, numpy.array(contexts, dtype=numpy.int32),
+                  numpy.array([u'dlj', u'lcp']))
+
+
+class AnalyticsTest(unittest.TestCase):
+    def test_ranks_share_the_best_rank_on_ties(self):
+        self.assertEqual(ranks([9, 7, 7, 3]).tolist(), [1, 2, 2, 4])
+        self.assertEqual(ranks([[1, 5], [1, 4], [2, 5]]).tolist(),
+                         [[2, 1], [2, 3], [1, 1]])
+
+    def test_percentiles_within_each_group(self):
+        self.assertEqual(numpy.round(percentiles([1, 10, 2, 20, 3],
+                                                 [0, 1, 0, 1, 0]),
+                                     1).tolist(),
+                         [33.3, 50.0, 66.7, 100.0, 100.0])
+        self.assertEqual(percentiles([5, 5]).tolist(), [100.0, 100.0])
+
+    def test_trailing_growth_needs_a_full_earlier_window(self):
+        trends = article_trends(series([[10] * 13]))
+        self.assertEqual(trends['trailing'].tolist(), [120])
+        self.assertTrue(numpy.isnan(trends['trailing_growth'][0]))
+        trends = article_trends(series([[10] * 24]))
+        self.assertEqual(trends['trailing_growth'].tolist(), [0.0])
+        trends = article_trends(series([[10] * 13]), window=1)
+        self.assertEqual(trends['trailing_growth'].tolist(), [0.0])
+
+    def test_month_growth(self):
+        trends = article_trends(series([[4, 6], [0, 3]]))
+        self.assertEqual(trends['month_growth'][0], 0.5)
+        # no earlier downloads, or no earlier month
+        self.assertTrue(numpy.isnan(trends['month_growth'][1]))
+        trends = article_trends(series([[4, 6]]), at=0)
+        self.assertTrue(numpy.isnan(trends['month_growth'][0]))
+
+    def test_top_movers_need_full_windows(self):
+        movers = series([[1, 1, 1, 1], [1, 2, 3, 9]])
+        self.assertEqual(top_movers(movers, n=1, lag=1), [(2, 3, 9)])
+        self.assertEqual(top_movers(movers, n=1, lag=2, window=2),
+                         [(2, 3, 12)])
+        self.assertEqual(top_movers(movers, lag=2, window=3), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
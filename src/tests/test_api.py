@@ -0,0 +1,195 @@
+"""The JSON API against a small synthetic SQLite dataset"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from api_benchmark import generate
+from repository_metrics import model, search
+from repository_metrics.api import admin, cache
+from repository_metrics.application import app
+from repository_metrics.model import Article
+
+
+class ApiTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='api-')
+        config = os.path.join(cls.directory, 'repository-metrics.cfg')
+        with open(config, 'w') as config_file:
+            config_file.write("[sqlalchemy]\ndsn=sqlite:///{0}\n"
+                              "echo=False\n".format(
+                                  os.path.join(cls.directory, 'api.db')))
+        cls.environ = os.environ.get('REPOSITORY_METRICS_CONFIG')
+        os.environ['REPOSITORY_METRICS_CONFIG'] = config
+        model.Base.metadata.create_all(model.get_engine())
+        session = model.get_session()
+        generate(session, 30, 2, 3, 1)
+        # the loaded search index keeps a deleted article until the
+        # dataset version changes
+        search.get_index(session)
+        cls.deleted = session.query(Article).get(30).title
+        session.execute(Article.__table__.delete().where(Article.id == 30))
+        session.commit()
+        session.remove()
+        cls.client = app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        model.dispose_engines()
+        if cls.environ is None:
+            del os.environ['REPOSITORY_METRICS_CONFIG']
+        else:
+            os.environ['REPOSITORY_METRICS_CONFIG'] = cls.environ
+        shutil.rmtree(cls.directory)
+
+    def get(self, url, status=200, **kwargs):
+        response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, status, url)
+        if status == 200:
+            return json.loads(response.get_data())
+        return response
+
+    def test_article_detail(self):
+        article = self.get('/api/articles/1')
+        self.assertEqual(article['id'], 1)
+        self.assertEqual(len(article['series']), 3)
+        self.assertEqual(article['downloads'],
+                         sum(month['count'] for month in article['series']))
+        self.get('/api/articles/30', 404)
+
+    def test_article_without_title(self):
+        session = model.get_session()
+        title = session.query(Article).get(29).title
+        session.query(Article).filter(Article.id == 29).\
+            update({'title': None})
+        session.commit()
+        try:
+            self.assertIsNone(self.get('/api/articles/29')['title'])
+        finally:
+            session.query(Article).filter(Article.id == 29).\
+                update({'title': title})
+            session.commit()
+            session.remove()
+
+    def test_article_days_rejects_bad_dates(self):
+        self.assertEqual(self.get('/api/articles/1/days')['id'], 1)
+        self.get('/api/articles/1/days?start=2015-13-01', 400)
+        self.get('/api/articles/30/days', 404)
+
+    def test_article_stream(self):
+        misses = cache.stats()['misses']
+        articles = self.get('/api/articles')['articles']
+        self.assertEqual([article['id'] for article in articles],
+                         range(1, 30))
+        articles = self.get('/api/articles?context=dlj')['articles']
+        self.assertEqual(set(article['context'] for article in articles),
+                         set([u'dlj']))
+        # the stream bypasses the response cache
+        self.assertEqual(cache.stats()['misses'], misses)
+
+    def test_article_pages(self):
+        ids = []
+        pages = []
+        url = '/api/articles?per_page=7'
+        while True:
+            page = self.get(url)
+            self.assertEqual(page['total'], 29)
+            self.assertEqual(page['pages'], 5)
+            pages.append([article['id'] for article in page['articles']])
+            ids.extend(pages[-1])
+            if page['next'] is None:
+                break
+            url = '/api/articles?per_page=7&cursor=' + page['next']
+        self.assertEqual(ids, range(1, 30))
+        self.assertEqual(len(pages), 5)
+        backwards = [pages[-1]]
+        while page['prev'] is not None:
+            page = self.get('/api/articles?per_page=7&cursor=' +
+                            page['prev'])
+            backwards.insert(0, [article['id']
+                                 for article in page['articles']])
+        self.assertEqual(backwards, pages)
+
+    def test_article_pages_by_title(self):
+        titles = []
+        url = '/api/articles?per_page=10&sort=title'
+        while url:
+            page = self.get(url)
+            titles.extend(article['title'] for article in page['articles'])
+            url = page['next'] and \
+                '/api/articles?per_page=10&sort=title&cursor=' + page['next']
+        self.assertEqual(titles, sorted(titles))
+        self.assertEqual(len(titles), 29)
+
+    def test_article_pages_reject_bad_arguments(self):
+        self.get('/api/articles?per_page=7&sort=date', 400)
+        self.get('/api/articles?cursor=nonsense', 400)
+
+    def test_not_modified(self):
+        response = self.client.get('/api/contexts')
+        etag = response.headers['ETag']
+        response = self.client.get('/api/contexts',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), '')
+        response = self.client.get('/api/contexts',
+                                   headers={'If-None-Match': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_search_skips_deleted_articles(self):
+        results = self.get('/api/search?q=' +
+                           self.deleted.split()[0])['results']
+        self.assertNotIn(30, [result['id'] for result in results])
+        self.get('/api/search?q=', 400)
+
+    def test_authors(self):
+        author = self.get('/api/authors/1')
+        self.assertEqual(author['email'], u'a0@law.duke.edu')
+        summary = self.get('/api/authors/a0@law.duke.edu')
+        self.assertEqual(summary['articles'], author['articles'])
+        self.get('/api/authors/nobody@law.duke.edu', 404)
+        self.get('/api/authors/1000', 404)
+
+    def test_contexts(self):
+        contexts = self.get('/api/contexts')['contexts']
+        self.assertEqual(len(contexts), 10)
+        context = self.get('/api/contexts/dlj')
+        self.assertEqual(context['articles'], 3)
+        self.assertEqual(len(context['series']), 3)
+        self.get('/api/contexts/missing', 404)
+
+    def test_admin_routes(self):
+        # not served unless [api] admin is set
+        self.get('/api/pool', 404)
+        self.get('/admin/pool', 404)
+        application = Flask(__name__)
+        application.register_blueprint(admin, url_prefix='/admin')
+        client = application.test_client()
+        self.assertEqual(client.get('/admin/cache').status_code, 200)
+        self.assertEqual(client.get('/admin/pool').status_code, 200)
+        response = client.get('/admin/pool',
+                              environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_top(self):
+        articles = self.get('/api/top/articles?n=5')['articles']
+        self.assertEqual(len(articles), 5)
+        downloads = [article['downloads'] for article in articles]
+        self.assertEqual(downloads, sorted(downloads, reverse=True))
+        articles = self.get('/api/top/articles?context=lcp')['articles']
+        self.assertEqual(set(article['context'] for article in articles),
+                         set([u'lcp']))
+        authors = self.get('/api/top/authors?n=3')['authors']
+        self.assertEqual(len(authors), 3)
+        downloads = [author['downloads'] for author in authors]
+        self.assertEqual(downloads, sorted(downloads, reverse=True))
+        author = self.get('/api/authors/{0}'.format(authors[0]['id']))
+        self.assertEqual(author['downloads'], authors[0]['downloads'])
+        self.assertEqual(author['email'], authors[0]['email'])
+
+
+if __name__ == '__main__':
+    unittest.main()
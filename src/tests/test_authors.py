@@ -0,0 +1,93 @@
+"""Author name keys, the AuthorIndex and linking creators"""
+import sys
+import unittest
+from StringIO import StringIO
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from repository_metrics.authors import AuthorIndex, link, name_key
+from repository_metrics.model import Article, Author, Base, Creator
+
+
+class NameKeyTest(unittest.TestCase):
+    def test_last_and_first_names(self):
+        self.assertEqual(name_key(u"Jos\xe9", None, u"Garc\xeda-L\xf3pez",
+                                  None), u"garcialopez jose")
+        self.assertEqual(name_key(u"John", u"Q.", u"Smith", u"Jr."),
+                         u"smith john")
+        self.assertEqual(name_key(None, None, u"O'Neil", None), u"oneil")
+        self.assertEqual(name_key(None, None, None, None), u"")
+
+
+class AuthorIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = AuthorIndex()
+        self.index.add(1, u"smith john", u"jsmith@law.duke.edu")
+        self.index.add(2, u"doe jane", u"jdoe@law.duke.edu")
+        self.index.add(3, u"doe jane", u"jane.doe@example.com")
+        self.index.add(4, u"roe richard", None)
+        self.index.add(5, u"roe richard", u"rroe@law.duke.edu")
+
+    def test_find(self):
+        self.assertEqual(self.index.find(u"smith john",
+                                         u"jsmith@law.duke.edu"), 1)
+        # an email identifies the author, whatever the name
+        self.assertEqual(self.index.find(u"other", u"jdoe@law.duke.edu"), 2)
+        self.assertIsNone(self.index.find(u"smith john",
+                                          u"new@law.duke.edu"))
+        # without email, the only author of the name
+        self.assertEqual(self.index.find(u"smith john", None), 1)
+        # or the author of the name without email
+        self.assertEqual(self.index.find(u"roe richard", None), 4)
+        # but never one of several authors of the name
+        self.assertIsNone(self.index.find(u"doe jane", None))
+        self.assertIsNone(self.index.find(u"nobody", None))
+
+
+class LinkTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def creator(self, article_id, position, first, last, email=None,
+                author_id=None):
+        return Creator(article_id=article_id, position=position,
+                       first=first, last=last, email=email,
+                       author_id=author_id)
+
+    def test_link(self):
+        self.session.add_all([Article(id=article_id)
+                              for article_id in (1, 2, 3)])
+        self.session.add(Author(id=9, name_key=u"gone", name=u"Gone"))
+        self.session.add_all([
+            self.creator(1, 1, u"John", u"Smith", u"jsmith@law.duke.edu",
+                         author_id=9),
+            self.creator(2, 1, u"Johnny", u"Smith",
+                         u" JSmith@law.duke.edu "),
+            self.creator(2, 2, u"Jane", u"Doe"),
+            self.creator(3, 1, u"Jane", u"Doe")])
+        self.session.commit()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEqual(link(self.session), 4)
+            self.assertEqual(link(self.session), 0)
+        finally:
+            sys.stdout = stdout
+        authors = dict(((creator.article_id, creator.position),
+                        creator.author_id)
+                       for creator in self.session.query(Creator))
+        self.assertEqual(authors[(1, 1)], authors[(2, 1)])
+        self.assertEqual(authors[(2, 2)], authors[(3, 1)])
+        self.assertNotEqual(authors[(1, 1)], authors[(2, 2)])
+        self.assertEqual(sorted((author.name_key, author.email)
+                                for author in self.session.query(Author)),
+                         [(u"doe jane", None),
+                          (u"smith john", u"jsmith@law.duke.edu")])
+
+
+if __name__ == '__main__':
+    unittest.main()
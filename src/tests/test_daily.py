@@ -0,0 +1,89 @@
+"""Daily download keys and the months derived from the days"""
+import unittest
+from datetime import date, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import load_downloads
+from repository_metrics import daily
+from repository_metrics.model import Article, Base, DailyDownload, Download
+
+
+def report_row(start, end, count=1):
+    """Return a report row with count downloads on each day"""
+    row = {'URL': u'http://scholarship.law.duke.edu/dlj/vol1/iss1/1'}
+    day = start
+    while day <= end:
+        row[(day.year, day.month, day.day, 0, 0, 0)] = count
+        day += timedelta(days=1)
+    return row
+
+
+def dates(row):
+    return [date(*key[:3]) for key in row if isinstance(key, tuple)]
+
+
+class DayKeyTest(unittest.TestCase):
+    def test_round_trip(self):
+        day = daily.FIRST_DAY
+        previous = -1
+        while day <= daily.LAST_DAY:
+            key = daily.day_key(day)
+            self.assertGreater(key, previous)
+            self.assertEqual(daily.key_date(key), day)
+            self.assertEqual(daily.key_date(daily.month_key(key)),
+                             day.replace(day=1))
+            previous = key
+            day += timedelta(days=1)
+
+    def test_keys_fit_a_smallint(self):
+        self.assertEqual(daily.day_key(daily.FIRST_DAY), 0)
+        self.assertLessEqual(daily.day_key(daily.LAST_DAY), 32767)
+        self.assertRaises(ValueError, daily.day_key, date(1999, 12, 31))
+        self.assertRaises(ValueError, daily.day_key, date(2088, 1, 1))
+
+
+class MonthRefreshTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add(Article(id=2))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def months(self):
+        return dict(self.session.query(Download.download_date,
+                                       Download.download_count))
+
+    def load_days(self, start, end):
+        row = report_row(start, end)
+        load_downloads.process_days(self.session, [(2, row)], dates(row))
+
+    def test_partial_month_keeps_the_monthly_total(self):
+        monthly = {(2010, 5, 1, 0, 0, 0): 40, (2010, 6, 1, 0, 0, 0): 23}
+        load_downloads.process_data(self.session, [(2, monthly)],
+                                    dates(monthly))
+        self.load_days(date(2010, 6, 28), date(2010, 7, 2))
+        # June is partly covered, July has no monthly total
+        self.assertEqual(self.months(), {date(2010, 5, 1): 40,
+                                         date(2010, 6, 1): 23,
+                                         date(2010, 7, 1): 2})
+        self.assertEqual(self.session.query(DailyDownload).count(), 5)
+        self.load_days(date(2010, 6, 1), date(2010, 6, 30))
+        self.assertEqual(self.months()[date(2010, 6, 1)], 30)
+        self.load_days(date(2010, 6, 29), date(2010, 6, 30))
+        self.assertEqual(self.months()[date(2010, 6, 1)], 30)
+
+    def test_monthly_report_keeps_the_months_of_the_days(self):
+        self.load_days(date(2010, 7, 1), date(2010, 7, 3))
+        monthly = {(2010, 6, 1, 0, 0, 0): 23}
+        load_downloads.process_data(self.session, [(2, monthly)],
+                                    dates(monthly))
+        self.assertEqual(self.months(), {date(2010, 6, 1): 23,
+                                         date(2010, 7, 1): 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+"""fetch_reports against a local HTTP server of fixture reports"""
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+from benchmark import generate
+from repository_metrics.fetch import (fetch, fetch_reports,
+                                      get_http_session, report_url)
+from repository_metrics.report_cache import ReportCache
+
+
+class ReportServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the files of a directory with an ETag, answering 304 to a
+    matching If-None-Match and 503 while a path has failures left"""
+    daemon_threads = True
+
+    def __init__(self, directory):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           ReportHandler)
+        self.directory = directory
+        self.failures = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def url(self):
+        return "http://127.0.0.1:{0}/".format(self.server_address[1])
+
+
+class ReportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        name = os.path.basename(self.path)
+        with server.lock:
+            server.requests.append((name, self.headers.get('If-None-Match')))
+            failing = server.failures.get(name, 0)
+            if failing:
+                server.failures[name] = failing - 1
+        if failing:
+            return self.reply(503)
+        try:
+            with open(os.path.join(server.directory, name), 'rb') as fh:
+                contents = fh.read()
+        except IOError:
+            return self.reply(404)
+        etag = '"{0}"'.format(hashlib.sha1(contents).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, etag=etag)
+        self.reply(200, contents, etag)
+
+    def reply(self, status, contents='', etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    def log_message(self, *args):
+        pass
+
+
+class FailingCache(ReportCache):
+    """Report cache that cannot write the dlj reports"""
+    def store(self, url, contents, headers):
+        if '/dlj_' in url:
+            raise IOError(28, "No space left on device")
+        return ReportCache.store(self, url, contents, headers)
+
+
+class ReadOnlyCache(ReportCache):
+    """Report cache on a read-only file system"""
+    def write(self, path, data):
+        raise IOError(30, "Read-only file system")
+
+
+class FetchReportsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='fetch-')
+        self.reports = os.path.join(self.directory, 'reports')
+        os.mkdir(self.reports)
+        generate(self.reports, 3, 1, 2, 1)
+        self.server = ReportServer(self.reports)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.http = get_http_session(workers=2, retries=2, backoff_factor=0)
+        self.cache = ReportCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def fixture(self, context, report):
+        name = "{0}_{1}.xls".format(context, report)
+        with open(os.path.join(self.reports, name), 'rb') as fh:
+            return fh.read()
+
+    def fetch_all(self, contexts, cache=None):
+        return dict(fetch_reports(self.server.url(), contexts, workers=2,
+                                  http=self.http, cache=cache))
+
+    def test_fetches_every_report(self):
+        result = self.fetch_all(['dlj', 'faculty_scholarship'])
+        self.assertEqual(sorted(result), ['dlj', 'faculty_scholarship'])
+        for (context, reports) in result.items():
+            self.assertEqual(reports['editor'],
+                             self.fixture(context, 'editor'))
+            self.assertEqual(reports['metadata'],
+                             self.fixture(context, 'metadata'))
+
+    def test_retries_server_errors(self):
+        self.server.failures['dlj_editor.xls'] = 2
+        result = self.fetch_all(['dlj'])
+        self.assertEqual(result['dlj']['editor'],
+                         self.fixture('dlj', 'editor'))
+        self.assertEqual([name for (name, etag) in self.server.requests
+                          if name == 'dlj_editor.xls'],
+                         ['dlj_editor.xls'] * 3)
+
+    def test_exhausted_retries_skip_only_that_context(self):
+        self.server.failures['dlj_editor.xls'] = 3
+        result = self.fetch_all(['dlj', 'faculty_scholarship'])
+        self.assertIsNone(result['dlj'])
+        self.assertIsNotNone(result['faculty_scholarship'])
+
+    def test_missing_report_skips_context(self):
+        result = self.fetch_all(['dlj', 'lcp'])
+        self.assertIsNone(result['lcp'])
+        self.assertIsNotNone(result['dlj'])
+
+    def test_conditional_get_answers_from_cache(self):
+        first = self.fetch_all(['dlj'], self.cache)
+        del self.server.requests[:]
+        second = self.fetch_all(['dlj'], self.cache)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.requests), 2)
+        for (name, etag) in self.server.requests:
+            self.assertIsNotNone(etag)
+
+    def test_refetches_when_cached_contents_are_gone(self):
+        url = report_url(self.server.url(), 'dlj', 'editor')
+        fetch(self.http, url, cache=self.cache)
+        os.remove(self.cache.object_path(self.cache.get(url)['sha256']))
+        del self.server.requests[:]
+        self.assertEqual(fetch(self.http, url, cache=self.cache),
+                         self.fixture('dlj', 'editor'))
+        self.assertEqual(self.server.requests, [('dlj_editor.xls', None)])
+
+    def test_body_that_is_not_a_workbook_is_not_cached(self):
+        with open(os.path.join(self.reports, 'dlj_editor.xls'), 'wb') as fh:
+            fh.write("<html>maintenance</html>")
+        result = self.fetch_all(['dlj', 'faculty_scholarship'], self.cache)
+        self.assertIsNone(result['dlj'])
+        self.assertIsNotNone(result['faculty_scholarship'])
+        url = report_url(self.server.url(), 'dlj', 'editor')
+        self.assertIsNone(self.cache.get(url))
+
+    def test_cache_errors_still_return_the_reports(self):
+        cache = FailingCache(os.path.join(self.directory, 'full'))
+        result = self.fetch_all(['dlj', 'faculty_scholarship'], cache)
+        self.assertEqual(result['dlj']['editor'],
+                         self.fixture('dlj', 'editor'))
+        self.assertIsNotNone(result['faculty_scholarship'])
+        url = report_url(self.server.url(), 'dlj', 'editor')
+        self.assertIsNone(cache.get(url))
+        self.assertEqual(cache.digests([url]), {})
+
+    def test_read_only_cache_answers_from_cache(self):
+        self.fetch_all(['dlj'], self.cache)
+        cache = ReadOnlyCache(os.path.join(self.directory, 'cache'))
+        del self.server.requests[:]
+        self.assertEqual(self.fetch_all(['dlj'], cache)['dlj'],
+                         {'editor': self.fixture('dlj', 'editor'),
+                          'metadata': self.fixture('dlj', 'metadata')})
+        for (name, etag) in self.server.requests:
+            self.assertIsNotNone(etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
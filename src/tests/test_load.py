@@ -0,0 +1,300 @@
+"""The loaders and exports against synthetic fixture reports
+
+The benchmark reports are loaded row by row and in bulk into two SQLite
+databases, which must hold the same rows apart from surrogate ids, and
+every export of the row loaded database is compared with its golden file
+in tests/exports.  After an intended change of an export rewrite them
+with
+
+    UPDATE_EXPORTS=1 python -m unittest tests.test_load"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+from StringIO import StringIO
+from sqlalchemy import text
+import benchmark
+import load
+import load_downloads
+from repository_metrics import export, model, rollups
+from repository_metrics.authors import AuthorIndex
+from repository_metrics.spreadsheet import read_excel
+from tests.test_fetch import ReportServer
+
+
+EXPORTS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'exports')
+
+# rows compared between databases, keyed by values instead of ids
+QUERIES = {
+    'articles': "SELECT a.oai_identifier, a.title, a.submission_date, "
+                "a.date, a.document_type, a.article_url, a.last_event, "
+                "a.last_event_date, a.status, a.pdf_url, a.publication, "
+                "a.source_fulltext_url, a.volume, a.issue, a.fpage, "
+                "a.lpage, a.source_hash, a.byline, a.context, "
+                "a.has_faculty FROM articles a",
+    'creators': "SELECT a.oai_identifier, c.position, c.first, c.middle, "
+                "c.last, c.suffix, c.institution, c.email, u.name_key, "
+                "u.email FROM creators c JOIN articles a "
+                "ON a.id = c.article_id LEFT JOIN authors u "
+                "ON u.id = c.author_id",
+    'authors': "SELECT name_key, email, name FROM authors",
+    'subjects': "SELECT a.oai_identifier, s.position, s.term FROM "
+                "subjects s JOIN articles a ON a.id = s.article_id",
+    'disciplines': "SELECT a.oai_identifier, d.position, d.term FROM "
+                   "disciplines d JOIN articles a ON a.id = d.article_id",
+    'downloads': "SELECT a.oai_identifier, d.download_date, "
+                 "d.download_count FROM downloads d JOIN articles a "
+                 "ON a.id = d.article_id",
+    'search_postings': "SELECT a.oai_identifier, p.term, p.frequency FROM "
+                       "search_postings p JOIN articles a "
+                       "ON a.id = p.article_id",
+    'article_download_totals': "SELECT a.oai_identifier, t.download_count "
+                               "FROM article_download_totals t JOIN "
+                               "articles a ON a.id = t.article_id",
+    'author_download_totals': "SELECT u.name_key, u.email, "
+                              "t.download_count FROM author_download_totals "
+                              "t JOIN authors u ON u.id = t.author_id",
+    'author_month_downloads': "SELECT u.name_key, u.email, m.download_date, "
+                              "m.download_count FROM author_month_downloads "
+                              "m JOIN authors u ON u.id = m.author_id",
+    'context_month_downloads': "SELECT * FROM context_month_downloads",
+}
+
+
+class Database(object):
+    """A SQLite database selected through REPOSITORY_METRICS_CONFIG"""
+    def __init__(self, directory, name):
+        self.config = os.path.join(directory, name + '.cfg')
+        with open(self.config, 'w') as config_file:
+            config_file.write("[sqlalchemy]\ndsn=sqlite:///{0}\n"
+                              "echo=False\n".format(
+                                  os.path.join(directory, name + '.db')))
+        with self.selected() as session:
+            model.Base.metadata.create_all(session.get_bind())
+
+    @contextmanager
+    def selected(self):
+        """Make this the configured database and yield its session"""
+        environ = os.environ.get('REPOSITORY_METRICS_CONFIG')
+        os.environ['REPOSITORY_METRICS_CONFIG'] = self.config
+        try:
+            session = model.get_session()
+            yield session
+            session.remove()
+        finally:
+            if environ is None:
+                del os.environ['REPOSITORY_METRICS_CONFIG']
+            else:
+                os.environ['REPOSITORY_METRICS_CONFIG'] = environ
+
+    def rows(self, name):
+        """Return the sorted rows of one of the QUERIES"""
+        with self.selected() as session:
+            return sorted(tuple(row)
+                          for row in session.execute(text(QUERIES[name])))
+
+
+def read_reports(directory, context):
+    """Return the editor and metadata report contents of a context"""
+    reports = {}
+    for report in ['editor', 'metadata']:
+        with open(os.path.join(directory, "{0}_{1}.xls".format(
+                context, report)), 'rb') as fh:
+            reports[report] = fh.read()
+    return reports
+
+
+def load_fixtures(database, directory, bulk):
+    """Load the fixture reports and downloads into a database"""
+    with database.selected() as session:
+        authors = AuthorIndex.load(session)
+        for context in benchmark.CONTEXTS:
+            reports = read_reports(directory, context)
+            if bulk:
+                load.process_context_bulk(None, context, session,
+                                          batch_size=7, reports=reports,
+                                          authors=authors)
+            else:
+                load.process_context(None, context, session,
+                                     reports=reports, authors=authors)
+        load_downloads.main(argparse.Namespace(
+            url=os.path.join(directory, 'downloads.xls'), daily=False,
+            rejects=os.path.join(directory, 'rejected_urls.txt'),
+            batch_size=7))
+
+
+class LoadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='load-')
+        benchmark.generate(cls.directory, 10, 3, 4, 5, seed=1)
+        cls.rows = Database(cls.directory, 'rows')
+        cls.bulk = Database(cls.directory, 'bulk')
+        load_fixtures(cls.rows, cls.directory, bulk=False)
+        load_fixtures(cls.bulk, cls.directory, bulk=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        model.dispose_engines()
+        shutil.rmtree(cls.directory)
+
+    def test_row_and_bulk_loads_match(self):
+        for name in sorted(QUERIES):
+            rows = self.rows.rows(name)
+            self.assertTrue(rows, name)
+            self.assertEqual(rows, self.bulk.rows(name), name)
+
+    def test_reload_is_unchanged(self):
+        for database in (self.rows, self.bulk):
+            with database.selected() as session:
+                reports = read_reports(self.directory, 'dlj')
+                counts = load.process_context_bulk(None, 'dlj', session,
+                                                   reports=reports)
+                self.assertEqual(counts, {'inserted': 0, 'updated': 0,
+                                          'unchanged': 10})
+
+    def test_source_hash_covers_only_written_values(self):
+        reports = read_reports(self.directory, 'dlj')
+        row = dict(next(read_excel(reports['editor'])).items())
+        source_hash = load.normalize('dlj', row, {})['values']['source_hash']
+        # the title is only written on creation
+        row['Title'] = u"Renamed"
+        self.assertEqual(load.normalize('dlj', row, {})['values']
+                         ['source_hash'], source_hash)
+        row['Status'] = u"withdrawn"
+        self.assertNotEqual(load.normalize('dlj', row, {})['values']
+                            ['source_hash'], source_hash)
+
+    def test_exports_match_golden_files(self):
+        with self.rows.selected():
+            for name in sorted(export.REPORTS):
+                output = os.path.join(self.directory, name + '.csv')
+                export.export(export.REPORTS[name], output)
+                with open(output, 'rb') as fh:
+                    contents = fh.read()
+                golden = os.path.join(EXPORTS, name + '.csv')
+                if os.environ.get('UPDATE_EXPORTS'):
+                    with open(golden, 'wb') as fh:
+                        fh.write(contents)
+                with open(golden, 'rb') as fh:
+                    self.assertEqual(contents, fh.read(), name)
+
+    def test_export_workers_match_serial(self):
+        with self.rows.selected():
+            output = os.path.join(self.directory, 'faculty-workers.csv')
+            export.export(export.REPORTS['faculty'], output, workers=2)
+            with open(output, 'rb') as fh:
+                contents = fh.read()
+        with open(os.path.join(EXPORTS, 'faculty.csv'), 'rb') as fh:
+            self.assertEqual(contents, fh.read())
+
+
+class RollupRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rollup-refresh-')
+        benchmark.generate(self.directory, 10, 3, 4, 5, seed=1)
+
+    def tearDown(self):
+        model.dispose_engines()
+        shutil.rmtree(self.directory)
+
+    def test_updates_refresh_the_previous_author_and_context(self):
+        for bulk in (False, True):
+            database = Database(self.directory, 'bulk' if bulk else 'rows')
+            load_fixtures(database, self.directory, bulk)
+            with database.selected() as session:
+                (article_id,) = session.execute(text(
+                    "SELECT article_id FROM creators WHERE email IS NOT NULL "
+                    "AND article_id IN (SELECT article_id FROM downloads) "
+                    "ORDER BY article_id")).first()
+                # as if the report had moved the article
+                author_id = session.execute(text(
+                    "INSERT INTO authors (name_key, email) "
+                    "VALUES ('moved', 'moved@law.duke.edu')")).lastrowid
+                session.execute(text(
+                    "UPDATE creators SET email = 'moved@law.duke.edu', "
+                    "author_id = :author WHERE article_id = :id"),
+                    {'id': article_id, 'author': author_id})
+                session.execute(text(
+                    "UPDATE articles SET context = 'moved', "
+                    "source_hash = NULL WHERE id = :id"), {'id': article_id})
+                session.commit()
+                rollups.rebuild(session)
+                context = model.article_context(session.execute(text(
+                    "SELECT oai_identifier FROM articles WHERE id = :id"),
+                    {'id': article_id}).scalar())
+                reports = read_reports(self.directory, context)
+                if bulk:
+                    load.process_context_bulk(None, context, session,
+                                              reports=reports)
+                else:
+                    load.process_context(None, context, session,
+                                         reports=reports)
+                self.assertEqual(rollups.check(session), 0, bulk)
+
+
+class CachedLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='cached-load-')
+        self.reports = os.path.join(self.directory, 'reports')
+        os.mkdir(self.reports)
+        benchmark.generate(self.reports, 3, 1, 2, 1)
+        self.server = ReportServer(self.reports)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.database = Database(self.directory, 'cached')
+        self.version = load.LOADER_VERSION
+
+    def tearDown(self):
+        load.LOADER_VERSION = self.version
+        self.server.shutdown()
+        self.server.server_close()
+        model.dispose_engines()
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        """Run load.py over the dlj reports and return its output"""
+        args = argparse.Namespace(
+            server=self.server.url(), contexts=['dlj'], bulk=True,
+            batch_size=500, workers=2, timeout=10, retries=0,
+            cache_dir=os.path.join(self.directory, 'cache'), cache_size=1,
+            no_cache=False)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            with self.database.selected():
+                load.main(args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_unchanged_reports_are_skipped(self):
+        self.assertIn("3 inserted", self.load())
+        self.assertIn("unchanged: dlj", self.load())
+
+    def test_new_loader_version_loads_again(self):
+        self.load()
+        load.LOADER_VERSION = self.version + 1
+        output = self.load()
+        self.assertNotIn("unchanged: dlj", output)
+        self.assertIn("3 unchanged", output)
+        self.assertIn("unchanged: dlj", self.load())
+
+    def test_missing_report_loads_loads_everything(self):
+        with self.database.selected() as session:
+            model.ReportLoad.__table__.drop(session.get_bind())
+        output = self.load()
+        self.assertIn("report_loads is missing", output)
+        self.assertIn("3 inserted", output)
+        self.assertIn("3 unchanged", self.load())
+
+
+if __name__ == '__main__':
+    unittest.main()
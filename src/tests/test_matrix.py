@@ -0,0 +1,79 @@
+"""Matrix snapshot pivots against the SQL aggregates"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+import numpy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from api_benchmark import generate
+from repository_metrics import matrix, rollups
+from repository_metrics.model import Base, bump_dataset_version
+
+
+class MatrixTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='matrix-')
+        engine = create_engine('sqlite:///' +
+                               os.path.join(cls.directory, 'matrix.db'))
+        Base.metadata.create_all(engine)
+        cls.session = scoped_session(sessionmaker(bind=engine))
+        generate(cls.session, 40, 3, 5, 1)
+        cls.snapshot_directory = os.path.join(cls.directory, 'snapshot')
+        matrix.build(cls.session, cls.snapshot_directory)
+        cls.snapshot = matrix.Snapshot(cls.snapshot_directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.remove()
+        shutil.rmtree(cls.directory)
+
+    def pivot(self, by):
+        """Return {(label, YYYY-MM): count} of the non zero pivot cells"""
+        (labels, counts) = getattr(self.snapshot, 'by_' + by)()
+        months = self.snapshot.month_labels()
+        return dict(((label, months[column]), count)
+                    for (label, row) in zip(labels, counts.tolist())
+                    for (column, count) in enumerate(row) if count)
+
+    def aggregate(self, query):
+        """Return {(key, YYYY-MM): count} of a rollup select"""
+        return dict(((key, download_date.strftime('%Y-%m')), count)
+                    for (key, download_date, count)
+                    in self.session.execute(query()) if count)
+
+    def test_author_totals_match_sql(self):
+        self.assertEqual(self.pivot('author'),
+                         self.aggregate(rollups.author_month_query))
+
+    def test_context_totals_match_sql(self):
+        self.assertEqual(self.pivot('context'),
+                         self.aggregate(rollups.context_month_query))
+
+    def test_group_sum(self):
+        counts = numpy.arange(12).reshape(4, 3)
+        self.assertEqual(matrix.group_sum(counts, [1, -1, 1, 0], 3).tolist(),
+                         [[9, 10, 11], [6, 8, 10], [0, 0, 0]])
+        # a row may count towards several groups
+        self.assertEqual(matrix.group_sum(counts, [0, 1, 1], 2,
+                                          rows=[2, 2, 3]).tolist(),
+                         [[6, 7, 8], [15, 17, 19]])
+
+    def test_stale_snapshot_warns(self):
+        self.assertTrue(self.snapshot.is_current(self.session))
+        bump_dataset_version(self.session)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertFalse(matrix.warn_if_stale(self.snapshot,
+                                                  self.session))
+            self.assertIn("--snapshot", sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""Migrations planned from the metadata the caller passes in"""
+import unittest
+from sqlalchemy import create_engine, inspect, text
+from repository_metrics import migrate
+from repository_metrics.model import (AuthorDownloadTotal, Base,
+                                      SearchPosting)
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+
+    def test_adds_missing_tables_and_indexes(self):
+        Base.metadata.create_all(self.engine)
+        SearchPosting.__table__.drop(self.engine)
+        with self.engine.connect() as connection:
+            steps = [description for (description, step)
+                     in migrate.plan(connection, Base.metadata)]
+        self.assertEqual(steps[0], "create table search_postings")
+        self.assertEqual(migrate.migrate(self.engine, Base.metadata), 1)
+        self.assertIn('search_postings',
+                      inspect(self.engine).get_table_names())
+        self.assertEqual(migrate.migrate(self.engine, Base.metadata), 0)
+
+    def test_recreates_a_derived_table_with_a_new_key(self):
+        Base.metadata.create_all(self.engine)
+        AuthorDownloadTotal.__table__.drop(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE author_download_totals (email VARCHAR(255) "
+                "PRIMARY KEY, download_count INTEGER)"))
+        self.assertEqual(migrate.migrate(self.engine, Base.metadata), 1)
+        self.assertEqual(inspect(self.engine).get_pk_constraint(
+            'author_download_totals')['constrained_columns'], ['author_id'])
+        self.assertEqual(migrate.migrate(self.engine, Base.metadata), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""Engines created per process and dsn"""
+import os
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from repository_metrics import model
+from repository_metrics.api import api
+
+
+class EngineTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='model-')
+        self.environ = os.environ.get('REPOSITORY_METRICS_CONFIG')
+        config = os.path.join(self.directory, 'repository-metrics.cfg')
+        with open(config, 'w') as config_file:
+            config_file.write("[sqlalchemy]\ndsn=sqlite://\necho=False\n"
+                              "[api]\nstatement_timeout=30000\n")
+        os.environ['REPOSITORY_METRICS_CONFIG'] = config
+        self.limits = []
+        self.set_statement_timeout = model.set_statement_timeout
+        model.set_statement_timeout = \
+            lambda engine, milliseconds: self.limits.append(milliseconds)
+
+    def tearDown(self):
+        model.set_statement_timeout = self.set_statement_timeout
+        model.limit_statements(None)
+        model.dispose_engines()
+        if self.environ is None:
+            del os.environ['REPOSITORY_METRICS_CONFIG']
+        else:
+            os.environ['REPOSITORY_METRICS_CONFIG'] = self.environ
+        shutil.rmtree(self.directory)
+
+    def engine(self, name):
+        return model.get_engine('sqlite:///' +
+                                os.path.join(self.directory, name))
+
+    def test_statement_timeout_only_when_limited(self):
+        self.engine('batch.db')
+        self.assertEqual(self.limits, [])
+        model.limit_statements(30000)
+        self.engine('api.db')
+        self.assertEqual(self.limits, [30000])
+
+    def test_api_limits_statements_on_its_first_request(self):
+        # importing the package, as the loaders do, sets no limit
+        self.assertIsNone(model._statement_timeout)
+        app = Flask(__name__)
+        app.register_blueprint(api, url_prefix='/api')
+        app.test_client().get('/api/missing')
+        self.assertEqual(model._statement_timeout, 30000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""KeysetPagination over ORM queries and selects in both directions"""
+import unittest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from repository_metrics.model import Article, Base, KeysetPagination
+
+
+class KeysetPaginationTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all([Article(id=article_id,
+                                      title=u"Title {0:02d}".format(
+                                          article_id % 4))
+                              for article_id in range(1, 11)])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def page(self, cursor=None, sort=Article.id, descending=False,
+             core=False):
+        if core:
+            return KeysetPagination(select([Article.id, Article.title]),
+                                    sort, Article.id, 4, cursor=cursor,
+                                    total_count=10, descending=descending,
+                                    session=self.session)
+        return KeysetPagination(self.session.query(Article), sort,
+                                Article.id, 4, cursor=cursor,
+                                total_count=10, descending=descending)
+
+    def ids(self, page):
+        return [item.id for item in page.items]
+
+    def walk(self, **kwargs):
+        """Return the pages forwards, then backwards from the last one"""
+        pages = [self.page(**kwargs)]
+        while pages[-1].has_next:
+            pages.append(self.page(pages[-1].next_cursor, **kwargs))
+        backwards = [pages[-1]]
+        while backwards[0].has_prev:
+            backwards.insert(0, self.page(backwards[0].prev_cursor,
+                                          **kwargs))
+        return (pages, backwards)
+
+    def flags(self, pages):
+        return [(page.page, page.has_prev, page.has_next) for page in pages]
+
+    def test_forwards_and_backwards(self):
+        for core in (False, True):
+            (pages, backwards) = self.walk(core=core)
+            self.assertEqual([self.ids(page) for page in pages],
+                             [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]])
+            self.assertEqual(self.flags(pages),
+                             [(1, False, True), (2, True, True),
+                              (3, True, False)])
+            self.assertEqual([self.ids(page) for page in backwards],
+                             [self.ids(page) for page in pages])
+            self.assertEqual(self.flags(backwards), self.flags(pages))
+
+    def test_descending_by_title(self):
+        (pages, backwards) = self.walk(sort=Article.title, descending=True)
+        self.assertEqual([self.ids(page) for page in pages],
+                         [[7, 3, 10, 6], [2, 9, 5, 1], [8, 4]])
+        self.assertEqual([self.ids(page) for page in backwards],
+                         [self.ids(page) for page in pages])
+        self.assertEqual(self.flags(backwards), self.flags(pages))
+
+    def test_backwards_past_deleted_rows(self):
+        first = self.page()
+        second = self.page(first.next_cursor)
+        self.session.query(Article).filter(Article.id > 4).delete()
+        self.session.commit()
+        page = self.page(second.prev_cursor)
+        self.assertEqual(self.ids(page), [1, 2, 3, 4])
+        self.assertFalse(page.has_prev)
+        self.assertFalse(page.has_next)
+        self.assertIsNone(page.next_cursor)
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, self.page, 'nonsense')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+"""Profile summaries of command line runs"""
+import os
+import subprocess
+import sys
+import unittest
+
+SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_peak_rss_excludes_the_parent(self):
+        # a parent 200MB larger than the child
+        ballast = 'x' * (200 * 1024 * 1024)
+        output = subprocess.check_output(
+            [sys.executable, '-c', "from repository_metrics import "
+             "profiling; print(profiling.peak_rss_kb())"], cwd=SOURCE)
+        self.assertLess(int(output), 150 * 1024)
+        del ballast
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""ResponseCache entries and the dataset version"""
+import json
+import unittest
+from flask import Flask, jsonify
+from repository_metrics.response_cache import ResponseCache
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.version = 1
+        self.renders = 0
+        self.cache = ResponseCache(lambda: self.version, version_ttl=0)
+        application = Flask(__name__)
+
+        @application.route('/value')
+        @self.cache.cached
+        def value():
+            self.renders += 1
+            rendered = self.version
+            if self.renders == 1:
+                # a load finishes while the first request renders
+                self.version = 2
+                self.cache.check_version()
+            return jsonify({'version': rendered})
+        self.client = application.test_client()
+
+    def get(self):
+        return json.loads(self.client.get('/value').get_data())['version']
+
+    def test_entry_rendered_before_a_version_change_is_dropped(self):
+        self.assertEqual(self.get(), 1)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+        self.assertEqual(self.get(), 2)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+        self.assertEqual(self.get(), 2)
+        self.assertEqual(self.renders, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""Search terms, BM25 ranking and the postings the loaders keep"""
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+import benchmark
+import load
+from repository_metrics import model, search
+from repository_metrics.model import (Article, ArticleDownloadTotal, Base,
+                                      SearchPosting, Subject)
+from tests.test_load import Database, load_fixtures, read_reports
+
+
+class TermsTest(unittest.TestCase):
+    def test_terms(self):
+        self.assertEqual(search.terms(u"The Law of the Sea"), [u'law', u'sea'])
+        self.assertEqual(search.terms(u"Caf\xe9 R\xe9gime, 1990s-era"),
+                         [u'cafe', u'regime', u'1990s', u'era'])
+        self.assertEqual(search.terms(None), [])
+        self.assertEqual(search.terms(u"x" * 100), [u"x" * search.TERM_LENGTH])
+        self.assertTrue(all(isinstance(term, unicode)
+                            for term in search.terms(u"Water Rights")))
+
+    def test_article_terms_weight_fields(self):
+        self.assertEqual(search.article_terms(search.article_fields(
+            u"Water Rights", [u"Water"], [u"Environmental Law"])),
+            {u'water': search.TITLE_WEIGHT + search.SUBJECT_WEIGHT,
+             u'rights': search.TITLE_WEIGHT,
+             u'environmental': search.DISCIPLINE_WEIGHT,
+             u'law': search.DISCIPLINE_WEIGHT})
+
+
+class RankingTest(unittest.TestCase):
+    # id: (title, subjects, downloads)
+    ARTICLES = {1: (u"Water Rights in the West", [], 10),
+                2: (u"Water Law", [u"Water"], 5),
+                3: (u"Mineral Rights", [], 50),
+                4: (u"Mineral Rights", [], 70),
+                5: (u"Securities Regulation", [u"Securities"], 0)}
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        for (article_id, (title, subjects, downloads)) in \
+                self.ARTICLES.items():
+            self.session.add(Article(id=article_id, title=title))
+            for (position, term) in enumerate(subjects):
+                self.session.add(Subject(article_id=article_id,
+                                         position=position, term=term))
+            self.session.add(ArticleDownloadTotal(
+                article_id=article_id, download_count=downloads))
+        self.session.commit()
+        search.rebuild(self.session)
+        self.index = search.SearchIndex.load(self.session)
+
+    def tearDown(self):
+        self.session.close()
+
+    def ids(self, query):
+        return [article_id for (article_id, score, downloads)
+                in self.index.search(query)]
+
+    def test_higher_term_frequency_ranks_first(self):
+        # the title and subject of 2 both hold water
+        self.assertEqual(self.ids(u"water"), [2, 1])
+
+    def test_rarer_terms_weigh_more(self):
+        # mineral is in two articles, west in one
+        self.assertEqual(self.ids(u"west mineral"), [1, 4, 3])
+
+    def test_equal_scores_rank_the_most_downloaded_first(self):
+        [(first, score, downloads), second] = self.index.search(u"mineral")
+        self.assertEqual((first, downloads), (4, 70))
+        self.assertEqual(second, (3, score, 50))
+        self.assertEqual(self.index.search(u"mineral", limit=1),
+                         [(first, score, downloads)])
+
+    def test_no_match(self):
+        self.assertEqual(self.ids(u"the"), [])
+        self.assertEqual(self.ids(u"antitrust"), [])
+
+
+class LoaderPostingsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='search-postings-')
+        benchmark.generate(self.directory, 10, 3, 4, 5, seed=1)
+
+    def tearDown(self):
+        search._index = None
+        model.dispose_engines()
+        shutil.rmtree(self.directory)
+
+    def postings(self, session):
+        return sorted(session.query(SearchPosting.term,
+                                    SearchPosting.article_id,
+                                    SearchPosting.frequency))
+
+    def test_loads_rewrite_the_postings_of_changed_articles(self):
+        for bulk in (False, True):
+            database = Database(self.directory, 'bulk' if bulk else 'rows')
+            load_fixtures(database, self.directory, bulk)
+            # the versions of the two databases may be equal
+            search._index = None
+            with database.selected() as session:
+                loaded = self.postings(session)
+                search.rebuild(session)
+                self.assertEqual(self.postings(session), loaded, bulk)
+                # as if the keywords had changed since the last load
+                article_id = session.query(Subject.article_id).\
+                    order_by(Subject.article_id).first()[0]
+                session.execute(text(
+                    "UPDATE subjects SET term = 'obsolete' "
+                    "WHERE article_id = :id"), {'id': article_id})
+                session.execute(text(
+                    "UPDATE articles SET source_hash = NULL "
+                    "WHERE id = :id"), {'id': article_id})
+                search.index_articles(session, [article_id])
+                session.commit()
+                self.assertEqual(search.search(session, u"obsolete")[0][0],
+                                 article_id)
+                context = session.query(Article.context).\
+                    filter(Article.id == article_id).scalar()
+                reports = read_reports(self.directory, context)
+                if bulk:
+                    load.process_context_bulk(None, context, session,
+                                              reports=reports)
+                else:
+                    load.process_context(None, context, session,
+                                         reports=reports)
+                # as load.py does after its contexts
+                model.bump_dataset_version(session)
+                self.assertEqual(self.postings(session), loaded, bulk)
+                self.assertEqual(search.search(session, u"obsolete"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()